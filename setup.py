@@ -28,7 +28,7 @@ class build_ext_opt(build_ext):
 
 cpp_extension = cythonize([
     Extension('testbeam_analysis.analysis_functions', ['testbeam_analysis/cpp/analysis_functions.pyx'])
-])
+], include_path=['testbeam_analysis/cpp'])  # data_struct.pxd
 
 author = 'David-Leon Pohl, Christian Bespin, Jens Janssen, Luigi Vigani'
 author_email = 'pohl@physik.uni-bonn.de'
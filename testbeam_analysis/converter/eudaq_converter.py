@@ -7,6 +7,8 @@ import tables as tb
 
 from eudaq2np import data_np
 
+from testbeam_analysis.tools import analysis_utils
+
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - [%(levelname)-8s] (%(threadName)-10s) %(message)s")
 
 
@@ -63,6 +65,11 @@ def format_hit_table(input_file):
                     hits_formatted['row'] = hits_actual_dut['y'] + 1
                     hits_formatted['charge'] = hits_actual_dut['val']
                     hit_table_out.append(hits_formatted)
+                    if analysis_utils.check_event_order(hits_formatted['event_number'], np.iinfo(np.int64).min):  # The time stamps of EUDAQ are not guaranteed to increase
+                        hit_table_out.attrs.sorted_by_event = True
+                        analysis_utils.create_event_index(hit_table_out)
+                    else:
+                        logging.warning('The event number of DUT%d does not always increase. No event index is created.', dut_index)
 
 if __name__ == "__main__":
     # Input raw data file names
@@ -102,10 +102,13 @@ def align_events(input_file, output_file, fix_event_number=True, fix_trigger_num
             hit_table_out = out_file_h5.create_table(out_file_h5.root, name='Hits', description=hit_table_description, title='Selected hits for test beam analysis', filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False), chunkshape=(chunk_size,))
  
             # Correct hit event number
+            last_event_number = np.iinfo(np.int64).min
+            output_sorted, last_output_event_number = True, np.iinfo(np.int64).min  # The corrected event numbers are checked too, they are not necessarily sorted
             for hits, _ in analysis_utils.data_aligned_at_events(hit_table, chunk_size=chunk_size):
  
-                if not np.all(np.diff(hits['event_number']) >= 0):
+                if not analysis_utils.check_event_order(hits['event_number'], last_event_number):
                     raise RuntimeError('The event number does not always increase. This data cannot be used like this!')
+                last_event_number = hits['event_number'][-1]
  
                 if fix_trigger_number is True:
                     selection = np.logical_or((hits['trigger_status'] & 0b00000001) == 0b00000001,
@@ -148,7 +151,14 @@ def align_events(input_file, output_file, fix_event_number=True, fix_trigger_num
 #                 FIX FOR DIAMOND:
 #                 selected_hits['event_number'] -= 1  # FIX FOR DIAMOND EVENT OFFSET
  
+                if fix_event_number is True and output_sorted:
+                    output_sorted = analysis_utils.check_event_order(selected_hits['event_number'], last_output_event_number)
+                if selected_hits.shape[0] != 0:
+                    last_output_event_number = selected_hits['event_number'][-1]
                 hit_table_out.append(selected_hits)
+            hit_table_out.attrs.sorted_by_event = output_sorted
+            if output_sorted:
+                analysis_utils.create_event_index(hit_table_out)
 
         jumps = np.unique(np.array(jumps))
         logging.info('Corrected %d inconsistencies in the event number. %d hits corrected.' % (jumps[jumps != 0].shape[0], n_fixed_hits))
@@ -177,9 +187,11 @@ def format_hit_table(input_file, output_file):
             hits_formatted['column'] = hits['column']
             hits_formatted['row'] = hits['row']
             hits_formatted['charge'] = hits['tot']
-            if not np.all(np.diff(hits_formatted['event_number']) >= 0):
+            if not analysis_utils.check_event_order(hits_formatted['event_number'], np.iinfo(np.int64).min):
                 raise RuntimeError('The event number does not always increase. This data cannot be used like this!')
             hit_table_out.append(hits_formatted)
+            hit_table_out.attrs.sorted_by_event = True
+            analysis_utils.create_event_index(hit_table_out)
 
 
 def _function_wrapper_process_dut(args):  # needed for multiprocessing call with arguments
@@ -7,9 +7,9 @@ import os
 import progressbar
 import warnings
 from collections import Iterable
+from multiprocessing import Pool, cpu_count
 
 import matplotlib.pyplot as plt
-from multiprocessing import Pool, cpu_count
 import tables as tb
 import numpy as np
 from scipy.optimize import curve_fit, minimize_scalar, leastsq, basinhopping, OptimizeWarning, minimize
@@ -27,11 +27,22 @@ from testbeam_analysis.result_analysis import calculate_residuals
 warnings.simplefilter("ignore", OptimizeWarning)  # Fit errors are handled internally, turn of warnings
 
 
-def correlate_cluster(input_cluster_files, output_correlation_file, n_pixels, pixel_size=None, dut_names=None, chunk_size=4999999):
+def correlate_cluster(input_cluster_files, output_correlation_file, n_pixels, pixel_size=None, dut_names=None, correlation_pairs=None, bin_size=None, n_events_window=None, max_peak_shift=None, chunk_size=4999999):
     '''Histograms the cluster column (row) of two different devices on an event basis.
 
     If the cluster positions are correlated a line should be seen. The cluster positions are round to 1 um precision to increase the histogramming speed.
     All permutations are considered (all cluster of the first device are correlated with all cluster of the second device).
+    All cluster files are read in one pass, the correlation histograms of all requested DUT pairs are filled at once.
+    The histograms are binned in pixels of the DUTs. If bin_size is set, they are binned in um instead. This reduces the
+    histogram size for devices with very different pixel sizes. The bin size is stored in the bin_size attribute of the histograms.
+
+    If n_events_window is set, the correlation quality is also determined for each event window to find event ranges where
+    the DUTs are not synchronized. The windows start at the first event of the run, like the noisy pixel windows. The quality is the fraction of the cluster pairs with a position difference close to the
+    correlation peak (the diagonal). The quality is stored in the CorrelationQuality tables.
+
+    For the pre-alignment usually a small part of the run is sufficient. If max_peak_shift is set the correlation peaks are checked
+    after each chunk and the reading stops as soon as the peaks do not move anymore. The number of used events is stored in the
+    n_events attribute of the correlation histograms, the converged attribute is True if the reading stopped early.
 
     Parameters
     ----------
@@ -47,72 +58,116 @@ def correlate_cluster(input_cluster_files, output_correlation_file, n_pixels, pi
         e.g. for 2 DUTs: pixel_size = [(250, 50), (250, 50)]
     dut_names : iterable of strings
         To show the DUT names in the plot
+    correlation_pairs : iterable of tuples
+        The (DUT index, reference DUT index) pairs to correlate, e.g. [(1, 0), (2, 1)] correlates DUT1 to DUT0 and DUT2 to DUT1.
+        If None, all DUTs are correlated to DUT0.
+    bin_size : iterable of tuples
+        One tuple per DUT describing the bin size of the correlation histograms in um in column, row direction,
+        e.g. for 2 DUTs: bin_size = [(250, 50), (250, 50)]. Needs pixel_size. If None, one bin per pixel is used.
+    n_events_window : int
+        The number of events of the event windows for the correlation quality. The window of a cluster is
+        (event number - first event number) // n_events_window. If None, the correlation quality is not determined.
+    max_peak_shift : float
+        Stop reading if the mean shift of the correlation peak positions (argmax for each DUT pixel column / row) between two chunks
+        is below max_peak_shift bins for all histograms. A DUT pixel column / row that gets a peak for the first time counts as
+        shifted by the number of DUT bins. If None, all cluster are used.
     chunk_size: int
         Defines the amount of in-RAM data. The higher the more RAM is used and the faster this function works.
+        If max_peak_shift is set, this also defines how often the convergence is checked.
     '''
 
     logging.info('=== Correlate the position of %d DUTs ===', len(input_cluster_files))
 
-    with tb.open_file(output_correlation_file, mode="w") as out_file_h5:
-        n_duts = len(input_cluster_files)
+    if correlation_pairs is None:
+        correlation_pairs = [(dut_index, 0) for dut_index in range(1, len(input_cluster_files))]
+
+    if bin_size is not None:
+        if pixel_size is None:
+            raise ValueError('The pixel size is needed to bin the correlation in um')
+        n_bins = [tuple(_get_n_bins(n_pixels[dut_index][dimension] * pixel_size[dut_index][dimension], bin_size[dut_index][dimension]) for dimension in range(2)) for dut_index in range(len(input_cluster_files))]
+    else:
+        n_bins = n_pixels
+
+    if n_events_window is not None:
+        position_scale = pixel_size if pixel_size is not None else [(1., 1.)] * len(input_cluster_files)  # Without pixel size all pixels are assumed to have the same size
+        # The position differences are histogrammed in reference pixels, the histograms cover all possible differences
+        n_difference_bins = [tuple(2 * int(np.ceil(0.5 * (n_pixels[dut_index][dimension] * position_scale[dut_index][dimension] / float(position_scale[ref_index][dimension]) + n_pixels[ref_index][dimension]))) + 1 for dimension in range(2)) for dut_index, ref_index in correlation_pairs]
+        difference_hists = [({}, {}) for _ in correlation_pairs]  # Column, row difference histogram for each event window and pair
+        first_event_numbers = []  # The cluster are sorted by event number, thus the first cluster of all DUTs gives the first event of the run
+        for input_cluster_file in input_cluster_files:
+            with tb.open_file(input_cluster_file, mode='r') as in_file_h5:
+                if in_file_h5.root.Cluster.nrows != 0:
+                    first_event_numbers.append(in_file_h5.root.Cluster[0]['event_number'])
+        first_event_number = min(first_event_numbers) if first_event_numbers else 0
 
+    with tb.open_file(output_correlation_file, mode="w") as out_file_h5:
         # Result arrays to be filled
         column_correlations = []
         row_correlations = []
-        for dut_index in range(1, n_duts):
-            shape_column = (n_pixels[dut_index][0], n_pixels[0][0])
-            shape_row = (n_pixels[dut_index][1], n_pixels[0][1])
-            column_correlations.append(np.zeros(shape_column, dtype=np.int))
-            row_correlations.append(np.zeros(shape_row, dtype=np.int))
-
-        start_indices = [0] * (n_duts - 1)  # Store the loop indices for speed up
-
-        with tb.open_file(input_cluster_files[0], mode='r') as in_file_h5:  # Open DUT0 cluster file
-            progress_bar = progressbar.ProgressBar(widgets=['', progressbar.Percentage(), ' ', progressbar.Bar(marker='*', left='|', right='|'), ' ', progressbar.AdaptiveETA()], maxval=in_file_h5.root.Cluster.shape[0], term_width=80)
-            progress_bar.start()
-
-            pool = Pool()  # Provide worker pool
-            for cluster_dut_0, index in analysis_utils.data_aligned_at_events(in_file_h5.root.Cluster, chunk_size=chunk_size):  # Loop over the cluster of DUT0 in chunks
-                actual_event_numbers = cluster_dut_0[:]['event_number']
-
-                # Create correlation histograms to the reference device for all other devices
-                # Do this in parallel to safe time
-
-                dut_results = []
-                for dut_index, cluster_file in enumerate(input_cluster_files[1:], start=1):  # Loop over the other cluster files
-                    dut_results.append(pool.apply_async(_correlate_cluster, kwds={'cluster_dut_0': cluster_dut_0,
-                                                                                  'cluster_file': cluster_file,
-                                                                                  'start_index': start_indices[dut_index - 1],
-                                                                                  'start_event_number': actual_event_numbers[0],
-                                                                                  'stop_event_number': actual_event_numbers[-1] + 1,
-                                                                                  'column_correlation': column_correlations[dut_index - 1],
-                                                                                  'row_correlation': row_correlations[dut_index - 1],
-                                                                                  'chunk_size': chunk_size
-                                                                                  }
-                                                        ))
-                # Collect results when available
-                for dut_index, dut_result in enumerate(dut_results, start=1):
-                    (start_indices[dut_index - 1], column_correlations[dut_index - 1], row_correlations[dut_index - 1]) = dut_result.get()
-
-                progress_bar.update(index)
-
-            pool.close()
-            pool.join()
+        for dut_index, ref_index in correlation_pairs:
+            column_correlations.append(np.zeros((n_bins[dut_index][0], n_bins[ref_index][0]), dtype=np.uint32))
+            row_correlations.append(np.zeros((n_bins[dut_index][1], n_bins[ref_index][1]), dtype=np.uint32))
+
+        with tb.open_file(input_cluster_files[0], mode='r') as in_file_h5:
+            n_cluster_dut_0 = in_file_h5.root.Cluster.shape[0]
+        progress_bar = progressbar.ProgressBar(widgets=['', progressbar.Percentage(), ' ', progressbar.Bar(marker='*', left='|', right='|'), ' ', progressbar.AdaptiveETA()], maxval=n_cluster_dut_0, term_width=80)
+        progress_bar.start()
+
+        n_cluster_read, n_events = 0, 0
+        converged, last_peaks = False, None
+        for cluster in analysis_utils.merge_aligned_at_events(input_cluster_files, node_name='Cluster', chunk_size=chunk_size):  # Loop over the cluster of all DUTs in one pass, the cluster of each step have the same event range
+            n_cluster_read += cluster[0].shape[0]
+            if n_events_window is not None:
+                _fill_difference_histograms(cluster, correlation_pairs, n_pixels, position_scale, n_events_window, first_event_number, difference_hists, n_difference_bins)
+            if bin_size is not None:  # Change the cluster position from pixel index to bin index
+                cluster = [_get_binned_cluster(cluster[dut_index], n_pixels[dut_index], pixel_size[dut_index], bin_size[dut_index], n_bins[dut_index]) for dut_index in range(len(cluster))]
+            for pair_index, (dut_index, ref_index) in enumerate(correlation_pairs):
+                if cluster[ref_index].shape[0] == 0 or cluster[dut_index].shape[0] == 0:
+                    continue
+                analysis_utils.correlate_cluster_on_event_number_parallel(data_1=cluster[ref_index],
+                                                                          data_2=cluster[dut_index],
+                                                                          column_corr_hist=column_correlations[pair_index],
+                                                                          row_corr_hist=row_correlations[pair_index])
+            n_events += np.unique(np.concatenate([actual_cluster['event_number'] for actual_cluster in cluster])).shape[0]
+            progress_bar.update(n_cluster_read)
+
+            if max_peak_shift is not None:  # Stop if the correlation peaks do not move anymore
+                peaks = [_get_correlation_peaks(correlation) for correlation in column_correlations + row_correlations]
+                if last_peaks is not None and _correlation_peaks_converged(last_peaks, peaks, max_peak_shift=max_peak_shift):
+                    logging.info('Correlation converged after %d events', n_events)
+                    converged = True
+                    break
+                last_peaks = peaks
 
         # Store the correlation histograms
-        for dut_index in range(n_duts - 1):
-            out_col = out_file_h5.create_carray(out_file_h5.root, name='CorrelationColumn_%d_0' % (dut_index + 1), title='Column Correlation between DUT %d and %d' % (dut_index + 1, 0), atom=tb.Atom.from_dtype(column_correlations[dut_index].dtype), shape=column_correlations[dut_index].shape, filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
-            out_row = out_file_h5.create_carray(out_file_h5.root, name='CorrelationRow_%d_0' % (dut_index + 1), title='Row Correlation between DUT %d and %d' % (dut_index + 1, 0), atom=tb.Atom.from_dtype(row_correlations[dut_index].dtype), shape=row_correlations[dut_index].shape, filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
-            out_col.attrs.filenames = [str(input_cluster_files[0]), str(input_cluster_files[dut_index])]
-            out_row.attrs.filenames = [str(input_cluster_files[0]), str(input_cluster_files[dut_index])]
-            out_col[:] = column_correlations[dut_index]
-            out_row[:] = row_correlations[dut_index]
+        for pair_index, (dut_index, ref_index) in enumerate(correlation_pairs):
+            out_col = out_file_h5.create_carray(out_file_h5.root, name='CorrelationColumn_%d_%d' % (dut_index, ref_index), title='Column Correlation between DUT %d and %d' % (dut_index, ref_index), atom=tb.Atom.from_dtype(column_correlations[pair_index].dtype), shape=column_correlations[pair_index].shape, filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+            out_row = out_file_h5.create_carray(out_file_h5.root, name='CorrelationRow_%d_%d' % (dut_index, ref_index), title='Row Correlation between DUT %d and %d' % (dut_index, ref_index), atom=tb.Atom.from_dtype(row_correlations[pair_index].dtype), shape=row_correlations[pair_index].shape, filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+            out_col.attrs.filenames = [str(input_cluster_files[ref_index]), str(input_cluster_files[dut_index])]
+            out_row.attrs.filenames = [str(input_cluster_files[ref_index]), str(input_cluster_files[dut_index])]
+            for dimension, out_array in enumerate((out_col, out_row)):
+                out_array.attrs.n_events = n_events
+                out_array.attrs.converged = converged
+                if bin_size is not None:
+                    out_array.attrs.bin_size = [bin_size[ref_index][dimension], bin_size[dut_index][dimension]]
+            out_col[:] = column_correlations[pair_index]
+            out_row[:] = row_correlations[pair_index]
+
+            if n_events_window is not None:
+                quality = _get_correlation_quality(difference_hists[pair_index], n_events_window, first_event_number)
+                out_quality = out_file_h5.create_table(out_file_h5.root, name='CorrelationQuality_%d_%d' % (dut_index, ref_index), description=quality.dtype, title='Correlation quality between DUT %d and %d' % (dut_index, ref_index), filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+                out_quality.append(quality)
+                out_quality.attrs.n_events_window = n_events_window
+                median_fraction = np.nanmedian(quality['column_fraction'])
+                n_bad_windows = np.count_nonzero(np.logical_or(quality['column_fraction'] < 0.5 * median_fraction, quality['row_fraction'] < 0.5 * np.nanmedian(quality['row_fraction'])))
+                if n_bad_windows:
+                    logging.warning('Low correlation between DUT %d and %d in %d of %d event windows, check synchronization', dut_index, ref_index, n_bad_windows, quality.shape[0])
         progress_bar.finish()
 
     plot_utils.plot_correlations(input_correlation_file=output_correlation_file, pixel_size=pixel_size, dut_names=dut_names)
 
 
-def merge_cluster_data(input_cluster_files, output_merged_file, n_pixels, pixel_size, chunk_size=4999999):
+def merge_cluster_data(input_cluster_files, output_merged_file, n_pixels, pixel_size, compact=False, chunk_size=4999999):
     '''Takes the cluster from all cluster files and merges them into one big table aligned at a common event number.
     Empty entries are signaled with column = row = charge = nan. Position is translated from indices to um. The
     local coordinate system rigin (0, 0) is defined in the sensor center, to decouple translation and rotation.
@@ -121,6 +176,12 @@ def merge_cluster_data(input_cluster_files, output_merged_file, n_pixels, pixel_
     available (translation/rotation for each plane), otherwise pre-alignment data (offset, slope of correlation)
     will be used.
 
+    To omit the merged cluster file use analysis_utils.MergedClusterView as input of apply_alignment or find_tracks instead.
+
+    The compact format stores the positions and charge as float32 and omits the z columns, since z is the same for all hits
+    of a DUT until the alignment is applied. The z positions of the DUTs are stored in the z_positions attribute of the table.
+    apply_alignment, find_tracks and fit_tracks read both formats.
+
     Parameters
     ----------
     input_cluster_files : list of pytables files
@@ -133,83 +194,29 @@ def merge_cluster_data(input_cluster_files, output_merged_file, n_pixels, pixel_
     pixel_size : iterable of tuples
         One tuple per DUT describing the pixel dimension in um in column, row direction
         e.g. for 2 DUTs: pixel_size = [(250, 50), (250, 50)]
+    compact : boolean
+        Use the compact format with float32 positions and charge and without z columns.
     chunk_size: int
         Defines the amount of in RAM data. The higher the more RAM is used and the faster this function works.
     '''
     logging.info('=== Merge cluster from %d DUTSs to merged hit file ===', len(input_cluster_files))
 
-    # Create result array description, depends on the number of DUTs
-    description = [('event_number', np.int64)]
-    for index, _ in enumerate(input_cluster_files):
-        description.append(('x_dut_%d' % index, np.float))
-    for index, _ in enumerate(input_cluster_files):
-        description.append(('y_dut_%d' % index, np.float))
-    for index, _ in enumerate(input_cluster_files):
-        description.append(('z_dut_%d' % index, np.float))
-    for index, _ in enumerate(input_cluster_files):
-        description.append(('charge_dut_%d' % index, np.float))
-    description.extend([('track_quality', np.uint32), ('n_tracks', np.int8)])
-
-    start_indices = [0] * len(input_cluster_files)  # Store the loop indices for speed up
-    start_indices_2 = [0] * len(input_cluster_files)  # Additional indices for second loop
+    merged_cluster = analysis_utils.MergedClusterView(input_cluster_files, n_pixels=n_pixels, pixel_size=pixel_size, compact=compact, chunk_size=chunk_size)
 
     # Merge the cluster data from different DUTs into one table
     with tb.open_file(output_merged_file, mode='w') as out_file_h5:
-        merged_cluster_table = out_file_h5.create_table(out_file_h5.root, name='MergedCluster', description=np.zeros((1,), dtype=description).dtype, title='Merged cluster on event number', filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
-        with tb.open_file(input_cluster_files[0], mode='r') as in_file_h5:  # Open DUT0 cluster file
-            progress_bar = progressbar.ProgressBar(widgets=['', progressbar.Percentage(), ' ', progressbar.Bar(marker='*', left='|', right='|'), ' ', progressbar.AdaptiveETA()], maxval=in_file_h5.root.Cluster.shape[0], term_width=80)
-            progress_bar.start()
-            actual_start_event_number = 0  # Defines the first event number of the actual chunk for speed up. Cannot be deduced from DUT0, since this DUT could have missing event numbers.
-            for cluster_dut_0, index in analysis_utils.data_aligned_at_events(in_file_h5.root.Cluster, chunk_size=chunk_size):  # Loop over the cluster of DUT0 in chunks
-                actual_event_numbers = cluster_dut_0[:]['event_number']
-
-                # First loop: calculate the minimum event number indices needed to merge all cluster from all files to this event number index
-                common_event_numbers = actual_event_numbers
-                for dut_index, cluster_file in enumerate(input_cluster_files[1:], start=1):  # Loop over the other cluster files
-                    with tb.open_file(cluster_file, mode='r') as actual_in_file_h5:  # Open DUT0 cluster file
-                        for actual_cluster, start_indices[dut_index] in analysis_utils.data_aligned_at_events(actual_in_file_h5.root.Cluster, start=start_indices[dut_index], start_event_number=actual_start_event_number, stop_event_number=actual_event_numbers[-1] + 1, chunk_size=chunk_size):  # Loop over the cluster in the actual cluster file in chunks
-                            common_event_numbers = analysis_utils.get_max_events_in_both_arrays(common_event_numbers, actual_cluster[:]['event_number'])
-                merged_cluster_array = np.empty((common_event_numbers.shape[0],), dtype=description)  # Result array to be filled. For no hit: column = row = NaN
-                merged_cluster_array[:] = np.nan
-
-                # Set the event number
-                merged_cluster_array['event_number'] = common_event_numbers[:]
-
-                # Fill result array with DUT 0 data
-                actual_cluster = analysis_utils.map_cluster(common_event_numbers, cluster_dut_0)
-                # Add only real hits, nan is a virtual hit
-                selection = ~np.isnan(actual_cluster['mean_column'])
-                # Convert indices to positions, origin defined in the center of the sensor
-                merged_cluster_array['x_dut_0'][selection] = pixel_size[0][0] * (actual_cluster['mean_column'][selection] - 0.5 - (0.5 * n_pixels[0][0]))
-                merged_cluster_array['y_dut_0'][selection] = pixel_size[0][1] * (actual_cluster['mean_row'][selection] - 0.5 - (0.5 * n_pixels[0][1]))
-                merged_cluster_array['z_dut_0'][selection] = 0.0
-                merged_cluster_array['charge_dut_0'][selection] = actual_cluster['charge'][selection]
-
-                # Fill result array with other DUT data
-                # Second loop: get the cluster from all files and merge them to the common event number
-                for dut_index, cluster_file in enumerate(input_cluster_files[1:], start=1):  # Loop over the other cluster files
-                    with tb.open_file(cluster_file, mode='r') as actual_in_file_h5:  # Open other DUT cluster file
-                        for actual_cluster, start_indices_2[dut_index] in analysis_utils.data_aligned_at_events(actual_in_file_h5.root.Cluster, start=start_indices_2[dut_index], start_event_number=common_event_numbers[0], stop_event_number=common_event_numbers[-1] + 1, chunk_size=chunk_size):  # Loop over the cluster in the actual cluster file in chunks
-                            actual_cluster = analysis_utils.map_cluster(common_event_numbers, actual_cluster)
-                            # Add only real hits, nan is a virtual hit
-                            selection = ~np.isnan(actual_cluster['mean_column'])
-                            # Convert indices to positions, origin in the center of the sensor
-                            actual_mean_column = pixel_size[dut_index][0] * (actual_cluster['mean_column'][selection] - 0.5 - (0.5 * n_pixels[dut_index][0]))
-                            actual_mean_row = pixel_size[dut_index][1] * (actual_cluster['mean_row'][selection] - 0.5 - (0.5 * n_pixels[dut_index][1]))
-
-                            merged_cluster_array['x_dut_%d' % (dut_index)][selection] = actual_mean_column
-                            merged_cluster_array['y_dut_%d' % (dut_index)][selection] = actual_mean_row
-                            merged_cluster_array['z_dut_%d' % (dut_index)][selection] = 0.0
-
-                            merged_cluster_array['charge_dut_%d' % (dut_index)][selection] = actual_cluster['charge'][selection]
-
-                merged_cluster_table.append(merged_cluster_array)
-                actual_start_event_number = common_event_numbers[-1] + 1  # Set the starting event number for the next chunked read
-                progress_bar.update(index)
-            progress_bar.finish()
-
-
-def prealignment(input_correlation_file, output_alignment_file, z_positions, pixel_size, s_n=0.1, fit_background=False, reduce_background=False, dut_names=None, no_fit=False, non_interactive=True, iterations=2):
+        merged_cluster_table = out_file_h5.create_table(out_file_h5.root, name=merged_cluster.name, description=merged_cluster.dtype, title=merged_cluster.title, filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+        if compact:  # z is the same for all hits of a DUT before the alignment
+            merged_cluster_table.attrs.z_positions = merged_cluster.z_positions
+        progress_bar = progressbar.ProgressBar(widgets=['', progressbar.Percentage(), ' ', progressbar.Bar(marker='*', left='|', right='|'), ' ', progressbar.AdaptiveETA()], maxval=merged_cluster.shape[0], term_width=80)
+        progress_bar.start()
+        for merged_cluster_array, index in merged_cluster.read_aligned_at_events():  # Loop over the cluster of all DUTs in one pass
+            merged_cluster_table.append(merged_cluster_array)
+            progress_bar.update(index)
+        progress_bar.finish()
+
+
+def prealignment(input_correlation_file, output_alignment_file, z_positions, pixel_size, s_n=0.1, fit_background=False, reduce_background=False, dut_names=None, no_fit=False, non_interactive=True, iterations=2, background_components=1, background_iterations=4, n_processes=None):
     '''Deduce a pre-alignment from the correlations, by fitting the correlations with a straight line (gives offset, slope, but no tild angles).
        The user can define cuts on the fit error and straight line offset in an interactive way.
 
@@ -234,13 +241,20 @@ def prealignment(input_correlation_file, output_alignment_file, z_positions, pix
     no_fit : bool
         Use Hough transformation to calculate slope and offset.
     pixel_size: iterable
-        Iterable of tuples with column and row pixel size in um
+        Iterable of tuples with column and row pixel size in um. Not used for correlation histograms that are binned in um.
     dut_names: iterable
         List of names of the DUTs.
     non_interactive : boolean
-        Deactivate user interaction and apply cuts automatically
+        Deactivate user interaction and apply cuts automatically. The correlations of all DUTs and axes are
+        then pre-aligned in parallel processes.
     iterations : number
         Only used in non interactive mode. Sets how often automatic cuts are applied.
+    background_components : int
+        Number of largest singular values of the correlation matrix that are taken as background. Only used if reduce_background is True.
+    background_iterations : int
+        Number of power iterations of the truncated SVD that calculates the background. Only used if reduce_background is True.
+    n_processes : int
+        Number of processes used in non interactive mode. If None, the number of CPUs is used.
     '''
     logging.info('=== Pre-alignment ===')
 
@@ -256,206 +270,54 @@ def prealignment(input_correlation_file, output_alignment_file, z_positions, pix
 
     with PdfPages(os.path.join(os.path.dirname(os.path.abspath(output_alignment_file)), 'Prealignment.pdf')) as output_pdf:
         with tb.open_file(input_correlation_file, mode="r") as in_file_h5:
-            n_duts = len(in_file_h5.list_nodes("/")) // 2 + 1  # no correlation for reference DUT0
+            correlation_nodes = [node for node in in_file_h5.root if isinstance(node, tb.CArray) and int(re.findall(r'\d+', node.name)[1]) == 0]  # The pre-alignment uses the correlations to DUT0 only
+            n_duts = max([int(re.findall(r'\d+', node.name)[0]) for node in correlation_nodes] + [0]) + 1  # The DUTs do not have to be correlated in consecutive pairs
             result = np.zeros(shape=(n_duts,), dtype=[('DUT', np.uint8), ('column_c0', np.float), ('column_c0_error', np.float), ('column_c1', np.float), ('column_c1_error', np.float), ('column_sigma', np.float), ('column_sigma_error', np.float), ('row_c0', np.float), ('row_c0_error', np.float), ('row_c1', np.float), ('row_c1_error', np.float), ('row_sigma', np.float), ('row_sigma_error', np.float), ('z', np.float)])
             # Set std. settings for reference DUT0
             result[0]['column_c0'], result[0]['column_c0_error'] = 0.0, 0.0
             result[0]['column_c1'], result[0]['column_c1_error'] = 1.0, 0.0
             result[0]['row_c0'], result[0]['row_c0_error'] = 0.0, 0.0
             result[0]['row_c1'], result[0]['row_c1_error'] = 1.0, 0.0
-            result[0]['z'] = z_positions[0]
-            for node in in_file_h5.root:
+            result['DUT'] = np.arange(n_duts)
+            result['z'] = z_positions[:n_duts]
+            jobs, dut_indices = [], []
+            for node in correlation_nodes:
                 table_prefix = 'column' if 'column' in node.name.lower() else 'row'
                 indices = re.findall(r'\d+', node.name)
                 dut_idx = int(indices[0])
                 ref_idx = int(indices[1])
-                result[dut_idx]['DUT'] = dut_idx
                 dut_name = dut_names[dut_idx] if dut_names else ("DUT " + str(dut_idx))
                 ref_name = dut_names[ref_idx] if dut_names else ("DUT " + str(ref_idx))
-                logging.info('Aligning data from %s', node.name)
 
-                if "column" in node.name.lower():
+                if 'bin_size' in node.attrs:  # Correlation is binned in um, the bins are used as pixels
+                    pixel_size_ref, pixel_size_dut = node.attrs.bin_size
+                elif "column" in node.name.lower():
                     pixel_size_dut, pixel_size_ref = pixel_size[dut_idx][0], pixel_size[ref_idx][0]
                 else:
                     pixel_size_dut, pixel_size_ref = pixel_size[dut_idx][1], pixel_size[ref_idx][1]
 
-                data = node[:]
-
-                n_pixel_dut, n_pixel_ref = data.shape[0], data.shape[1]
-
-                # Initialize arrays with np.nan (invalid), adding 0.5 to change from index to position
-                # matrix index 0 is cluster index 1 ranging from 0.5 to 1.4999, which becomes position 0.0 to 0.999 with center at 0.5, etc.
-                x_ref = (np.linspace(0.0, n_pixel_ref, num=n_pixel_ref, endpoint=False, dtype=np.float) + 0.5)
-                x_dut = (np.linspace(0.0, n_pixel_dut, num=n_pixel_dut, endpoint=False, dtype=np.float) + 0.5)
-                coeff_fitted = [None] * n_pixel_dut
-                mean_fitted = np.empty(shape=(n_pixel_dut,), dtype=np.float)  # Peak of the Gauss fit
-                mean_fitted.fill(np.nan)
-                mean_error_fitted = np.empty(shape=(n_pixel_dut,), dtype=np.float)  # Error of the fit of the peak
-                mean_error_fitted.fill(np.nan)
-                sigma_fitted = np.empty(shape=(n_pixel_dut,), dtype=np.float)  # Sigma of the Gauss fit
-                sigma_fitted.fill(np.nan)
-                chi2 = np.empty(shape=(n_pixel_dut,), dtype=np.float)  # Chi2 of the fit
-                chi2.fill(np.nan)
-                n_cluster = np.sum(data, axis=1)  # Number of hits per bin
-
-                if reduce_background:
-                    uu, dd, vv = np.linalg.svd(data)  # sigular value decomposition
-                    background = np.matrix(uu[:, :1]) * np.diag(dd[:1]) * np.matrix(vv[:1, :])  # take first sigular value for background
-                    background = np.array(background, dtype=np.int)  # make Numpy array
-                    data = (data - background).astype(np.int)  # remove background
-                    data -= data.min()  # only positive values
-
-                if no_fit:
-                    # calculate half hight
-                    median = np.median(data)
-                    median_max = np.median(np.max(data, axis=1))
-                    half_median_data = (data > ((median + median_max) / 2))
-                    # calculate maximum per column
-                    max_select = np.argmax(data, axis=1)
-                    hough_data = np.zeros_like(data)
-                    hough_data[np.arange(data.shape[0]), max_select] = 1
-                    # select maximums if larger than half hight
-                    hough_data = hough_data & half_median_data
-                    # transpose for correct angle
-                    hough_data = hough_data.T
-                    accumulator, theta, rho, theta_edges, rho_edges = analysis_utils.hough_transform(hough_data, theta_res=0.1, rho_res=1.0, return_edges=True)
-                    rho_idx, th_idx = np.unravel_index(accumulator.argmax(), accumulator.shape)
-                    rho_val, theta_val = rho[rho_idx], theta[th_idx]
-                    slope_idx, offset_idx = -np.cos(theta_val) / np.sin(theta_val), rho_val / np.sin(theta_val)
-                    slope = slope_idx * (pixel_size_ref / pixel_size_dut)
-                    offset = offset_idx * pixel_size_ref
-                    # offset in the center of the pixel matrix
-                    offset_center = offset + slope * pixel_size_dut * n_pixel_dut * 0.5 - pixel_size_ref * n_pixel_ref * 0.5
-                    offset_center += 0.5 * pixel_size_ref - slope * 0.5 * pixel_size_dut  # correct for half bin
-
-                    result[dut_idx][table_prefix + '_c0'], result[dut_idx][table_prefix + '_c0_error'] = offset_center, 0.0
-                    result[dut_idx][table_prefix + '_c1'], result[dut_idx][table_prefix + '_c1_error'] = slope, 0.0
-                    result[dut_idx][table_prefix + '_sigma'], result[dut_idx][table_prefix + '_sigma_error'] = 0.0, 0.0
-                    result[dut_idx]['z'] = z_positions[dut_idx]
-
-                    plot_utils.plot_hough(
-                        x=x_dut,
-                        data=hough_data,
-                        accumulator=accumulator,
-                        offset=offset_idx,
-                        slope=slope_idx,
-                        theta_edges=theta_edges,
-                        rho_edges=rho_edges,
-                        n_pixel_ref=n_pixel_ref,
-                        n_pixel_dut=n_pixel_dut,
-                        pixel_size_ref=pixel_size_ref,
-                        pixel_size_dut=pixel_size_dut,
-                        ref_name=ref_name,
-                        dut_name=dut_name,
-                        prefix=table_prefix,
-                        output_pdf=output_pdf)
+                jobs.append(dict(node_name=node.name, data=node[:], table_prefix=table_prefix, pixel_size_dut=pixel_size_dut, pixel_size_ref=pixel_size_ref, dut_name=dut_name, ref_name=ref_name, s_n=s_n, fit_background=fit_background, reduce_background=reduce_background, no_fit=no_fit, non_interactive=non_interactive, iterations=iterations, background_components=background_components, background_iterations=background_iterations))
+                dut_indices.append(dut_idx)
 
-                else:
-                    # fill the arrays from above with values
-                    _fit_data(x=x_ref, data=data, s_n=s_n, coeff_fitted=coeff_fitted, mean_fitted=mean_fitted, mean_error_fitted=mean_error_fitted, sigma_fitted=sigma_fitted, chi2=chi2, fit_background=fit_background, reduce_background=reduce_background)
-
-                    # Convert fit results to metric units for alignment fit
-                    # Origin is center of pixel matrix
-                    x_dut_scaled = (x_dut - 0.5 * n_pixel_dut) * pixel_size_dut
-                    mean_fitted_scaled = (mean_fitted - 0.5 * n_pixel_ref) * pixel_size_ref
-                    mean_error_fitted_scaled = mean_error_fitted * pixel_size_ref
-
-                    # Selected data arrays
-                    x_selected = x_dut.copy()
-                    x_dut_scaled_selected = x_dut_scaled.copy()
-                    mean_fitted_scaled_selected = mean_fitted_scaled.copy()
-                    mean_error_fitted_scaled_selected = mean_error_fitted_scaled.copy()
-                    sigma_fitted_selected = sigma_fitted.copy()
-                    chi2_selected = chi2.copy()
-                    n_cluster_selected = n_cluster.copy()
-
-                    # Show the straigt line correlation fit including fit errors and offsets from the fit
-                    # Let the user change the cuts (error limit, offset limit) and refit until result looks good
-                    refit = True
-                    selected_data = np.ones_like(x_dut, dtype=np.bool)
-                    actual_iteration = 0  # Refit counter for non interactive mode
-                    while(refit):
-                        selected_data, fit, refit = plot_utils.plot_alignments(x=x_dut_scaled_selected,
-                                                                               mean_fitted=mean_fitted_scaled_selected,
-                                                                               mean_error_fitted=mean_error_fitted_scaled_selected,
-                                                                               n_cluster=n_cluster_selected,
-                                                                               ref_name=ref_name,
-                                                                               dut_name=dut_name,
-                                                                               prefix=table_prefix,
-                                                                               non_interactive=non_interactive)
-                        x_selected = x_selected[selected_data]
-                        x_dut_scaled_selected = x_dut_scaled_selected[selected_data]
-                        mean_fitted_scaled_selected = mean_fitted_scaled_selected[selected_data]
-                        mean_error_fitted_scaled_selected = mean_error_fitted_scaled_selected[selected_data]
-                        sigma_fitted_selected = sigma_fitted_selected[selected_data]
-                        chi2_selected = chi2_selected[selected_data]
-                        n_cluster_selected = n_cluster_selected[selected_data]
-                        # Stop in non interactive mode if the number of refits (iterations) is reached
-                        if non_interactive:
-                            actual_iteration += 1
-                            if actual_iteration > iterations:
-                                break
-
-                    # Linear fit, usually describes correlation very well, slope is close to 1.
-                    # With low energy beam and / or beam with diverse agular distribution, the correlation will not be perfectly straight
-                    # Use results from straight line fit as start values for this final fit
-                    re_fit, re_fit_pcov = curve_fit(analysis_utils.linear, x_dut_scaled_selected, mean_fitted_scaled_selected, sigma=mean_error_fitted_scaled_selected, absolute_sigma=True, p0=[fit[0], fit[1]])
-
-                    # Write fit results to array
-                    result[dut_idx][table_prefix + '_c0'], result[dut_idx][table_prefix + '_c0_error'] = re_fit[0], np.absolute(re_fit_pcov[0][0]) ** 0.5
-                    result[dut_idx][table_prefix + '_c1'], result[dut_idx][table_prefix + '_c1_error'] = re_fit[1], np.absolute(re_fit_pcov[1][1]) ** 0.5
-                    result[dut_idx]['z'] = z_positions[dut_idx]
-
-                    # Calculate mean sigma (is a residual when assuming straight tracks) and its error and store the actual data in result array
-                    # This error is needed for track finding and track quality determination
-                    mean_sigma = pixel_size_ref * np.mean(np.array(sigma_fitted_selected))
-                    mean_sigma_error = pixel_size_ref * np.std(np.array(sigma_fitted_selected)) / np.sqrt(np.array(sigma_fitted_selected).shape[0])
-
-                    result[dut_idx][table_prefix + '_sigma'], result[dut_idx][table_prefix + '_sigma_error'] = mean_sigma, mean_sigma_error
-
-                    # Calculate the index of the beam center based on valid indices
-                    plot_index = np.average(x_selected - 1, weights=np.sum(data, axis=1)[np.array(x_selected - 1, dtype=np.int)])
-                    # Find nearest valid index to the calculated index
-                    idx = (np.abs(x_selected - 1 - plot_index)).argmin()
-                    plot_index = np.array(x_selected - 1, dtype=np.int)[idx]
-
-                    if np.all(np.isnan(coeff_fitted[plot_index][3:6])):
-                        y_fit = analysis_utils.gauss_offset(x_ref, *coeff_fitted[plot_index][[0, 1, 2, 6]])
-                        fit_label = "Gauss-Offset"
-                    else:
-                        y_fit = analysis_utils.double_gauss_offset(x_ref, *coeff_fitted[plot_index])
-                        fit_label = "Gauss-Gauss-Offset"
-                    plot_utils.plot_correlation_fit(x=x_ref,
-                                                    y=data[plot_index, :],
-                                                    y_fit=y_fit,
-                                                    xlabel='%s %s' % ("Column" if "column" in node.name.lower() else "Row", ref_name),
-                                                    fit_label=fit_label,
-                                                    title="Correlation of %s: %s vs. %s at %s %d" % (table_prefix + "s", ref_name, dut_name, table_prefix, plot_index),
-                                                    output_pdf=output_pdf)
-
-                    # Plot selected data with fit
-                    fit_fn = np.poly1d(re_fit[::-1])
-                    selected_indices = np.searchsorted(x_dut_scaled, x_dut_scaled_selected)
-                    mask = np.zeros_like(x_dut_scaled, dtype=np.bool)
-                    mask[selected_indices] = True
-                    plot_utils.plot_alignment_fit(
-                        x=x_dut_scaled,
-                        mean_fitted=mean_fitted_scaled,
-                        mask=mask,
-                        fit_fn=fit_fn,
-                        fit=re_fit,
-                        pcov=re_fit_pcov,
-                        chi2=chi2,
-                        mean_error_fitted=mean_error_fitted_scaled,
-                        n_cluster=n_cluster,
-                        n_pixel_ref=n_pixel_ref,
-                        n_pixel_dut=n_pixel_dut,
-                        pixel_size_ref=pixel_size_ref,
-                        pixel_size_dut=pixel_size_dut,
-                        ref_name=ref_name,
-                        dut_name=dut_name,
-                        prefix=table_prefix,
-                        output_pdf=output_pdf)
+            if n_processes is None:
+                n_processes = cpu_count()
+            if non_interactive and n_processes > 1 and len(jobs) > 1:  # The correlations are independent, align them in parallel processes
+                pool = Pool(min(n_processes, len(jobs)))
+                try:
+                    results = [pool.apply_async(_prealign_correlation, kwds=job) for job in jobs]
+                    results = [actual_result.get() for actual_result in results]  # Results in the order of the correlation nodes, thus the plots are in a deterministic order
+                    pool.close()
+                finally:
+                    pool.terminate()  # Do not leave worker processes behind if a worker failed
+                    pool.join()
+            else:  # User interaction needs the main process, a single correlation is not worth the process overhead
+                results = [_prealign_correlation(**job) for job in jobs]
+
+            for dut_idx, (alignment_result, plots) in zip(dut_indices, results):
+                for name, value in alignment_result.items():
+                    result[dut_idx][name] = value
+                for plot_function, kwargs in plots:
+                    getattr(plot_utils, plot_function)(output_pdf=output_pdf, **kwargs)
 
             logging.info('Store pre alignment data in %s', output_alignment_file)
             with tb.open_file(output_alignment_file, mode="w") as out_file_h5:
@@ -466,7 +328,196 @@ def prealignment(input_correlation_file, output_alignment_file, z_positions, pix
                     logging.warning('Coarse alignment table exists already. Do not create new.')
 
 
-def _fit_data(x, data, s_n, coeff_fitted, mean_fitted, mean_error_fitted, sigma_fitted, chi2, fit_background, reduce_background):
+def _prealign_correlation(node_name, data, table_prefix, pixel_size_dut, pixel_size_ref, dut_name, ref_name, s_n, fit_background, reduce_background, no_fit, non_interactive, iterations, background_components=1, background_iterations=4):
+    ''' Deduces the pre-alignment of one correlation histogram. Returns the alignment results and the plots to create
+    as a list of plot_utils function names and arguments. The plots are created by the calling process, since the PDF
+    file cannot be shared between processes. '''
+    logging.info('Aligning data from %s', node_name)
+    result, plots = {}, []
+
+    n_pixel_dut, n_pixel_ref = data.shape[0], data.shape[1]
+
+    # Initialize arrays with np.nan (invalid), adding 0.5 to change from index to position
+    # matrix index 0 is cluster index 1 ranging from 0.5 to 1.4999, which becomes position 0.0 to 0.999 with center at 0.5, etc.
+    x_ref = (np.linspace(0.0, n_pixel_ref, num=n_pixel_ref, endpoint=False, dtype=np.float) + 0.5)
+    x_dut = (np.linspace(0.0, n_pixel_dut, num=n_pixel_dut, endpoint=False, dtype=np.float) + 0.5)
+    coeff_fitted = [None] * n_pixel_dut
+    mean_fitted = np.empty(shape=(n_pixel_dut,), dtype=np.float)  # Peak of the Gauss fit
+    mean_fitted.fill(np.nan)
+    mean_error_fitted = np.empty(shape=(n_pixel_dut,), dtype=np.float)  # Error of the fit of the peak
+    mean_error_fitted.fill(np.nan)
+    sigma_fitted = np.empty(shape=(n_pixel_dut,), dtype=np.float)  # Sigma of the Gauss fit
+    sigma_fitted.fill(np.nan)
+    chi2 = np.empty(shape=(n_pixel_dut,), dtype=np.float)  # Chi2 of the fit
+    chi2.fill(np.nan)
+    n_cluster = np.sum(data, axis=1)  # Number of hits per bin
+
+    if reduce_background:
+        uu, dd, vv = analysis_utils.truncated_svd(data, n_components=background_components, n_iterations=background_iterations)  # sigular value decomposition of the largest sigular values only
+        background = np.matrix(uu) * np.diag(dd) * np.matrix(vv)  # take largest sigular values for background
+        background = np.array(background, dtype=np.int)  # make Numpy array
+        data = (data - background).astype(np.int)  # remove background
+        data -= data.min()  # only positive values
+
+    if no_fit:
+        # calculate half hight
+        median = np.median(data)
+        median_max = np.median(np.max(data, axis=1))
+        half_median_data = (data > ((median + median_max) / 2))
+        # calculate maximum per column
+        max_select = np.argmax(data, axis=1)
+        hough_data = np.zeros_like(data)
+        hough_data[np.arange(data.shape[0]), max_select] = 1
+        # select maximums if larger than half hight
+        hough_data = hough_data & half_median_data
+        # transpose for correct angle
+        hough_data = hough_data.T
+        accumulator, theta, rho, theta_edges, rho_edges, (rho_idx, th_idx) = analysis_utils.hough_transform(hough_data, theta_res=0.1, rho_res=1.0, return_edges=True, return_peak=True)
+        rho_val, theta_val = rho[rho_idx], theta[th_idx]
+        slope_idx, offset_idx = -np.cos(theta_val) / np.sin(theta_val), rho_val / np.sin(theta_val)
+        slope = slope_idx * (pixel_size_ref / pixel_size_dut)
+        offset = offset_idx * pixel_size_ref
+        # offset in the center of the pixel matrix
+        offset_center = offset + slope * pixel_size_dut * n_pixel_dut * 0.5 - pixel_size_ref * n_pixel_ref * 0.5
+        offset_center += 0.5 * pixel_size_ref - slope * 0.5 * pixel_size_dut  # correct for half bin
+
+        result[table_prefix + '_c0'], result[table_prefix + '_c0_error'] = offset_center, 0.0
+        result[table_prefix + '_c1'], result[table_prefix + '_c1_error'] = slope, 0.0
+        result[table_prefix + '_sigma'], result[table_prefix + '_sigma_error'] = 0.0, 0.0
+
+        plots.append(('plot_hough', dict(
+            x=x_dut,
+            data=hough_data,
+            accumulator=accumulator,
+            offset=offset_idx,
+            slope=slope_idx,
+            theta_edges=theta_edges,
+            rho_edges=rho_edges,
+            n_pixel_ref=n_pixel_ref,
+            n_pixel_dut=n_pixel_dut,
+            pixel_size_ref=pixel_size_ref,
+            pixel_size_dut=pixel_size_dut,
+            ref_name=ref_name,
+            dut_name=dut_name,
+            prefix=table_prefix)))
+
+    else:
+        # fill the arrays from above with values
+        _fit_data(x=x_ref, data=data, s_n=s_n, coeff_fitted=coeff_fitted, mean_fitted=mean_fitted, mean_error_fitted=mean_error_fitted, sigma_fitted=sigma_fitted, chi2=chi2, fit_background=fit_background, reduce_background=reduce_background)
+
+        # Convert fit results to metric units for alignment fit
+        # Origin is center of pixel matrix
+        x_dut_scaled = (x_dut - 0.5 * n_pixel_dut) * pixel_size_dut
+        mean_fitted_scaled = (mean_fitted - 0.5 * n_pixel_ref) * pixel_size_ref
+        mean_error_fitted_scaled = mean_error_fitted * pixel_size_ref
+
+        # Selected data arrays
+        x_selected = x_dut.copy()
+        x_dut_scaled_selected = x_dut_scaled.copy()
+        mean_fitted_scaled_selected = mean_fitted_scaled.copy()
+        mean_error_fitted_scaled_selected = mean_error_fitted_scaled.copy()
+        sigma_fitted_selected = sigma_fitted.copy()
+        chi2_selected = chi2.copy()
+        n_cluster_selected = n_cluster.copy()
+
+        # Show the straigt line correlation fit including fit errors and offsets from the fit
+        # Let the user change the cuts (error limit, offset limit) and refit until result looks good
+        refit = True
+        selected_data = np.ones_like(x_dut, dtype=np.bool)
+        actual_iteration = 0  # Refit counter for non interactive mode
+        while(refit):
+            selected_data, fit, refit = plot_utils.plot_alignments(x=x_dut_scaled_selected,
+                                                                   mean_fitted=mean_fitted_scaled_selected,
+                                                                   mean_error_fitted=mean_error_fitted_scaled_selected,
+                                                                   n_cluster=n_cluster_selected,
+                                                                   ref_name=ref_name,
+                                                                   dut_name=dut_name,
+                                                                   prefix=table_prefix,
+                                                                   non_interactive=non_interactive)
+            x_selected = x_selected[selected_data]
+            x_dut_scaled_selected = x_dut_scaled_selected[selected_data]
+            mean_fitted_scaled_selected = mean_fitted_scaled_selected[selected_data]
+            mean_error_fitted_scaled_selected = mean_error_fitted_scaled_selected[selected_data]
+            sigma_fitted_selected = sigma_fitted_selected[selected_data]
+            chi2_selected = chi2_selected[selected_data]
+            n_cluster_selected = n_cluster_selected[selected_data]
+            # Stop in non interactive mode if the number of refits (iterations) is reached
+            if non_interactive:
+                actual_iteration += 1
+                if actual_iteration > iterations:
+                    break
+
+        # Linear fit, usually describes correlation very well, slope is close to 1.
+        # With low energy beam and / or beam with diverse agular distribution, the correlation will not be perfectly straight
+        # Use results from straight line fit as start values for this final fit
+        re_fit, re_fit_pcov = curve_fit(analysis_utils.linear, x_dut_scaled_selected, mean_fitted_scaled_selected, sigma=mean_error_fitted_scaled_selected, absolute_sigma=True, p0=[fit[0], fit[1]])
+
+        # Write fit results to array
+        result[table_prefix + '_c0'], result[table_prefix + '_c0_error'] = re_fit[0], np.absolute(re_fit_pcov[0][0]) ** 0.5
+        result[table_prefix + '_c1'], result[table_prefix + '_c1_error'] = re_fit[1], np.absolute(re_fit_pcov[1][1]) ** 0.5
+
+        # Calculate mean sigma (is a residual when assuming straight tracks) and its error and store the actual data in result array
+        # This error is needed for track finding and track quality determination
+        mean_sigma = pixel_size_ref * np.mean(np.array(sigma_fitted_selected))
+        mean_sigma_error = pixel_size_ref * np.std(np.array(sigma_fitted_selected)) / np.sqrt(np.array(sigma_fitted_selected).shape[0])
+
+        result[table_prefix + '_sigma'], result[table_prefix + '_sigma_error'] = mean_sigma, mean_sigma_error
+
+        # Calculate the index of the beam center based on valid indices
+        plot_index = np.average(x_selected - 1, weights=np.sum(data, axis=1)[np.array(x_selected - 1, dtype=np.int)])
+        # Find nearest valid index to the calculated index
+        idx = (np.abs(x_selected - 1 - plot_index)).argmin()
+        plot_index = np.array(x_selected - 1, dtype=np.int)[idx]
+
+        if np.all(np.isnan(coeff_fitted[plot_index][3:6])):
+            y_fit = analysis_utils.gauss_offset(x_ref, *coeff_fitted[plot_index][[0, 1, 2, 6]])
+            fit_label = "Gauss-Offset"
+        else:
+            y_fit = analysis_utils.double_gauss_offset(x_ref, *coeff_fitted[plot_index])
+            fit_label = "Gauss-Gauss-Offset"
+        plots.append(('plot_correlation_fit', dict(
+            x=x_ref,
+            y=data[plot_index, :],
+            y_fit=y_fit,
+            xlabel='%s %s' % ("Column" if table_prefix == 'column' else "Row", ref_name),
+            fit_label=fit_label,
+            title="Correlation of %s: %s vs. %s at %s %d" % (table_prefix + "s", ref_name, dut_name, table_prefix, plot_index))))
+
+        # Plot selected data with fit
+        fit_fn = np.poly1d(re_fit[::-1])
+        selected_indices = np.searchsorted(x_dut_scaled, x_dut_scaled_selected)
+        mask = np.zeros_like(x_dut_scaled, dtype=np.bool)
+        mask[selected_indices] = True
+        plots.append(('plot_alignment_fit', dict(
+            x=x_dut_scaled,
+            mean_fitted=mean_fitted_scaled,
+            mask=mask,
+            fit_fn=fit_fn,
+            fit=re_fit,
+            pcov=re_fit_pcov,
+            chi2=chi2,
+            mean_error_fitted=mean_error_fitted_scaled,
+            n_cluster=n_cluster,
+            n_pixel_ref=n_pixel_ref,
+            n_pixel_dut=n_pixel_dut,
+            pixel_size_ref=pixel_size_ref,
+            pixel_size_dut=pixel_size_dut,
+            ref_name=ref_name,
+            dut_name=dut_name,
+            prefix=table_prefix)))
+
+    return result, plots
+
+
+def _fit_data(x, data, s_n, coeff_fitted, mean_fitted, mean_error_fitted, sigma_fitted, chi2, fit_background, reduce_background, batch_fit=True):
+    ''' Fits the correlation peak of each row of the correlation histogram and stores the results in the given arrays.
+
+    Without background fit the rows are fitted at once if batch_fit is True. The batched fit uses the start value bounds
+    of each row, while the row by row fit limits the parameters to the range of the previous converged fit. Both take the
+    correlation peak of the row as start value for the mean, thus the results agree within the fit errors. The background fit
+    keeps the mean of the previous converged fit as start value. Rows with a peak of less than 10 entries have several similar
+    local minima, they are fitted row by row like rows where the batched fit does not converge or has an amplitude <= 2.
+    '''
 
     def calc_limits_from_fit(coeff):
         ''' Calculates the fit limits from the last successfull fit.'''
@@ -502,6 +553,16 @@ def _fit_data(x, data, s_n, coeff_fitted, mean_fitted, mean_error_fitted, sigma_
     mu_background = np.zeros_like(n_entries)
     mu_background[n_entries > 0] = np.average(data, axis=1, weights=x)[n_entries > 0] * np.sum(x) / n_entries[n_entries > 0]
 
+    min_entries = n_entries.sum() / n_pixel_dut * 0.01  # Less entries are not fitted if a fit converged before (e.g. columns not in the beam)
+
+    batch_indices = np.flatnonzero((n_entries >= max(min_entries, 1)) & (A_peak >= 10)) if (batch_fit and not fit_background) else np.array([], dtype=np.int64)
+    if batch_indices.shape[0] != 0:  # Fit all rows with enough entries and a clear peak at once, the other rows are fitted one by one below
+        coeff_batch, pcov_batch, converged_batch = _fit_gauss_offset_batch(x, data[batch_indices], A_peak[batch_indices], mu_peak[batch_indices])
+        # Correlation should have at least 2 entries to avoid random fluctuation peaks to be selected
+        batch_index = dict((index, (coeff_batch[i], pcov_batch[i])) for i, index in enumerate(batch_indices) if converged_batch[i] and coeff_batch[i][0] > 2)
+    else:
+        batch_index = {}
+
     coeff = None
     fit_converged = False  # To signal that las fit was good, thus the results can be taken as start values for next fit
 
@@ -512,21 +573,33 @@ def _fit_data(x, data, s_n, coeff_fitted, mean_fitted, mean_error_fitted, sigma_
         # TODO: start fitting from the beam center to get a higher chance to pick up the correlation peak
 
         # omit correlation fit with no entries / correlation (e.g. sensor edges, masked columns)
-        if np.all(data[index, :] == 0):
+        if n_entries[index] == 0:
             no_correlation_indeces.append(index)
             continue
 
         # omit correlation fit if sum of correlation entries is < 1 % of total entries devided by number of indices
         # (e.g. columns not in the beam)
-        n_cluster_curr_index = data[index, :].sum()
-        if fit_converged and n_cluster_curr_index < data.sum() / n_pixel_dut * 0.01:
+        if fit_converged and n_entries[index] < min_entries:
             few_correlation_indeces.append(index)
             continue
 
+        if index in batch_index:  # Take the result of the batched fit
+            coeff_gauss_offset, var_matrix = batch_index[index]
+            fit_converged = True
+            coeff = np.insert(coeff_gauss_offset, 3, [np.nan] * 3)  # Parameters: A_1, mu_1, sigma_1, A_2, mu_2, sigma_2, offset
+            coeff_fitted[index] = coeff
+            mean_fitted[index] = coeff[1]
+            mean_error_fitted[index] = np.sqrt(np.abs(var_matrix[1, 1]))
+            sigma_fitted[index] = np.abs(coeff[2])
+            chi2[index] = analysis_utils.get_chi2(y_data=data[index, :], y_fit=analysis_utils.double_gauss_offset(x, *coeff))
+            continue
+
         # Set start parameters and fit limits
         # Parameters: A_1, mu_1, sigma_1, A_2, mu_2, sigma_2, offset
         if fit_converged and not reduce_background:  # Set start values from last successfull fit, no large difference expected
-            p0 = coeff  # Set start values from last successfull fit
+            p0 = coeff.copy()  # Set start values from last successfull fit
+            if not fit_background:  # The peak moves from row to row, the last mean can be off by several sigma
+                p0[1] = mu_peak[index]
             bounds = calc_limits_from_fit(coeff)  # Set boundaries from previous converged fit
         else:  # No (last) successfull fit, try to dedeuce reasonable start values
             p0 = [A_peak[index], mu_peak[index], 5.0, A_background[index], mu_background[index], analysis_utils.get_rms_from_histogram(data[index, :], x), 0.0]
@@ -602,6 +675,18 @@ def _fit_data(x, data, s_n, coeff_fitted, mean_fitted, mean_error_fitted, sigma_
         logging.info('Very few correlation entries for index %s. Omit correlation fit.', str(few_correlation_indeces)[1:-1])
 
 
+def _fit_gauss_offset_batch(x, data, A_peak, mu_peak):
+    ''' Fits all correlation rows with a gauss + offset at once. The start values are deduced from the peak of each row:
+    the offset is the median, the sigma is deduced from the number of bins above half maximum. '''
+    offset = np.clip(np.median(data, axis=1), 0., A_peak)
+    n_above_half_max = np.count_nonzero(data > (0.5 * (A_peak + offset))[:, np.newaxis], axis=1)
+    sigma = np.maximum(n_above_half_max * (x[1] - x[0]) / 2.3548, 0.5 * (x[1] - x[0]))  # FWHM = 2.3548 sigma
+    p0 = np.column_stack((A_peak - offset, mu_peak, sigma, offset))
+    lower = np.column_stack((np.zeros_like(A_peak), np.full(A_peak.shape, x.min()), np.zeros_like(A_peak), np.zeros_like(A_peak)))
+    upper = np.column_stack((2.0 * A_peak, np.full(A_peak.shape, x.max()), np.full(A_peak.shape, x.max() - x.min()), A_peak))
+    return analysis_utils.fit_gauss_offset(x, data, p0=p0, bounds=(lower, upper))
+
+
 def refit_advanced(x_data, y_data, y_fit, p0):
     ''' Substract the fit from the data, thus only the small signal peak should be left.
     Fit this peak, and refit everything with start values'''
@@ -624,14 +709,16 @@ def apply_alignment(input_hit_file, input_alignment, output_hit_aligned_file, in
     ''' Takes a file with tables containing hit information (x, y, z) and applies the alignment to each DUT hits positions. The alignment data is used. If this is not
     available a fallback to the pre-alignment is done.
     One can also inverse the alignment or apply the alignment without changing the z position.
+    Tables in the compact format (see merge_cluster_data) stay compact if the z position stays the same for all hits of a DUT
+    (pre-alignment or no_z), otherwise they are converted to the full format.
 
     This function cannot be easily made faster with multiprocessing since the computation function (apply_alignment_to_chunk) does not contribute significantly to the runtime (< 20 %),
     but the copy overhead for not shared memory needed for multipgrocessing is higher. Also the hard drive IO can be limiting (30 Mb/s read, 20 Mb/s write to the same disk)
 
     Parameters
     ----------
-    input_hit_file : pytables file
-        Input file name with hit data (e.g. merged data file, tracklets file, etc.)
+    input_hit_file : pytables file or analysis_utils.MergedClusterView
+        Input file name with hit data (e.g. merged data file, tracklets file, etc.) or the lazy merged cluster view
     input_alignment : pytables file or alignment array
         The alignment file with the data
     output_hit_aligned_file : pytables file
@@ -693,31 +780,56 @@ def apply_alignment(input_hit_file, input_alignment, output_hit_aligned_file, in
         if not no_z:
             hits_chunk['z_dut_%d' % dut_index][selection] = hit_z
 
-    # Looper over the hits of all DUTs of all hit tables in chunks and apply the alignment
-    with tb.open_file(input_hit_file, mode='r') as in_file_h5:
-        with tb.open_file(output_hit_aligned_file, mode='w') as out_file_h5:
-            for node in in_file_h5.root:  # Loop over potential hit tables in data file
-                hits = node
-                new_node_name = hits.name
-
-                if new_node_name == 'MergedCluster':  # Merged cluster with alignment are tracklets
-                    new_node_name = 'Tracklets'
+    def apply_alignment_to_table(hits, out_file_h5):
+        new_node_name = hits.name
 
-                hits_aligned_table = out_file_h5.create_table(out_file_h5.root, name=new_node_name, description=np.zeros((1,), dtype=hits.dtype).dtype, title=hits.title, filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+        if new_node_name == 'MergedCluster':  # Merged cluster with alignment are tracklets
+            new_node_name = 'Tracklets'
 
-                progress_bar = progressbar.ProgressBar(widgets=['', progressbar.Percentage(), ' ', progressbar.Bar(marker='*', left='|', right='|'), ' ', progressbar.AdaptiveETA()], maxval=hits.shape[0], term_width=80)
-                progress_bar.start()
-
-                for hits_chunk, index in analysis_utils.data_aligned_at_events(hits, chunk_size=chunk_size):  # Loop over the hits
-                    for dut_index in range(0, n_duts):  # Loop over the DUTs in the hit table
-                        if use_duts is not None and dut_index not in use_duts:  # omit DUT
-                            continue
-
-                        apply_alignment_to_chunk(hits_chunk, dut_index, alignment, inverse, no_z)
+        compact = analysis_utils.is_compact_tracklets(hits)
+        if compact:
+            z_positions = analysis_utils.get_z_positions(hits)
+            keep_compact = use_prealignment or no_z  # Only the fine alignment makes z hit dependent
+            description = hits.dtype if keep_compact else analysis_utils.get_full_tracklets_dtype(hits.dtype)
+        else:
+            description = hits.dtype
+
+        hits_aligned_table = out_file_h5.create_table(out_file_h5.root, name=new_node_name, description=np.zeros((1,), dtype=description).dtype, title=hits.title, filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+        if compact and keep_compact:  # Set the new z position of each DUT by aligning one hit per DUT
+            z_hits = analysis_utils.expand_tracklets(np.zeros((1,), dtype=hits.dtype), z_positions)
+            for dut_index in range(0, n_duts):
+                if use_duts is None or dut_index in use_duts:
+                    apply_alignment_to_chunk(z_hits, dut_index, alignment, inverse, no_z)
+            hits_aligned_table.attrs.z_positions = np.array([z_hits['z_dut_%d' % dut_index][0] for dut_index in range(len(z_positions))], dtype=np.float)
+
+        progress_bar = progressbar.ProgressBar(widgets=['', progressbar.Percentage(), ' ', progressbar.Bar(marker='*', left='|', right='|'), ' ', progressbar.AdaptiveETA()], maxval=hits.shape[0], term_width=80)
+        progress_bar.start()
+
+        for hits_chunk, index in analysis_utils.data_aligned_at_events(hits, chunk_size=chunk_size):  # Loop over the hits
+            if compact:
+                hits_chunk = analysis_utils.expand_tracklets(hits_chunk, z_positions)
+            for dut_index in range(0, n_duts):  # Loop over the DUTs in the hit table
+                if use_duts is not None and dut_index not in use_duts:  # omit DUT
+                    continue
+
+                apply_alignment_to_chunk(hits_chunk, dut_index, alignment, inverse, no_z)
+
+            if compact and keep_compact:
+                hits_chunk = analysis_utils.compact_tracklets(hits_chunk)
+            hits_aligned_table.append(hits_chunk)
+            progress_bar.update(index)
+        progress_bar.finish()
 
-                    hits_aligned_table.append(hits_chunk)
-                    progress_bar.update(index)
-                progress_bar.finish()
+    # Looper over the hits of all DUTs of all hit tables in chunks and apply the alignment
+    with tb.open_file(output_hit_aligned_file, mode='w') as out_file_h5:
+        if isinstance(input_hit_file, analysis_utils.MergedClusterView):  # Merged cluster are created on the fly
+            apply_alignment_to_table(input_hit_file, out_file_h5)
+        else:
+            with tb.open_file(input_hit_file, mode='r') as in_file_h5:
+                for node in in_file_h5.root:  # Loop over potential hit tables in data file
+                    if analysis_utils.is_event_index(node):  # The event index belongs to a hit table
+                        continue
+                    apply_alignment_to_table(node, out_file_h5)
 
     logging.debug('File with newly aligned hits %s', output_hit_aligned_file)
 
@@ -1031,6 +1143,86 @@ def alignment(input_track_candidates_file, input_alignment_file, n_pixels, pixel
 
 
 # Helper functions for the alignment. Not to be used directly.
+def _get_n_bins(size, bin_size):
+    ''' Returns the number of bins of bin_size needed to cover size. '''
+    return int(np.ceil(size / float(bin_size)))
+
+
+def _get_binned_cluster(cluster, n_pixels, pixel_size, bin_size, n_bins):
+    ''' Returns a copy of the cluster with the mean column / row changed from pixel index to bin index.
+    The sensor is centered in the binned range, thus the sensor center is also the center of the correlation histogram. '''
+    binned_cluster = cluster.copy()
+    for dimension, name in enumerate(('mean_column', 'mean_row')):
+        position = (cluster[name] - 0.5) * pixel_size[dimension] + 0.5 * (n_bins[dimension] * bin_size[dimension] - n_pixels[dimension] * pixel_size[dimension])  # Position in um
+        binned_cluster[name] = position / bin_size[dimension] + 0.5
+    return binned_cluster
+
+
+def _fill_difference_histograms(cluster, correlation_pairs, n_pixels, pixel_size, n_events_window, first_event_number, difference_hists, n_bins):
+    ''' Histograms the cluster position difference of the DUT pairs for each event window, counted from first_event_number.
+    The positions are in reference pixels with the origin in the sensor center. The position sum is histogrammed as well,
+    it peaks instead of the difference if the DUT is flipped relative to the reference (correlation slope of -1). '''
+    for pair_index, (dut_index, ref_index) in enumerate(correlation_pairs):
+        if cluster[ref_index].shape[0] == 0 or cluster[dut_index].shape[0] == 0:
+            continue
+        event_number_ref, event_number_dut = np.ascontiguousarray(cluster[ref_index]['event_number']), np.ascontiguousarray(cluster[dut_index]['event_number'])
+        windows, window_index = np.unique((event_number_ref - first_event_number) // n_events_window, return_inverse=True)
+        for dimension, name in enumerate(('mean_column', 'mean_row')):
+            position_ref = cluster[ref_index][name] - 0.5 - 0.5 * n_pixels[ref_index][dimension]
+            position_dut = (cluster[dut_index][name] - 0.5 - 0.5 * n_pixels[dut_index][dimension]) * pixel_size[dut_index][dimension] / float(pixel_size[ref_index][dimension])
+            difference_hist = np.zeros((windows.shape[0], n_bins[pair_index][dimension]), dtype=np.uint32)
+            sum_hist = np.zeros_like(difference_hist)
+            analysis_utils.histogram_difference_on_event_number(event_number_ref, position_ref, event_number_dut, position_dut, window_index, difference_hist)
+            analysis_utils.histogram_difference_on_event_number(event_number_ref, -position_ref, event_number_dut, position_dut, window_index, sum_hist)
+            for window, window_difference_hist in zip(windows, np.stack((difference_hist, sum_hist), axis=1)):  # Event windows can be split between chunks
+                if window in difference_hists[pair_index][dimension]:
+                    difference_hists[pair_index][dimension][window] += window_difference_hist
+                else:
+                    difference_hists[pair_index][dimension][window] = window_difference_hist
+
+
+def _get_correlation_quality(difference_hists, n_events_window, first_event_number=0, max_distance=2):
+    ''' Returns the number of cluster pairs and the fraction of the pairs within max_distance reference pixels of
+    the correlation peak for each event window. The correlation peak is the most probable difference of all events,
+    or the most probable position sum if the DUT is flipped (see _fill_difference_histograms). '''
+    windows = np.array(sorted(difference_hists[0].keys()), dtype=np.int64)
+    quality = np.zeros(shape=(windows.shape[0],), dtype=[('event_number', np.int64), ('n_entries_column', np.uint32), ('column_fraction', np.float), ('n_entries_row', np.uint32), ('row_fraction', np.float)])
+    if windows.shape[0] == 0:  # No cluster pairs at all
+        return quality
+    quality['event_number'] = first_event_number + windows * n_events_window  # First event of the window
+    for dimension, name in enumerate(('column', 'row')):
+        difference_hist = np.array([difference_hists[dimension][window] for window in windows])
+        difference_hist = difference_hist[:, np.argmax(difference_hist.sum(axis=0).max(axis=1))]  # Use the difference (slope 1) or the sum (slope -1) with the higher peak
+        peak = np.argmax(difference_hist.sum(axis=0))
+        n_entries = difference_hist.sum(axis=1)
+        n_entries_peak = difference_hist[:, max(0, peak - max_distance):peak + max_distance + 1].sum(axis=1)
+        quality['n_entries_%s' % name] = n_entries
+        quality['%s_fraction' % name] = np.divide(n_entries_peak, n_entries, out=np.full(n_entries.shape, np.nan), where=n_entries > 0)
+    return quality
+
+
+def _get_correlation_peaks(correlation, min_entries=10):
+    ''' Returns the reference pixel with the most entries for each DUT pixel of the correlation histogram.
+    DUT pixels with less than min_entries entries have no peak (-1). '''
+    peaks = np.argmax(correlation, axis=1)
+    peaks[correlation.sum(axis=1) < min_entries] = -1
+    return peaks
+
+
+def _correlation_peaks_converged(last_peaks, peaks, max_peak_shift):
+    ''' Returns True if the mean shift of the correlation peaks is below max_peak_shift for all correlation histograms.
+    New peaks count as shifted by the number of DUT bins, thus the peaks are only converged if no new DUT bins get a peak. '''
+    for actual_last_peaks, actual_peaks in zip(last_peaks, peaks):
+        selection = actual_peaks >= 0
+        if not np.any(selection):
+            return False
+        peak_shifts = np.abs(actual_peaks[selection] - actual_last_peaks[selection]).astype(np.float)
+        peak_shifts[actual_last_peaks[selection] < 0] = actual_peaks.shape[0]  # New peak
+        if np.mean(peak_shifts) >= max_peak_shift:
+            return False
+    return True
+
+
 def _create_alignment_array(n_duts):
     # Result Translation / rotation table
     description = [('DUT', np.int)]
@@ -1248,15 +1440,3 @@ def _optimize_alignment(input_tracks_file, alignment_last_iteration, new_alignme
 
     return alignment_result, total_residuals_after  # Return alignment result and total residual
 
-
-# Helper functions to be called from multiple processes
-def _correlate_cluster(cluster_dut_0, cluster_file, start_index, start_event_number, stop_event_number, column_correlation, row_correlation, chunk_size):
-    with tb.open_file(cluster_file, mode='r') as actual_in_file_h5:  # Open other DUT cluster file
-        for actual_dut_cluster, start_index in analysis_utils.data_aligned_at_events(actual_in_file_h5.root.Cluster, start=start_index, start_event_number=start_event_number, stop_event_number=stop_event_number, chunk_size=chunk_size):  # Loop over the cluster in the actual cluster file in chunks
-
-            analysis_utils.correlate_cluster_on_event_number(data_1=cluster_dut_0,
-                                                             data_2=actual_dut_cluster,
-                                                             column_corr_hist=column_correlation,
-                                                             row_corr_hist=row_correlation)
-
-    return start_index, column_correlation, row_correlation
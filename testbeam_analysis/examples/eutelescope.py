@@ -39,7 +39,6 @@ The Mimosa26 detects ionizing particle with a density of up to
 import os
 import inspect
 import logging
-from multiprocessing import Pool
 
 from testbeam_analysis import (hit_analysis, dut_alignment, track_analysis,
                                result_analysis)
@@ -75,34 +74,18 @@ def run_analysis():
     # The following shows a complete test beam analysis by calling the
     # seperate function in correct order
 
-    # Remove hot pixels, only needed for devices wih noisy pixel like Mimosa 26
-    # A pool of workers to remove the noisy pixels in all files in parallel
-    kwargs = [{
-        'input_hits_file': data_files[i],
-        'n_pixel': n_pixels[i],
-        'pixel_size': pixel_size[i],
-        'threshold': 0.5,
-        'dut_name': dut_names[i]} for i in range(0, len(data_files))]
-    pool = Pool()
-    for kwarg in kwargs:
-        pool.apply_async(hit_analysis.remove_noisy_pixels, kwds=kwarg)
-    pool.close()
-    pool.join()
-
-    # Cluster hits off all DUTs
-    # A pool of workers to cluster hits in all files in parallel
-    kwargs = [{
-        'input_hits_file': data_files[i][:-3] + '_noisy_pixels.h5',
-        'max_x_distance': 3,
-        'max_y_distance': 3,
-        'max_time_distance': 2,
-        'max_cluster_hits': 1000000,
-        'dut_name': dut_names[i]} for i in range(0, len(data_files))]
-    pool = Pool()
-    for kwarg in kwargs:
-        pool.apply_async(hit_analysis.cluster_hits, kwds=kwarg)
-    pool.close()
-    pool.join()
+    # Remove hot pixels, only needed for devices wih noisy pixel like Mimosa 26,
+    # and cluster hits off all DUTs. The DUTs are analyzed in parallel within a RAM budget of 4 GB
+    hit_analysis.analyze_hits(input_hits_files=data_files,
+                              n_pixels=n_pixels,
+                              pixel_size=pixel_size,
+                              dut_names=dut_names,
+                              noisy_pixel_kwargs={'threshold': 0.5},
+                              cluster_kwargs={'max_x_distance': 3,
+                                              'max_y_distance': 3,
+                                              'max_time_distance': 2,
+                                              'max_cluster_hits': 1000000},
+                              max_memory=4e9)
 
     # Correlate the row / column of each DUT
     input_cluster_files = [data_file[:-3] + '_noisy_pixels_cluster.h5'
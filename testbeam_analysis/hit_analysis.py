@@ -3,6 +3,9 @@ from __future__ import division
 
 import logging
 import os.path
+import time
+from collections import deque
+from multiprocessing import Pool, cpu_count, current_process
 
 import tables as tb
 import numpy as np
@@ -13,10 +16,17 @@ from testbeam_analysis.tools import analysis_utils
 from testbeam_analysis.tools.plot_utils import plot_noisy_pixels, plot_cluster_size
 
 
-def remove_noisy_pixels(input_hits_file, n_pixel, output_hits_file=None, pixel_size=None, threshold=10.0, filter_size=3, dut_name=None, plot=True, chunk_size=1000000):
+def remove_noisy_pixels(input_hits_file, n_pixel, output_hits_file=None, pixel_size=None, threshold=10.0, filter_size=3, dut_name=None, plot=True, pixel_mask=None, cache_occupancy=False, n_events_window=None, chunk_size=1000000, n_processes=None):
     '''Removes noisy pixel from the data file containing the hit table.
     The hit table is read in chunks and for each chunk the noisy pixel are determined and removed.
 
+    The occupancy can be cached in a file next to the input file (input file name + _occupancy.h5). The cache is only used
+    if size and modification time of the input file did not change, thus e.g. a rerun with another threshold only has to read
+    the hits once for filtering.
+
+    Pixels that are noisy only during a part of the run can be found by setting n_events_window. Then the occupancy is histogrammed
+    for each window of n_events_window events and the noisy pixels are determined and removed per window.
+
     To call this function on 8 cores in parallel with chunk_size=1000000 the following RAM is needed:
     11 byte * 8 * 1000000 = 88 Mb
 
@@ -32,67 +42,54 @@ def remove_noisy_pixels(input_hits_file, n_pixel, output_hits_file=None, pixel_s
         The threshold for pixel masking. The threshold is given in units of sigma of the pixel noise (background subtracted). The lower the value the more pixels are masked.
     filter_size : scalar or tuple
         Adjust the median filter size by giving the number of columns and rows. The higher the value the more the background is smoothed and more pixels are masked.
+    pixel_mask : array like
+        Boolean array with the shape of n_pixel. Hits of pixels set to True are removed in addition to the noisy pixels (e.g. pixels disabled in the DAQ).
+    cache_occupancy : bool
+        Store the occupancy next to the input file and reuse it in later calls if the input file did not change.
+    n_events_window : int
+        Number of events per time window. If None, the noisy pixels are determined for the whole run.
+        The occupancy of all windows is kept in RAM: 4 byte * number of pixels * number of windows. While histogramming in parallel
+        processes, each process holds in addition the windows of its hits, thus in total the RAM needed is about doubled.
+        Windows with few hits (e.g. the last window) do not have enough entries to determine the noise, there the noisy pixels of the whole run are removed.
     chunk_size : int
         Chunk size of the data when reading from file.
+    n_processes : int
+        Number of processes used to histogram the occupancy. If None, the number of CPUs is used.
     '''
     logging.info('=== Removing noisy pixel in %s ===', input_hits_file)
 
     if not output_hits_file:
         output_hits_file = os.path.splitext(input_hits_file)[0] + '_noisy_pixels.h5'
 
-    occupancy = None
-    # Calculating occupancy array
-    with tb.open_file(input_hits_file, 'r') as input_file_h5:
-        for hits, _ in analysis_utils.data_aligned_at_events(input_file_h5.root.Hits, chunk_size=chunk_size):
-            col, row = hits['column'], hits['row']
-            chunk_occ = analysis_utils.hist_2d_index(col - 1, row - 1, shape=n_pixel)
-            if occupancy is None:
-                occupancy = chunk_occ
-            else:
-                occupancy = occupancy + chunk_occ
+    # Calculating occupancy array with noisy pixels masked
+    occupancy = find_noisy_pixels(input_hits_file=input_hits_file, n_pixel=n_pixel, threshold=threshold, filter_size=filter_size, cache_occupancy=cache_occupancy, n_events_window=n_events_window, chunk_size=chunk_size, n_processes=n_processes)
 
-    # Run median filter across data, assuming 0 filling past the edges to get expected occupancy
-    blurred = median_filter(occupancy.astype(np.int32), size=filter_size, mode='constant', cval=0.0)
-    # Spot noisy pixels maxima by substracting expected occupancy
-    difference = np.ma.masked_array(occupancy - blurred)
-
-    std = np.ma.std(difference)
-    abs_occ_threshold = threshold * std
-    occupancy = np.ma.masked_where(difference > abs_occ_threshold, occupancy)
-    logging.info('Removed %d hot pixels at threshold %.1f in %s', np.ma.count_masked(occupancy), threshold, input_hits_file)
-
-    # Generate tuple col / row array of hot pixels, do not use getmask()
-    noisy_pixels_mask = np.ma.getmaskarray(occupancy)
-    # Generate pair of col / row arrays
-    noisy_pixels = np.nonzero(noisy_pixels_mask)
-    # Check for any noisy pixels
-    if noisy_pixels[0].shape[0] != 0:
-        # map 2d array (col, row) to 1d array to increase selection speed
-        noisy_pixels_1d = (noisy_pixels[0] + 1) * n_pixel[1] + (noisy_pixels[1] + 1)
-    else:
-        noisy_pixels_1d = []
+    occupancy, noisy_pixels_mask, noisy_pixels_window_mask, selection_mask = _get_noisy_pixels_masks(input_hits_file, occupancy, threshold=threshold, n_events_window=n_events_window, pixel_mask=pixel_mask)
 
     # Storing putput files
     with tb.open_file(input_hits_file, 'r') as input_file_h5:
         with tb.open_file(output_hits_file, 'w') as out_file_h5:
             # Creating new hit table without noisy pixels
             hit_table_out = out_file_h5.create_table(out_file_h5.root, name='Hits', description=input_file_h5.root.Hits.dtype, title='Selected not noisy hits for test beam analysis', filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+            if n_events_window is not None and input_file_h5.root.Hits.nrows != 0:
+                first_event_number = input_file_h5.root.Hits[0]['event_number']
             for hits, _ in analysis_utils.data_aligned_at_events(input_file_h5.root.Hits, chunk_size=chunk_size):
                 # Select not noisy pixel
-                hits_1d = hits['column'].astype(np.uint32) * n_pixel[1] + hits['row']  # change dtype to fit new number
-                hits = hits[np.in1d(hits_1d, noisy_pixels_1d, invert=True)]
+                if n_events_window is None:
+                    hits = hits[~analysis_utils.in_pixel_mask(hits['column'], hits['row'], selection_mask)]
+                else:
+                    hits = hits[~analysis_utils.in_pixel_window_mask(hits['column'], hits['row'], (hits['event_number'] - first_event_number) // n_events_window, selection_mask)]
 
                 hit_table_out.append(hits)
 
-            logging.info('Reducing data by a factor of %.2f in file %s', input_file_h5.root.Hits.nrows / hit_table_out.nrows, out_file_h5.filename)
+            # Removing hits does not change the event order
+            hit_table_out.attrs.sorted_by_event = analysis_utils.is_sorted_by_event(input_file_h5.root.Hits)
+            # Store the event boundaries for fast random access
+            analysis_utils.create_event_index(hit_table_out, chunk_size=chunk_size)
 
-            # Creating occupancy table without masking noisy pixels
-            occupancy_array_table = out_file_h5.create_carray(out_file_h5.root, name='HistOcc', title='Occupancy Histogram', atom=tb.Atom.from_dtype(occupancy.dtype), shape=occupancy.shape, filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
-            occupancy_array_table[:] = np.ma.getdata(occupancy)
+            logging.info('Reducing data by a factor of %.2f in file %s', input_file_h5.root.Hits.nrows / hit_table_out.nrows, out_file_h5.filename)
 
-            # Creating noisy pixels table
-            noisy_pixels_table = out_file_h5.create_carray(out_file_h5.root, name='NoisyPixelsMask', title='Noisy Pixels Mask', atom=tb.Atom.from_dtype(noisy_pixels_mask.dtype), shape=noisy_pixels_mask.shape, filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
-            noisy_pixels_table[:] = noisy_pixels_mask
+            _store_noisy_pixels(out_file_h5, occupancy, noisy_pixels_mask, noisy_pixels_window_mask, n_events_window)
 
     if plot:
         plot_noisy_pixels(input_hits_file=output_hits_file, pixel_size=pixel_size, dut_name=dut_name)
@@ -100,6 +97,63 @@ def remove_noisy_pixels(input_hits_file, n_pixel, output_hits_file=None, pixel_s
     return output_hits_file
 
 
+def find_noisy_pixels(input_hits_file, n_pixel, threshold=10.0, filter_size=3, cache_occupancy=False, n_events_window=None, chunk_size=1000000, n_processes=None):
+    '''Determines the noisy pixels from the occupancy of the hit table. No output file is created, thus the noisy pixel mask
+    can be given directly to cluster_hits.
+
+    Parameters
+    ----------
+    input_hits_file : string
+        Input PyTables raw data file.
+    n_pixel : tuple
+        Total number of pixels per column and row.
+    threshold : float
+        The threshold for pixel masking. The threshold is given in units of sigma of the pixel noise (background subtracted). The lower the value the more pixels are masked.
+    filter_size : scalar or tuple
+        Adjust the median filter size by giving the number of columns and rows. The higher the value the more the background is smoothed and more pixels are masked.
+    cache_occupancy : bool
+        Store the occupancy next to the input file and reuse it in later calls if the input file did not change.
+    n_events_window : int
+        Number of events per time window. The window of a hit is (event number - first event number) // n_events_window.
+        If None, the noisy pixels are determined for the whole run. Windows with less than half of the median number
+        of hits per window take the noisy pixels of the whole run, since the noise cannot be determined with few hits.
+    chunk_size : int
+        Chunk size of the data when reading from file.
+    n_processes : int
+        Number of processes used to histogram the occupancy. If None, the number of CPUs is used.
+
+    Returns
+    -------
+    numpy.ma.array
+        Occupancy histogram with the noisy pixels masked. np.ma.getmaskarray() gives the noisy pixel mask.
+        If n_events_window is set the time windows are stored in an additional last dimension.
+    '''
+    occupancy = None
+    if cache_occupancy:
+        occupancy = _read_occupancy_cache(input_hits_file, n_pixel, n_events_window=n_events_window)
+    if occupancy is None:
+        occupancy = _create_occupancy(input_hits_file, n_pixel, n_events_window=n_events_window, chunk_size=chunk_size, n_processes=n_processes)
+        if cache_occupancy:
+            _write_occupancy_cache(input_hits_file, occupancy, n_events_window=n_events_window)
+    else:
+        logging.info('Use cached occupancy of %s', input_hits_file)
+
+    if n_events_window is not None:  # Noisy pixels per time window
+        noisy_pixels_mask = np.zeros(shape=occupancy.shape, dtype=np.bool_)
+        n_hits_window = occupancy.sum(axis=(0, 1))
+        run_noisy_pixels_mask = None
+        for window_index in range(occupancy.shape[2]):
+            # The noise of a sparse window is underestimated (e.g. the last partial window), thus almost every hit pixel would be noisy
+            if n_hits_window[window_index] < 0.5 * np.median(n_hits_window):
+                if run_noisy_pixels_mask is None:
+                    run_noisy_pixels_mask = np.ma.getmaskarray(_mask_noisy_pixels(occupancy.sum(axis=2, dtype=np.uint32), threshold=threshold, filter_size=filter_size))
+                noisy_pixels_mask[:, :, window_index] = run_noisy_pixels_mask
+            else:
+                noisy_pixels_mask[:, :, window_index] = np.ma.getmaskarray(_mask_noisy_pixels(occupancy[:, :, window_index], threshold=threshold, filter_size=filter_size))
+        return np.ma.masked_array(occupancy, mask=noisy_pixels_mask)
+    return _mask_noisy_pixels(occupancy, threshold=threshold, filter_size=filter_size)
+
+
 def remove_noisy_pixels_wrapper(args):
     return remove_noisy_pixels(**args)
 
@@ -108,13 +162,33 @@ def cluster_hits_wrapper(args):
     return cluster_hits(**args)
 
 
-def cluster_hits(input_hits_file, output_cluster_file=None, max_x_distance=3, max_y_distance=3, max_time_distance=2, dut_name=None, plot=True, max_cluster_hits=1000, max_hit_charge=13, chunk_size=1000000):
+def cluster_hits(input_hits_file, output_cluster_file=None, max_x_distance=3, max_y_distance=3, max_time_distance=2, dut_name=None, plot=True, max_cluster_hits=1000, max_hit_charge=13, pixel_mask=None, n_events_window=None, output_hits_file=None, chunk_size=1000000, n_processes=None):
     '''Clusters the hits in the data file containing the hit table.
 
+    Hits of masked pixels can be removed while reading the hits (e.g. with the noisy pixel mask from find_noisy_pixels).
+    Then no intermediate file with the selected hits is needed.
+
+    The cluster size, the cluster charge and the number of cluster per event are histogrammed while clustering
+    and stored in the output file (HistClusterSize, HistClusterCharge, HistNClusterPerEvent).
+    Only events with cluster are counted in HistNClusterPerEvent. Events without hits are not stored in the hit table
+    and thus cannot be counted, therefore bin 0 is always 0.
+
     Parameters
     ----------
     data_file : pytables file
     output_file : pytables file
+    pixel_mask : array like
+        Boolean array with the shape (n_columns, n_rows). Hits of pixels set to True are omitted in the clustering.
+        If n_events_window is set, the shape is (n_columns, n_rows, n_windows) with a pixel mask for each time window.
+    n_events_window : int
+        Number of events per time window of the pixel mask. The window of a hit is (event number - first event number) // n_events_window,
+        like in find_noisy_pixels.
+    output_hits_file : pytables file
+        If set the hits selected with the pixel mask are stored in this file. Only used if pixel_mask is set, without pixel mask the hits are not changed.
+    chunk_size : int
+        Approximate number of hits clustered at once.
+    n_processes : int
+        Number of processes used for clustering. If None, the number of CPUs is used.
     '''
 
     logging.info('=== Cluster hits in %s ===', input_hits_file)
@@ -122,40 +196,465 @@ def cluster_hits(input_hits_file, output_cluster_file=None, max_x_distance=3, ma
     if not output_cluster_file:
         output_cluster_file = os.path.splitext(input_hits_file)[0] + '_cluster.h5'
 
+    if pixel_mask is not None:
+        pixel_mask = np.ascontiguousarray(pixel_mask, dtype=np.bool_)
+    elif output_hits_file:
+        logging.warning('No pixel mask given, the hits are not changed and %s is not created', output_hits_file)
+
     with tb.open_file(input_hits_file, 'r') as input_file_h5:
-        with tb.open_file(output_cluster_file, 'w') as output_file_h5:
-            # create clusterizer object
-            clusterizer = HitClusterizer()
-            clusterizer.set_max_hits(chunk_size)
-            clusterizer.set_max_cluster_hits(max_cluster_hits)
-            clusterizer.set_max_hit_charge(max_hit_charge)
-
-            # Set clusterzier settings
-            clusterizer.create_cluster_hit_info_array(False)  # do not create cluster infos for hits
-            clusterizer.set_x_cluster_distance(max_x_distance)  # cluster distance in columns
-            clusterizer.set_y_cluster_distance(max_y_distance)  # cluster distance in rows
-            clusterizer.set_frame_cluster_distance(max_time_distance)  # cluster distance in time frames
-
-            # Output data
-            cluster_table_description = np.dtype([('event_number', '<i8'),
-                                                  ('ID', '<u2'),
-                                                  ('n_hits', '<u2'),
-                                                  ('charge', 'f4'),
-                                                  ('seed_column', '<u2'),
-                                                  ('seed_row', '<u2'),
-                                                  ('mean_column', 'f4'),
-                                                  ('mean_row', 'f4')])
-            cluster_table_out = output_file_h5.create_table(output_file_h5.root, name='Cluster', description=cluster_table_description, title='Clustered hits', filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
-
-            for hits, _ in analysis_utils.data_aligned_at_events(input_file_h5.root.Hits, chunk_size=chunk_size, try_speedup=False):
-                if not np.all(np.diff(hits['event_number']) >= 0):
-                    raise RuntimeError('The event number does not always increase. The hits cannot be used like this!')
-                __, cluster = clusterizer.cluster_hits(hits)  # Cluster hits
-                if not np.all(np.diff(cluster['event_number']) >= 0):
+        hits_description = input_file_h5.root.Hits.dtype
+        hits_sorted = analysis_utils.is_sorted_by_event(input_file_h5.root.Hits)  # Event order already checked, do not check again
+        # Split the hits into ranges with complete events, these can be clustered independently
+        hit_ranges = analysis_utils.get_event_aligned_ranges(input_file_h5.root.Hits, chunk_size=chunk_size)
+        # The time windows of the pixel mask start at the first event of the hit table
+        first_event_number = None
+        if pixel_mask is not None and n_events_window is not None:
+            first_event_number = input_file_h5.root.Hits[0]['event_number'] if input_file_h5.root.Hits.nrows != 0 else 0
+        # The event order of each range is checked starting from the last event number of the previous range
+        last_event_numbers = [np.iinfo(np.int64).min if (hits_sorted or start == 0) else input_file_h5.root.Hits.read(start=start - 1, stop=start, field='event_number')[0] for start, _ in hit_ranges]
+
+    with tb.open_file(output_cluster_file, 'w') as output_file_h5:
+        # Output data
+        cluster_table_description = np.dtype([('event_number', '<i8'),
+                                              ('ID', '<u2'),
+                                              ('n_hits', '<u2'),
+                                              ('charge', 'f4'),
+                                              ('seed_column', '<u2'),
+                                              ('seed_row', '<u2'),
+                                              ('mean_column', 'f4'),
+                                              ('mean_row', 'f4')])
+        cluster_table_out = output_file_h5.create_table(output_file_h5.root, name='Cluster', description=cluster_table_description, title='Clustered hits', filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+
+        if pixel_mask is not None and output_hits_file:
+            output_hits_file_h5 = tb.open_file(output_hits_file, 'w')
+            hit_table_out = output_hits_file_h5.create_table(output_hits_file_h5.root, name='Hits', description=hits_description, title='Selected not noisy hits for test beam analysis', filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+        else:
+            output_hits_file_h5 = None
+
+        kwargs = [{'input_hits_file': input_hits_file,
+                   'start': start,
+                   'stop': stop,
+                   'max_x_distance': max_x_distance,
+                   'max_y_distance': max_y_distance,
+                   'max_time_distance': max_time_distance,
+                   'max_cluster_hits': max_cluster_hits,
+                   'max_hit_charge': max_hit_charge,
+                   'pixel_mask': pixel_mask,
+                   'n_events_window': n_events_window,
+                   'first_event_number': first_event_number,
+                   'return_hits': output_hits_file_h5 is not None,
+                   'check_order': not hits_sorted,
+                   'last_event_number': last_event_number} for (start, stop), last_event_number in zip(hit_ranges, last_event_numbers)]
+
+        n_processes = min(cpu_count() if n_processes is None else n_processes, len(kwargs))  # Not more processes than hit ranges
+        pool = None
+        try:
+            if n_processes <= 1 or current_process().daemon:  # Small data (one hit range), do not pay the process overhead; worker processes cannot start a pool
+                results = (_cluster_hits_of_range(**kwarg) for kwarg in kwargs)
+            else:  # Cluster the hit ranges in parallel, results are retrieved in order to keep the cluster sorted by event number
+                pool = Pool(n_processes)
+                results = _apply_ordered(pool, _cluster_hits_of_range, kwargs, max_pending=2 * n_processes)
+
+            # Cluster statistics are histogrammed while clustering, thus the cluster table does not have to be read again for plotting
+            cluster_size_hist = np.zeros(shape=(0, ), dtype=np.uint32)
+            cluster_charge_hist = np.zeros(shape=(0, ), dtype=np.uint32)
+            n_cluster_per_event_hist = np.zeros(shape=(0, ), dtype=np.uint32)
+
+            last_event_number = np.iinfo(np.int64).min
+            for hits, cluster in results:
+                if output_hits_file_h5 is not None:
+                    hit_table_out.append(hits)
+                # The event order is checked in one pass across all chunks
+                if not analysis_utils.check_event_order(cluster['event_number'], last_event_number):
                     raise RuntimeError('The event number does not always increase. The cluster cannot be used like this!')
+                if cluster.shape[0] != 0:
+                    last_event_number = cluster['event_number'][-1]
                 cluster_table_out.append(cluster)
 
+                cluster_size_hist = _fill_histogram(cluster_size_hist, cluster['n_hits'])
+                cluster_charge_hist = _fill_histogram(cluster_charge_hist, cluster['charge'].astype(np.int64))  # Charge bins have a width of 1
+                # Events are not splitted between the hit ranges; events without cluster are unknown here, bin 0 stays empty
+                _, n_cluster_per_event = np.unique(cluster['event_number'], return_counts=True)
+                n_cluster_per_event_hist = _fill_histogram(n_cluster_per_event_hist, n_cluster_per_event)
+
+            if pool is not None:
+                pool.close()
+
+            for name, title, hist in (('HistClusterSize', 'Cluster Size Histogram', cluster_size_hist),
+                                      ('HistClusterCharge', 'Cluster Charge Histogram', cluster_charge_hist),
+                                      ('HistNClusterPerEvent', 'Number of Cluster per Event Histogram', n_cluster_per_event_hist)):
+                hist_array = output_file_h5.create_carray(output_file_h5.root, name=name, title=title, atom=tb.Atom.from_dtype(hist.dtype), shape=hist.shape, filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+                hist_array[:] = hist
+
+            # Store the event boundaries for fast random access
+            cluster_table_out.attrs.sorted_by_event = True
+            analysis_utils.create_event_index(cluster_table_out, chunk_size=chunk_size)
+            if output_hits_file_h5 is not None:
+                analysis_utils.create_event_index(hit_table_out, chunk_size=chunk_size)
+        finally:
+            if pool is not None:  # Do not leave worker processes behind if a worker failed
+                pool.terminate()
+                pool.join()
+            if output_hits_file_h5 is not None:
+                output_hits_file_h5.close()
+
     if plot:
         plot_cluster_size(input_cluster_file=output_cluster_file, dut_name=dut_name)
 
     return output_cluster_file
+
+
+def analyze_hits(input_hits_files, n_pixels, pixel_size=None, dut_names=None, remove_noisy=True, noisy_pixel_kwargs=None, cluster_kwargs=None, max_memory=4e9, max_processes=None):
+    '''Removes the noisy pixels and clusters the hits of several DUTs in parallel processes.
+    The DUTs are processed in parallel with at most max_processes processes. If only one DUT is processed at a time, the
+    processes are used to histogram and cluster the hits of this DUT instead. The chunk size is derived from the memory
+    budget shared by all chunks that are analyzed at the same time, thus the memory consumption is limited independent
+    from the number of DUTs. If the noisy pixels are removed, the occupancy histograms and noisy pixel masks of the DUTs
+    analyzed at the same time are taken from the budget first. The noisy pixel mask is given directly to the clustering,
+    the selected hits are stored while clustering and are not read again. The largest files are processed first to reduce
+    the total run time.
+
+    Parameters
+    ----------
+    input_hits_files : iterable of strings
+        Input PyTables raw data files, one per DUT.
+    n_pixels : iterable of tuples
+        Total number of pixels per column and row for each DUT.
+    pixel_size : iterable of tuples
+        Pixel dimension for column and row for each DUT. If None, assuming square pixels.
+    dut_names : iterable of strings
+        Names of the DUTs used for plotting. If None, the DUT index is used.
+    remove_noisy : bool
+        If True the noisy pixels are removed before clustering.
+    noisy_pixel_kwargs : dict
+        Additional keyword arguments for remove_noisy_pixels (e.g. threshold), used for all DUTs.
+    cluster_kwargs : dict
+        Additional keyword arguments for cluster_hits (e.g. max_x_distance), used for all DUTs.
+        The arguments set by analyze_hits (e.g. chunk_size, n_processes) cannot be given in noisy_pixel_kwargs and
+        cluster_kwargs, a ValueError is raised.
+    max_memory : number
+        The RAM in bytes that all processes are allowed to use together. A ValueError is raised if the occupancy histograms
+        do not fit into the budget.
+    max_processes : int
+        Maximum number of parallel processes. If None, the number of CPUs is used.
+
+    Returns
+    -------
+    list of dicts
+        For each DUT the output files ('noisy_pixels_file', 'cluster_file'), the chunk size ('chunk_size') and the processing time in seconds ('time').
+    '''
+    logging.info('=== Analyzing hits of %d DUTs ===', len(input_hits_files))
+
+    # The input files and the chunking are set per DUT, the noisy pixel mask is set for the clustering
+    for name, dut_kwargs, set_keys in (('noisy_pixel_kwargs', noisy_pixel_kwargs, ('input_hits_file', 'n_pixel', 'pixel_size', 'dut_name', 'chunk_size', 'n_processes', 'cluster_kwargs')),
+                                       ('cluster_kwargs', cluster_kwargs, ('input_hits_file', 'dut_name', 'chunk_size', 'n_processes') + (('pixel_mask', 'n_events_window', 'output_hits_file') if remove_noisy else ()))):
+        duplicate_keys = sorted(set(dut_kwargs or {}) & set(set_keys))
+        if duplicate_keys:
+            raise ValueError('%s must not contain %s, these are set by analyze_hits' % (name, ', '.join(duplicate_keys)))
+
+    max_processes = cpu_count() if max_processes is None else max(max_processes, 1)
+    n_processes = min(max_processes, len(input_hits_files))
+    if n_processes > 1:  # DUTs in parallel, each DUT process analyzes one chunk at a time
+        n_dut_processes = 1
+        n_chunks_in_memory = n_processes
+    else:  # One DUT at a time, the DUT is analyzed in parallel; cluster_hits keeps up to 2 chunks per process in memory
+        n_dut_processes = max_processes
+        n_chunks_in_memory = 2 * n_dut_processes if n_dut_processes > 1 else 1
+    if remove_noisy:  # The occupancy histograms of the DUTs analyzed at the same time are kept during the whole analysis of the DUT
+        occupancy_memory = sorted((_get_occupancy_memory(input_hits_file, n_pixels[dut_index], (noisy_pixel_kwargs or {}).get('n_events_window'), n_dut_processes) for dut_index, input_hits_file in enumerate(input_hits_files)), reverse=True)
+        max_memory -= sum(occupancy_memory[:n_processes])
+        if max_memory <= 0:
+            raise ValueError('The memory budget is too small for the occupancy histograms of %d bytes' % sum(occupancy_memory[:n_processes]))
+    memory_per_chunk = max_memory / n_chunks_in_memory
+
+    kwargs = [{'input_hits_file': input_hits_file,
+               'n_pixel': n_pixels[dut_index],
+               'pixel_size': pixel_size[dut_index] if pixel_size is not None else None,
+               'dut_name': dut_names[dut_index] if dut_names is not None else 'DUT%d' % dut_index,
+               'remove_noisy': remove_noisy,
+               'noisy_pixel_kwargs': noisy_pixel_kwargs,
+               'cluster_kwargs': cluster_kwargs,
+               'chunk_size': _get_chunk_size(input_hits_file, memory_per_chunk),
+               'n_processes': n_dut_processes} for dut_index, input_hits_file in enumerate(input_hits_files)]
+
+    if n_processes <= 1:
+        return [_analyze_hits_of_dut(**kwarg) for kwarg in kwargs]
+    # Schedule the largest files first, thus small files fill the gaps at the end
+    dut_indices = sorted(range(len(kwargs)), key=lambda dut_index: os.path.getsize(input_hits_files[dut_index]), reverse=True)
+    pool = Pool(n_processes)
+    try:
+        results = {dut_index: pool.apply_async(_analyze_hits_of_dut, kwds=kwargs[dut_index]) for dut_index in dut_indices}
+        results = [results[dut_index].get() for dut_index in range(len(kwargs))]
+        pool.close()
+    finally:  # Do not leave worker processes behind if a worker failed
+        pool.terminate()
+        pool.join()
+    return results
+
+
+# Helper functions that are not meant to be called during analysis
+def _mask_noisy_pixels(occupancy, threshold, filter_size):
+    ''' Masks the pixels of the 2D occupancy that exceed the median filtered occupancy by threshold * sigma. '''
+    # Run median filter across data, assuming 0 filling past the edges to get expected occupancy
+    blurred = median_filter(occupancy.astype(np.int32), size=filter_size, mode='constant', cval=0.0)
+    # Spot noisy pixels maxima by substracting expected occupancy
+    difference = np.ma.masked_array(occupancy - blurred)
+
+    std = np.ma.std(difference)
+    abs_occ_threshold = threshold * std
+    return np.ma.masked_where(difference > abs_occ_threshold, occupancy)
+
+
+def _get_noisy_pixels_masks(input_hits_file, occupancy, threshold, n_events_window=None, pixel_mask=None):
+    ''' Returns the occupancy summed over the time windows with the noisy pixels masked, the noisy pixel mask, the noisy pixel mask per
+    time window (None without time windows) and the mask of all pixels to remove from the hits (with time windows if n_events_window is set). '''
+    # Generate tuple col / row array of hot pixels, do not use getmask()
+    noisy_pixels_mask = np.ma.getmaskarray(occupancy)
+    noisy_pixels_window_mask = None
+    if n_events_window is not None:  # Time windows in the last dimension
+        noisy_pixels_window_mask = noisy_pixels_mask
+        noisy_pixels_mask = np.any(noisy_pixels_window_mask, axis=2)  # Pixels that are noisy in at least one window
+        occupancy = np.ma.masked_array(np.ma.getdata(occupancy).sum(axis=2, dtype=np.uint32), mask=noisy_pixels_mask)
+        logging.info('Removed %d hot pixels at threshold %.1f in %d windows of %d events in %s', np.ma.count_masked(occupancy), threshold, noisy_pixels_window_mask.shape[2], n_events_window, input_hits_file)
+    else:
+        logging.info('Removed %d hot pixels at threshold %.1f in %s', np.ma.count_masked(occupancy), threshold, input_hits_file)
+
+    # Pixels removed from the hits, dense boolean mask to have a O(n) lookup per hit
+    selection_mask = noisy_pixels_mask if n_events_window is None else noisy_pixels_window_mask
+    if pixel_mask is not None:
+        pixel_mask = np.asarray(pixel_mask, dtype=np.bool_)
+        if pixel_mask.shape != noisy_pixels_mask.shape:
+            raise ValueError('The pixel mask shape %s does not match the number of pixels %s' % (str(pixel_mask.shape), str(noisy_pixels_mask.shape)))
+        logging.info('Removed %d additionally masked pixels in %s', np.count_nonzero(pixel_mask & ~noisy_pixels_mask), input_hits_file)
+        selection_mask = selection_mask | (pixel_mask if n_events_window is None else pixel_mask[:, :, np.newaxis])
+    return occupancy, noisy_pixels_mask, noisy_pixels_window_mask, np.ascontiguousarray(selection_mask)
+
+
+def _store_noisy_pixels(out_file_h5, occupancy, noisy_pixels_mask, noisy_pixels_window_mask, n_events_window=None):
+    ''' Stores the occupancy and the noisy pixel masks next to the selected hits. '''
+    # Creating occupancy table without masking noisy pixels
+    occupancy_array_table = out_file_h5.create_carray(out_file_h5.root, name='HistOcc', title='Occupancy Histogram', atom=tb.Atom.from_dtype(occupancy.dtype), shape=occupancy.shape, filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+    occupancy_array_table[:] = np.ma.getdata(occupancy)
+
+    # Creating noisy pixels table
+    noisy_pixels_table = out_file_h5.create_carray(out_file_h5.root, name='NoisyPixelsMask', title='Noisy Pixels Mask', atom=tb.Atom.from_dtype(noisy_pixels_mask.dtype), shape=noisy_pixels_mask.shape, filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+    noisy_pixels_table[:] = noisy_pixels_mask
+
+    if n_events_window is not None:  # Creating noisy pixels table for each time window
+        noisy_pixels_window_table = out_file_h5.create_carray(out_file_h5.root, name='NoisyPixelsWindowMask', title='Noisy Pixels Mask per Time Window', atom=tb.Atom.from_dtype(noisy_pixels_window_mask.dtype), shape=noisy_pixels_window_mask.shape, filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+        noisy_pixels_window_table[:] = noisy_pixels_window_mask
+        noisy_pixels_window_table.attrs.n_events_window = n_events_window
+
+
+def _create_occupancy(input_hits_file, n_pixel, n_events_window=None, chunk_size=1000000, n_processes=None):
+    ''' Histograms the pixel hits of the hit table in one pass.
+    The hit table is split into row ranges that are histogrammed in parallel, the partial histograms are summed afterwards.
+    Event alignment is not needed for the histogramming, thus the ranges can start at any row.
+    If n_events_window is set, the hits are histogrammed per time window into a 3D histogram.
+    At most n_processes processes are used, if None the number of CPUs. '''
+    with tb.open_file(input_hits_file, 'r') as input_file_h5:
+        n_hits = input_file_h5.root.Hits.nrows
+        first_event_number = None
+        if n_events_window is not None:  # The hits are sorted by event number, thus the first and last hit give the event range
+            first_event_number = input_file_h5.root.Hits[0]['event_number'] if n_hits != 0 else 0
+            last_event_number = input_file_h5.root.Hits[n_hits - 1]['event_number'] if n_hits != 0 else 0
+            n_pixel = tuple(n_pixel) + (int((last_event_number - first_event_number) // n_events_window) + 1, )
+
+    n_slices = min(cpu_count() if n_processes is None else n_processes, int(np.ceil(n_hits / chunk_size)))
+    if n_slices <= 1 or current_process().daemon:  # Small data, do not pay the process overhead; worker processes cannot start a pool
+        return _create_occupancy_of_range(input_hits_file, n_pixel, start=0, stop=n_hits, chunk_size=chunk_size, n_events_window=n_events_window, first_event_number=first_event_number)[0]
+
+    slice_edges = np.linspace(0, n_hits, n_slices + 1).astype(np.int64)
+    pool = Pool(n_slices)
+    try:
+        results = [pool.apply_async(_create_occupancy_of_range, kwds={'input_hits_file': input_hits_file,
+                                                                      'n_pixel': n_pixel,
+                                                                      'start': slice_edges[i],
+                                                                      'stop': slice_edges[i + 1],
+                                                                      'chunk_size': chunk_size,
+                                                                      'n_events_window': n_events_window,
+                                                                      'first_event_number': first_event_number}) for i in range(n_slices)]
+        occupancy = np.zeros(shape=n_pixel, dtype=np.uint32)
+        for result in results:
+            range_occupancy, first_window = result.get()
+            if n_events_window is None:
+                occupancy += range_occupancy
+            else:  # The hit ranges only have the time windows of their hits
+                occupancy[:, :, first_window:first_window + range_occupancy.shape[2]] += range_occupancy
+        pool.close()
+    finally:  # Do not leave worker processes behind if a worker failed
+        pool.terminate()
+        pool.join()
+    return occupancy
+
+
+def _create_occupancy_of_range(input_hits_file, n_pixel, start, stop, chunk_size, n_events_window=None, first_event_number=None):
+    ''' Histograms the hits in the row range [start, stop[. If n_events_window is set, only the time windows of the hits in the range
+    are histogrammed, thus parallel processes do not need the occupancy of all windows. Returns the occupancy and the index of its first time window. '''
+    with tb.open_file(input_hits_file, 'r') as input_file_h5:
+        range_first_window = 0
+        if n_events_window is None:
+            occupancy = np.zeros(shape=n_pixel, dtype=np.uint32)
+        else:  # The hits are sorted by event number, thus the first and last hit of the range give its time windows
+            range_last_window = 0
+            if stop > start:
+                range_first_window = (input_file_h5.root.Hits[start]['event_number'] - first_event_number) // n_events_window
+                range_last_window = (input_file_h5.root.Hits[stop - 1]['event_number'] - first_event_number) // n_events_window
+            occupancy = np.zeros(shape=(n_pixel[0], n_pixel[1], range_last_window - range_first_window + 1), dtype=np.uint32)
+        for start_index in range(start, stop, chunk_size):
+            hits = input_file_h5.root.Hits.read(start=start_index, stop=min(start_index + chunk_size, stop))
+            if n_events_window is None:
+                occupancy += analysis_utils.hist_2d_index(hits['column'] - 1, hits['row'] - 1, shape=n_pixel)
+            else:  # Only histogram the time windows of the hits, the hits are sorted by event number
+                window = (hits['event_number'] - first_event_number) // n_events_window
+                for slice_start in range(0, hits.shape[0], 65535):  # The 3D histogram has 16-bit bins, thus at most 65535 hits are histogrammed at once
+                    hits_slice, window_slice = hits[slice_start:slice_start + 65535], window[slice_start:slice_start + 65535]
+                    first_window, last_window = window_slice[0] - range_first_window, window_slice[-1] - range_first_window
+                    occupancy[:, :, first_window:last_window + 1] += analysis_utils.hist_3d_index(hits_slice['column'] - 1, hits_slice['row'] - 1, window_slice - window_slice[0], shape=(n_pixel[0], n_pixel[1], last_window - first_window + 1))
+    return occupancy, range_first_window
+
+
+def _get_occupancy_cache_file(input_hits_file):
+    return os.path.splitext(input_hits_file)[0] + '_occupancy.h5'
+
+
+def _read_occupancy_cache(input_hits_file, n_pixel, n_events_window=None):
+    ''' Returns the cached occupancy of the input file or None if there is no valid cache.
+    The cache is valid if the input file size and modification time and the time windows did not change. '''
+    try:
+        with tb.open_file(_get_occupancy_cache_file(input_hits_file), 'r') as cache_file_h5:
+            occupancy_node = cache_file_h5.root.HistOcc
+            input_file_stat = os.stat(input_hits_file)
+            if occupancy_node.attrs.input_file_size != input_file_stat.st_size or occupancy_node.attrs.input_file_mtime != input_file_stat.st_mtime or occupancy_node.shape[:2] != tuple(n_pixel) or getattr(occupancy_node.attrs, 'n_events_window', None) != n_events_window:
+                logging.info('Occupancy cache of %s is outdated', input_hits_file)
+                return None
+            return occupancy_node[:]
+    except (IOError, OSError, tb.exceptions.NoSuchNodeError, AttributeError):  # No cache file, no occupancy or no cache info
+        return None
+
+
+def _write_occupancy_cache(input_hits_file, occupancy, n_events_window=None):
+    input_file_stat = os.stat(input_hits_file)
+    with tb.open_file(_get_occupancy_cache_file(input_hits_file), 'w') as cache_file_h5:
+        occupancy_array_table = cache_file_h5.create_carray(cache_file_h5.root, name='HistOcc', title='Occupancy Histogram', atom=tb.Atom.from_dtype(occupancy.dtype), shape=occupancy.shape, filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+        occupancy_array_table[:] = occupancy
+        occupancy_array_table.attrs.input_file_size = input_file_stat.st_size
+        occupancy_array_table.attrs.input_file_mtime = input_file_stat.st_mtime
+        if n_events_window is not None:
+            occupancy_array_table.attrs.n_events_window = n_events_window
+
+
+def _cluster_hits_of_range(input_hits_file, start, stop, max_x_distance, max_y_distance, max_time_distance, max_cluster_hits, max_hit_charge, pixel_mask, return_hits, check_order, last_event_number=np.iinfo(np.int64).min, n_events_window=None, first_event_number=None):
+    ''' Clusters the hits in the row range [start, stop[. The range must not divide events.
+    The event order of the hits is only checked if check_order is True, the first event number must not be below
+    last_event_number, the last event number of the previous range. If n_events_window is set, the pixel mask has
+    a time window dimension starting at first_event_number. '''
+    with tb.open_file(input_hits_file, 'r') as input_file_h5:
+        hits = input_file_h5.root.Hits.read(start=start, stop=stop)
+
+    if check_order and not analysis_utils.check_event_order(hits['event_number'], last_event_number):
+        raise RuntimeError('The event number does not always increase. The hits cannot be used like this!')
+
+    if pixel_mask is not None and n_events_window is None:  # Select not masked pixel
+        hits = hits[~analysis_utils.in_pixel_mask(hits['column'], hits['row'], pixel_mask)]
+    elif pixel_mask is not None:  # Select pixel not masked in the time window of the hit
+        hits = hits[~analysis_utils.in_pixel_window_mask(hits['column'], hits['row'], (hits['event_number'] - first_event_number) // n_events_window, pixel_mask)]
+
+    # create clusterizer object
+    clusterizer = HitClusterizer()
+    clusterizer.set_max_hits(max(hits.shape[0], 1))
+    clusterizer.set_max_cluster_hits(max_cluster_hits)
+    clusterizer.set_max_hit_charge(max_hit_charge)
+
+    # Set clusterzier settings
+    clusterizer.create_cluster_hit_info_array(False)  # do not create cluster infos for hits
+    clusterizer.set_x_cluster_distance(max_x_distance)  # cluster distance in columns
+    clusterizer.set_y_cluster_distance(max_y_distance)  # cluster distance in rows
+    clusterizer.set_frame_cluster_distance(max_time_distance)  # cluster distance in time frames
+
+    __, cluster = clusterizer.cluster_hits(hits)  # Cluster hits
+
+    return (hits if return_hits else None), cluster
+
+
+def _apply_ordered(pool, function, kwargs, max_pending):
+    ''' Applies the function to the keyword arguments in the pool and yields the results in the order of the arguments.
+    At most max_pending results are calculated in advance to limit the memory consumption. '''
+    pending_results = deque()
+    for kwarg in kwargs:
+        if len(pending_results) >= max_pending:
+            yield pending_results.popleft().get()
+        pending_results.append(pool.apply_async(function, kwds=kwarg))
+    while pending_results:
+        yield pending_results.popleft().get()
+
+
+def _analyze_hits_of_dut(input_hits_file, n_pixel, pixel_size, dut_name, remove_noisy, noisy_pixel_kwargs, cluster_kwargs, chunk_size, n_processes):
+    ''' Removes the noisy pixels and clusters the hits of one DUT with n_processes processes. Returns the output files, the chunk size and the processing time. '''
+    start_time = time.time()
+    result = {'input_hits_file': input_hits_file, 'noisy_pixels_file': None, 'chunk_size': chunk_size}
+    if remove_noisy:
+        result['noisy_pixels_file'], result['cluster_file'] = _remove_noisy_pixels_and_cluster(input_hits_file=input_hits_file, n_pixel=n_pixel, pixel_size=pixel_size, dut_name=dut_name, chunk_size=chunk_size, n_processes=n_processes, cluster_kwargs=cluster_kwargs, **(noisy_pixel_kwargs or {}))
+    else:
+        result['cluster_file'] = cluster_hits(input_hits_file=input_hits_file, dut_name=dut_name, chunk_size=chunk_size, n_processes=n_processes, **(cluster_kwargs or {}))
+    result['time'] = time.time() - start_time
+    return result
+
+
+def _remove_noisy_pixels_and_cluster(input_hits_file, n_pixel, output_hits_file=None, pixel_size=None, threshold=10.0, filter_size=3, dut_name=None, plot=True, pixel_mask=None, cache_occupancy=False, n_events_window=None, chunk_size=1000000, n_processes=None, cluster_kwargs=None):
+    ''' Removes the noisy pixels like remove_noisy_pixels and clusters the selected hits like cluster_hits of the noisy pixel file.
+    The noisy pixel mask is given directly to cluster_hits, thus the selected hits are not read back from the noisy pixel file.
+    The output files are the same. Returns the noisy pixel file and the cluster file. '''
+    logging.info('=== Removing noisy pixel in %s ===', input_hits_file)
+
+    if not output_hits_file:
+        output_hits_file = os.path.splitext(input_hits_file)[0] + '_noisy_pixels.h5'
+    cluster_kwargs = dict(cluster_kwargs or {})
+    cluster_kwargs.setdefault('output_cluster_file', os.path.splitext(output_hits_file)[0] + '_cluster.h5')
+
+    occupancy = find_noisy_pixels(input_hits_file=input_hits_file, n_pixel=n_pixel, threshold=threshold, filter_size=filter_size, cache_occupancy=cache_occupancy, n_events_window=n_events_window, chunk_size=chunk_size, n_processes=n_processes)
+    occupancy, noisy_pixels_mask, noisy_pixels_window_mask, selection_mask = _get_noisy_pixels_masks(input_hits_file, occupancy, threshold=threshold, n_events_window=n_events_window, pixel_mask=pixel_mask)
+
+    # The selected hits are stored while clustering
+    output_cluster_file = cluster_hits(input_hits_file=input_hits_file, dut_name=dut_name, pixel_mask=selection_mask, n_events_window=n_events_window, output_hits_file=output_hits_file, chunk_size=chunk_size, n_processes=n_processes, **cluster_kwargs)
+    with tb.open_file(output_hits_file, 'r+') as out_file_h5:
+        _store_noisy_pixels(out_file_h5, occupancy, noisy_pixels_mask, noisy_pixels_window_mask, n_events_window)
+
+    if plot:
+        plot_noisy_pixels(input_hits_file=output_hits_file, pixel_size=pixel_size, dut_name=dut_name)
+
+    return output_hits_file, output_cluster_file
+
+
+def _get_occupancy_memory(input_hits_file, n_pixel, n_events_window, n_processes):
+    ''' Returns the RAM in bytes needed for the occupancy and the noisy pixel masks of one DUT.
+    The occupancy (4 byte per bin) is kept until the noisy pixels are stored. While histogramming in parallel, the processes hold
+    about the occupancy again. The noisy pixel mask and the mask of the removed pixels (1 byte per bin each) are kept while clustering,
+    in parallel the mask is sent with every pending hit range, these are up to 2 per process. '''
+    n_bins = n_pixel[0] * n_pixel[1]
+    if n_events_window is not None:  # The hits are sorted by event number, thus the first and last hit give the number of time windows
+        with tb.open_file(input_hits_file, 'r') as input_file_h5:
+            hit_table = input_file_h5.root.Hits
+            if hit_table.nrows != 0:
+                n_bins *= int((hit_table[hit_table.nrows - 1]['event_number'] - hit_table[0]['event_number']) // n_events_window) + 1
+    if n_processes > 1:
+        return n_bins * (4 + max(4, 2 + 2 * n_processes))
+    return n_bins * (4 + 2)
+
+
+def _get_chunk_size(input_hits_file, max_memory):
+    ''' Returns the number of hits that can be analyzed at once within the memory budget in bytes.
+    The clusterizer needs buffers for hits, cluster hit infos and cluster, this is estimated with 10 times the hit size. '''
+    with tb.open_file(input_hits_file, 'r') as input_file_h5:
+        hit_table = input_file_h5.root.Hits
+        chunk_size = int(max_memory / (10 * hit_table.dtype.itemsize))
+        return max(1, min(chunk_size, hit_table.nrows))
+
+
+def _fill_histogram(hist, values):
+    ''' Adds the non negative integer values to the 1D histogram with bin width 1. The histogram is enlarged if needed. '''
+    counts = np.bincount(values)
+    if counts.shape[0] > hist.shape[0]:
+        hist = np.concatenate((hist, np.zeros(shape=(counts.shape[0] - hist.shape[0], ), dtype=hist.dtype)))
+    hist[:counts.shape[0]] += counts.astype(hist.dtype)
+    return hist
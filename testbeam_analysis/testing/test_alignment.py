@@ -4,6 +4,7 @@ import os
 
 import unittest
 
+import tables as tb
 import numpy as np
 
 from testbeam_analysis import dut_alignment
@@ -41,10 +42,43 @@ class TestAlignmentAnalysis(unittest.TestCase):
     def tearDownClass(cls):  # remove created files
         os.remove(os.path.join(cls.output_folder, 'Correlation.h5'))
         os.remove(os.path.join(cls.output_folder, 'Correlation.pdf'))
+        os.remove(os.path.join(cls.output_folder, 'Correlation_pairs.h5'))
+        os.remove(os.path.join(cls.output_folder, 'Correlation_pairs.pdf'))
+        os.remove(os.path.join(cls.output_folder, 'Correlation_pairs_2.h5'))
+        os.remove(os.path.join(cls.output_folder, 'Correlation_pairs_2.pdf'))
+        os.remove(os.path.join(cls.output_folder, 'Correlation_binned.h5'))
+        os.remove(os.path.join(cls.output_folder, 'Correlation_binned.pdf'))
+        os.remove(os.path.join(cls.output_folder, 'Correlation_binned_2.h5'))
+        os.remove(os.path.join(cls.output_folder, 'Correlation_binned_2.pdf'))
+        os.remove(os.path.join(cls.output_folder, 'Correlation_binned_3.h5'))
+        os.remove(os.path.join(cls.output_folder, 'Correlation_binned_3.pdf'))
+        os.remove(os.path.join(cls.output_folder, 'Cluster_desync.h5'))
+        os.remove(os.path.join(cls.output_folder, 'Cluster_flipped.h5'))
+        os.remove(os.path.join(cls.output_folder, 'Correlation_quality.h5'))
+        os.remove(os.path.join(cls.output_folder, 'Correlation_quality.pdf'))
+        os.remove(os.path.join(cls.output_folder, 'Correlation_quality_shifted.h5'))
+        os.remove(os.path.join(cls.output_folder, 'Correlation_quality_shifted.pdf'))
+        for dut_index in range(3):
+            os.remove(os.path.join(cls.output_folder, 'Cluster_shifted_%d.h5' % dut_index))
+        os.remove(os.path.join(cls.output_folder, 'Correlation_converged.h5'))
+        os.remove(os.path.join(cls.output_folder, 'Correlation_converged.pdf'))
         os.remove(os.path.join(cls.output_folder, 'Merged.h5'))
         os.remove(os.path.join(cls.output_folder, 'Merged_2.h5'))
         os.remove(os.path.join(cls.output_folder, 'Tracklets.h5'))
         os.remove(os.path.join(cls.output_folder, 'Tracklets_2.h5'))
+        os.remove(os.path.join(cls.output_folder, 'Merged_compact.h5'))
+        os.remove(os.path.join(cls.output_folder, 'Tracklets_compact.h5'))
+        os.remove(os.path.join(cls.output_folder, 'Tracklets_view.h5'))
+        os.remove(os.path.join(cls.output_folder, 'Prealignment_serial.h5'))
+        os.remove(os.path.join(cls.output_folder, 'Prealignment_parallel.h5'))
+        os.remove(os.path.join(cls.output_folder, 'Correlation_without_dut_1.h5'))
+        os.remove(os.path.join(cls.output_folder, 'Prealignment_without_dut_1.h5'))
+        os.remove(os.path.join(cls.output_folder, 'Prealignment_pixel_binned.h5'))
+        os.remove(os.path.join(cls.output_folder, 'Prealignment_um_binned.h5'))
+        os.remove(os.path.join(cls.output_folder, 'Correlation_fit.h5'))
+        os.remove(os.path.join(cls.output_folder, 'Prealignment_fit_serial.h5'))
+        os.remove(os.path.join(cls.output_folder, 'Prealignment_fit_parallel.h5'))
+        os.remove(os.path.join(cls.output_folder, 'Prealignment.pdf'))
 #         os.remove(os.path.join(cls.output_folder, 'Alignment_difficult.h5'))
 #         os.remove(os.path.join(cls.output_folder, 'Prealignment.pdf'))
 
@@ -67,6 +101,146 @@ class TestAlignmentAnalysis(unittest.TestCase):
         data_equal, error_msg = test_tools.compare_h5_files(os.path.join(tests_data_folder, 'Correlation_result.h5'), os.path.join(self.output_folder, 'Correlation_2.h5'), exact=True)
         self.assertTrue(data_equal, msg=error_msg)
 
+    def test_cluster_correlation_pairs(self):  # Check the correlation of arbitrary DUT pairs in one pass
+        dut_alignment.correlate_cluster(input_cluster_files=self.data_files,
+                                        output_correlation_file=os.path.join(self.output_folder, 'Correlation_pairs.h5'),
+                                        n_pixels=self.n_pixels,
+                                        correlation_pairs=[(1, 0), (3, 0), (2, 1)],
+                                        chunk_size=293
+                                        )
+        # Correlation to DUT1 has to be the same than correlating DUT2 with DUT1 as reference
+        dut_alignment.correlate_cluster(input_cluster_files=self.data_files[1:3],
+                                        output_correlation_file=os.path.join(self.output_folder, 'Correlation_pairs_2.h5'),
+                                        n_pixels=self.n_pixels[1:3]
+                                        )
+        with tb.open_file(os.path.join(tests_data_folder, 'Correlation_result.h5'), 'r') as expected_file_h5:
+            with tb.open_file(os.path.join(self.output_folder, 'Correlation_pairs.h5'), 'r') as out_file_h5:
+                with tb.open_file(os.path.join(self.output_folder, 'Correlation_pairs_2.h5'), 'r') as out_file_2_h5:
+                    for node_name in ('CorrelationColumn_1_0', 'CorrelationRow_1_0', 'CorrelationColumn_3_0', 'CorrelationRow_3_0'):
+                        self.assertTrue(np.array_equal(expected_file_h5.get_node(expected_file_h5.root, node_name)[:], out_file_h5.get_node(out_file_h5.root, node_name)[:]))
+                    self.assertTrue(np.array_equal(out_file_2_h5.root.CorrelationColumn_1_0[:], out_file_h5.root.CorrelationColumn_2_1[:]))
+                    self.assertTrue(np.array_equal(out_file_2_h5.root.CorrelationRow_1_0[:], out_file_h5.root.CorrelationRow_2_1[:]))
+
+    def test_cluster_correlation_binning(self):  # Check the correlation binned in um
+        # Bins with the pixel size have to give the pixel binned correlation
+        dut_alignment.correlate_cluster(input_cluster_files=self.data_files,
+                                        output_correlation_file=os.path.join(self.output_folder, 'Correlation_binned.h5'),
+                                        n_pixels=self.n_pixels,
+                                        pixel_size=self.pixel_size,
+                                        bin_size=self.pixel_size
+                                        )
+        data_equal, error_msg = test_tools.compare_h5_files(os.path.join(tests_data_folder, 'Correlation_result.h5'), os.path.join(self.output_folder, 'Correlation_binned.h5'), exact=True)
+        self.assertTrue(data_equal, msg=error_msg)
+
+        # Larger bins reduce the histogram size, but keep all entries
+        bin_size = [(3 * column_size, 5 * row_size) for column_size, row_size in self.pixel_size]
+        dut_alignment.correlate_cluster(input_cluster_files=self.data_files,
+                                        output_correlation_file=os.path.join(self.output_folder, 'Correlation_binned_2.h5'),
+                                        n_pixels=self.n_pixels,
+                                        pixel_size=self.pixel_size,
+                                        bin_size=bin_size
+                                        )
+        with tb.open_file(os.path.join(tests_data_folder, 'Correlation_result.h5'), 'r') as expected_file_h5:
+            with tb.open_file(os.path.join(self.output_folder, 'Correlation_binned_2.h5'), 'r') as out_file_h5:
+                for node in out_file_h5.root:
+                    expected_data = expected_file_h5.get_node(expected_file_h5.root, node.name)[:]
+                    self.assertEqual(node.dtype, np.uint32)
+                    self.assertEqual(node.shape, tuple(int(np.ceil(n / 3. if 'Column' in node.name else n / 5.)) for n in expected_data.shape))
+                    self.assertEqual(node[:].sum(), expected_data.sum())
+
+    def test_cluster_correlation_quality(self):  # Check the correlation quality of event windows
+        # Desynchronize DUT1 by shifting the event numbers of the second half of the events
+        with tb.open_file(self.data_files[1], 'r') as in_file_h5:
+            cluster = in_file_h5.root.Cluster[:]
+            cluster['event_number'][cluster['event_number'] >= 4000] += 1
+            with tb.open_file(os.path.join(self.output_folder, 'Cluster_desync.h5'), 'w') as out_file_h5:
+                out_file_h5.create_table(out_file_h5.root, name='Cluster', obj=cluster)
+        # Flip DUT2 in column and row, the correlation has a slope of -1
+        with tb.open_file(self.data_files[2], 'r') as in_file_h5:
+            cluster = in_file_h5.root.Cluster[:]
+            cluster['mean_column'] = self.n_pixels[2][0] + 1 - cluster['mean_column']
+            cluster['mean_row'] = self.n_pixels[2][1] + 1 - cluster['mean_row']
+            with tb.open_file(os.path.join(self.output_folder, 'Cluster_flipped.h5'), 'w') as out_file_h5:
+                out_file_h5.create_table(out_file_h5.root, name='Cluster', obj=cluster)
+        dut_alignment.correlate_cluster(input_cluster_files=[self.data_files[0], os.path.join(self.output_folder, 'Cluster_desync.h5'), os.path.join(self.output_folder, 'Cluster_flipped.h5')],
+                                        output_correlation_file=os.path.join(self.output_folder, 'Correlation_quality.h5'),
+                                        n_pixels=self.n_pixels[:3],
+                                        pixel_size=self.pixel_size[:3],
+                                        n_events_window=1000,
+                                        chunk_size=293
+                                        )
+        with tb.open_file(os.path.join(self.output_folder, 'Correlation_quality.h5'), 'r') as out_file_h5:
+            for dut_index in (1, 2):
+                quality = out_file_h5.get_node(out_file_h5.root, 'CorrelationQuality_%d_0' % dut_index)[:]
+                self.assertTrue(np.array_equal(quality['event_number'], np.arange(2, 7002, 1000)))  # The windows start at the first event of the run
+                # All cluster pairs are in the event windows
+                self.assertEqual(quality['n_entries_column'].sum(), out_file_h5.get_node(out_file_h5.root, 'CorrelationColumn_%d_0' % dut_index)[:].sum())
+                self.assertEqual(quality['n_entries_row'].sum(), out_file_h5.get_node(out_file_h5.root, 'CorrelationRow_%d_0' % dut_index)[:].sum())
+                self.assertTrue(np.all(quality['column_fraction'][:4] > 0.3) and np.all(quality['row_fraction'][:4] > 0.3))
+                if dut_index == 1:  # Desynchronized
+                    self.assertTrue(np.all(quality['column_fraction'][4:] < 0.2) and np.all(quality['row_fraction'][4:] < 0.2))
+                else:  # Flipped
+                    self.assertTrue(np.all(quality['column_fraction'][4:] > 0.3) and np.all(quality['row_fraction'][4:] > 0.3))
+        # The event windows do not depend on the event number offset of the run
+        cluster_files = []
+        for dut_index, cluster_file in enumerate([self.data_files[0], os.path.join(self.output_folder, 'Cluster_desync.h5'), os.path.join(self.output_folder, 'Cluster_flipped.h5')]):
+            with tb.open_file(cluster_file, 'r') as in_file_h5:
+                cluster = in_file_h5.root.Cluster[:]
+                cluster['event_number'] += 1500
+                cluster_files.append(os.path.join(self.output_folder, 'Cluster_shifted_%d.h5' % dut_index))
+                with tb.open_file(cluster_files[-1], 'w') as out_file_h5:
+                    out_file_h5.create_table(out_file_h5.root, name='Cluster', obj=cluster)
+        dut_alignment.correlate_cluster(input_cluster_files=cluster_files,
+                                        output_correlation_file=os.path.join(self.output_folder, 'Correlation_quality_shifted.h5'),
+                                        n_pixels=self.n_pixels[:3],
+                                        pixel_size=self.pixel_size[:3],
+                                        n_events_window=1000,
+                                        chunk_size=293
+                                        )
+        with tb.open_file(os.path.join(self.output_folder, 'Correlation_quality.h5'), 'r') as expected_file_h5:
+            with tb.open_file(os.path.join(self.output_folder, 'Correlation_quality_shifted.h5'), 'r') as out_file_h5:
+                for dut_index in (1, 2):
+                    quality = out_file_h5.get_node(out_file_h5.root, 'CorrelationQuality_%d_0' % dut_index)[:]
+                    expected_quality = expected_file_h5.get_node(expected_file_h5.root, 'CorrelationQuality_%d_0' % dut_index)[:]
+                    self.assertTrue(np.array_equal(quality['event_number'], expected_quality['event_number'] + 1500))
+                    for name in ('n_entries_column', 'column_fraction', 'n_entries_row', 'row_fraction'):
+                        self.assertTrue(np.array_equal(quality[name], expected_quality[name]))
+        # Without cluster pairs there are no event windows
+        self.assertEqual(dut_alignment._get_correlation_quality(({}, {}), n_events_window=1000).shape[0], 0)
+
+    def test_cluster_correlation_convergence(self):  # Check that the correlation stops when the correlation peaks do not move
+        event_numbers = []
+        for data_file in self.data_files:
+            with tb.open_file(data_file, 'r') as in_file_h5:
+                event_numbers.append(in_file_h5.root.Cluster[:]['event_number'])
+        n_events = np.unique(np.concatenate(event_numbers)).shape[0]
+        # Peaks move less than 1 bin: the correlation stops before the end of the run
+        dut_alignment.correlate_cluster(input_cluster_files=self.data_files,
+                                        output_correlation_file=os.path.join(self.output_folder, 'Correlation_converged.h5'),
+                                        n_pixels=self.n_pixels,
+                                        max_peak_shift=1.,
+                                        chunk_size=293
+                                        )
+        with tb.open_file(os.path.join(self.output_folder, 'Correlation_converged.h5'), 'r') as out_file_h5:
+            with tb.open_file(os.path.join(tests_data_folder, 'Correlation_result.h5'), 'r') as expected_file_h5:
+                for node in out_file_h5.root:
+                    self.assertTrue(node.attrs.converged)
+                    self.assertTrue(0 < node.attrs.n_events < n_events)
+                    self.assertTrue(0 < node[:].sum() < expected_file_h5.get_node(expected_file_h5.root, node.name)[:].sum())
+        # Peak shift has to be below 0 bins, this never happens: all events are correlated
+        dut_alignment.correlate_cluster(input_cluster_files=self.data_files,
+                                        output_correlation_file=os.path.join(self.output_folder, 'Correlation_converged.h5'),
+                                        n_pixels=self.n_pixels,
+                                        max_peak_shift=0.,
+                                        chunk_size=293
+                                        )
+        with tb.open_file(os.path.join(self.output_folder, 'Correlation_converged.h5'), 'r') as out_file_h5:
+            with tb.open_file(os.path.join(tests_data_folder, 'Correlation_result.h5'), 'r') as expected_file_h5:
+                for node in out_file_h5.root:
+                    self.assertFalse(node.attrs.converged)
+                    self.assertEqual(node.attrs.n_events, n_events)
+                    self.assertTrue(np.array_equal(node[:], expected_file_h5.get_node(expected_file_h5.root, node.name)[:]))
+
     # FIXME: fails under Linux, needs check why
     @unittest.SkipTest
     def test_prealignment(self):  # Check the hit alignment function
@@ -100,6 +274,97 @@ class TestAlignmentAnalysis(unittest.TestCase):
                                                             atol=5)  # 5 um absolute tolerance allowed
         self.assertTrue(data_equal, msg=error_msg)
 
+    def test_prealignment_parallel(self):  # Check that the correlations pre-aligned in parallel processes give the same result than the serial pre-alignment
+        for n_processes, output_alignment_file in ((1, 'Prealignment_serial.h5'), (3, 'Prealignment_parallel.h5')):
+            dut_alignment.prealignment(input_correlation_file=os.path.join(tests_data_folder, 'Correlation_result.h5'),
+                                       output_alignment_file=os.path.join(self.output_folder, output_alignment_file),
+                                       z_positions=self.z_positions,
+                                       pixel_size=self.pixel_size,
+                                       non_interactive=True,
+                                       no_fit=True,  # Hough transformation, fast and deterministic
+                                       n_processes=n_processes)
+        data_equal, error_msg = test_tools.compare_h5_files(os.path.join(self.output_folder, 'Prealignment_serial.h5'), os.path.join(self.output_folder, 'Prealignment_parallel.h5'))
+        self.assertTrue(data_equal, msg=error_msg)
+        # The number of DUTs is deduced from the DUT indices of the correlations, not from the number of correlations
+        with tb.open_file(os.path.join(tests_data_folder, 'Correlation_result.h5'), 'r') as in_file_h5:
+            with tb.open_file(os.path.join(self.output_folder, 'Correlation_without_dut_1.h5'), 'w') as out_file_h5:
+                for node_name in ('CorrelationColumn_3_0', 'CorrelationRow_3_0'):
+                    in_file_h5.copy_node(in_file_h5.root, name=node_name, newparent=out_file_h5.root)
+        dut_alignment.prealignment(input_correlation_file=os.path.join(self.output_folder, 'Correlation_without_dut_1.h5'),
+                                   output_alignment_file=os.path.join(self.output_folder, 'Prealignment_without_dut_1.h5'),
+                                   z_positions=self.z_positions,
+                                   pixel_size=self.pixel_size,
+                                   non_interactive=True,
+                                   no_fit=True)
+        with tb.open_file(os.path.join(self.output_folder, 'Prealignment_without_dut_1.h5'), 'r') as in_file_h5:
+            with tb.open_file(os.path.join(self.output_folder, 'Prealignment_serial.h5'), 'r') as expected_file_h5:
+                prealignment, expected_prealignment = in_file_h5.root.PreAlignment[:], expected_file_h5.root.PreAlignment[:]
+        self.assertTrue(np.array_equal(prealignment['DUT'], np.arange(4)))
+        self.assertTrue(np.array_equal(prealignment['z'], self.z_positions))
+        self.assertTrue(np.array_equal(prealignment[3], expected_prealignment[3]))
+
+    def test_prealignment_fit_parallel(self):  # Check that the correlations fitted in parallel processes give the same pre-alignment than the serial fit
+        with tb.open_file(os.path.join(tests_data_folder, 'Correlation_result.h5'), 'r') as in_file_h5:
+            with tb.open_file(os.path.join(self.output_folder, 'Correlation_fit.h5'), 'w') as out_file_h5:
+                for node_name in ('CorrelationColumn_2_0', 'CorrelationRow_2_0', 'CorrelationColumn_3_0', 'CorrelationRow_3_0'):
+                    in_file_h5.copy_node(in_file_h5.root, name=node_name, newparent=out_file_h5.root)
+        for n_processes, output_alignment_file in ((1, 'Prealignment_fit_serial.h5'), (2, 'Prealignment_fit_parallel.h5')):
+            dut_alignment.prealignment(input_correlation_file=os.path.join(self.output_folder, 'Correlation_fit.h5'),
+                                       output_alignment_file=os.path.join(self.output_folder, output_alignment_file),
+                                       z_positions=self.z_positions,
+                                       pixel_size=self.pixel_size,
+                                       non_interactive=True,
+                                       no_fit=False,
+                                       n_processes=n_processes)
+        data_equal, error_msg = test_tools.compare_h5_files(os.path.join(self.output_folder, 'Prealignment_fit_serial.h5'), os.path.join(self.output_folder, 'Prealignment_fit_parallel.h5'), exact=True)
+        self.assertTrue(data_equal, msg=error_msg)
+
+    def test_prealignment_binning(self):  # Check that the pre-alignment of correlations binned in um agrees with the pixel binned result
+        bin_size = [(2 * column_size, 2 * row_size) for column_size, row_size in self.pixel_size]
+        dut_alignment.correlate_cluster(input_cluster_files=self.data_files,
+                                        output_correlation_file=os.path.join(self.output_folder, 'Correlation_binned_3.h5'),
+                                        n_pixels=self.n_pixels,
+                                        pixel_size=self.pixel_size,
+                                        bin_size=bin_size
+                                        )
+        for input_correlation_file, output_alignment_file in ((os.path.join(tests_data_folder, 'Correlation_result.h5'), 'Prealignment_pixel_binned.h5'), (os.path.join(self.output_folder, 'Correlation_binned_3.h5'), 'Prealignment_um_binned.h5')):
+            dut_alignment.prealignment(input_correlation_file=input_correlation_file,
+                                       output_alignment_file=os.path.join(self.output_folder, output_alignment_file),
+                                       z_positions=self.z_positions,
+                                       pixel_size=self.pixel_size,
+                                       non_interactive=True,
+                                       no_fit=True)
+        with tb.open_file(os.path.join(self.output_folder, 'Prealignment_um_binned.h5'), 'r') as in_file_h5:
+            with tb.open_file(os.path.join(self.output_folder, 'Prealignment_pixel_binned.h5'), 'r') as expected_file_h5:
+                prealignment, expected_prealignment = in_file_h5.root.PreAlignment[:], expected_file_h5.root.PreAlignment[:]
+        # The offsets have to agree within one bin, the slopes within the bin size resolution
+        for dimension, bin_index in (('column', 0), ('row', 1)):
+            self.assertTrue(np.all(np.abs(prealignment[dimension + '_c0'] - expected_prealignment[dimension + '_c0']) < np.array(bin_size)[:, bin_index]))
+            self.assertTrue(np.allclose(prealignment[dimension + '_c1'], expected_prealignment[dimension + '_c1'], atol=0.05))
+
+    def test_correlation_fit_batch(self):  # Check the batched correlation fit against the row by row fit
+        with tb.open_file(os.path.join(tests_data_folder, 'Correlation_result.h5'), 'r') as in_file_h5:
+            for node in in_file_h5.root:
+                for data in (node[:], node[:][:, ::-1]):  # Also check the mirrored correlation (slope of -1)
+                    x = np.arange(data.shape[1]) + 0.5
+                    mean_fitted, mean_error_fitted = [], []
+                    for batch_fit in (True, False):
+                        coeff_fitted, mean_fitted_fit, mean_error_fitted_fit, sigma_fitted, chi2 = np.full((data.shape[0], 7), np.nan), np.full(data.shape[0], np.nan), np.full(data.shape[0], np.nan), np.full(data.shape[0], np.nan), np.full(data.shape[0], np.nan)
+                        dut_alignment._fit_data(x=x, data=data, s_n=0.1, coeff_fitted=coeff_fitted, mean_fitted=mean_fitted_fit, mean_error_fitted=mean_error_fitted_fit, sigma_fitted=sigma_fitted, chi2=chi2, fit_background=False, reduce_background=False, batch_fit=batch_fit)
+                        mean_fitted.append(mean_fitted_fit)
+                        mean_error_fitted.append(mean_error_fitted_fit)
+                    # The row by row fit depends on the previous fit, thus very few rows at the edges can be fitted in one case only
+                    fitted = np.isfinite(mean_fitted[0]) & np.isfinite(mean_fitted[1])
+                    self.assertLessEqual(np.count_nonzero(np.isfinite(mean_fitted[0]) != np.isfinite(mean_fitted[1])), 0.01 * data.shape[0], msg=node.name)
+                    # All rows fitted in both cases agree within the fit errors
+                    difference = np.abs(mean_fitted[0][fitted] - mean_fitted[1][fitted])
+                    error = np.sqrt(np.square(mean_error_fitted[0][fitted]) + np.square(mean_error_fitted[1][fitted]))
+                    self.assertTrue(np.all(difference <= 2. * error), msg=node.name)
+        # A histogram without entries has no rows to fit
+        mean_fitted = np.full(10, np.nan)
+        dut_alignment._fit_data(x=np.arange(10) + 0.5, data=np.zeros((10, 10), dtype=np.int), s_n=0.1, coeff_fitted=np.full((10, 7), np.nan), mean_fitted=mean_fitted, mean_error_fitted=np.full(10, np.nan), sigma_fitted=np.full(10, np.nan), chi2=np.full(10, np.nan), fit_background=False, reduce_background=False)
+        self.assertTrue(np.all(np.isnan(mean_fitted)))
+
     def test_cluster_merging(self):
         cluster_files = [os.path.join(tests_data_folder, 'Cluster_DUT%d_cluster.h5') % i for i in range(4)]
         dut_alignment.merge_cluster_data(cluster_files,
@@ -119,6 +384,57 @@ class TestAlignmentAnalysis(unittest.TestCase):
         data_equal, error_msg = test_tools.compare_h5_files(os.path.join(tests_data_folder, 'Merged_result.h5'), os.path.join(self.output_folder, 'Merged_2.h5'))
         self.assertTrue(data_equal, msg=error_msg)
 
+    def test_cluster_merging_compact(self):  # Check the compact tracklet format against the full format
+        cluster_files = [os.path.join(tests_data_folder, 'Cluster_DUT%d_cluster.h5') % i for i in range(4)]
+        dut_alignment.merge_cluster_data(cluster_files,
+                                         output_merged_file=os.path.join(self.output_folder, 'Merged_compact.h5'),
+                                         n_pixels=self.n_pixels,
+                                         pixel_size=self.pixel_size,
+                                         compact=True,
+                                         chunk_size=293)
+        dut_alignment.apply_alignment(input_hit_file=os.path.join(self.output_folder, 'Merged_compact.h5'),
+                                      input_alignment=os.path.join(self.output_folder, 'Prealignment_result.h5'),
+                                      output_hit_aligned_file=os.path.join(self.output_folder, 'Tracklets_compact.h5'),
+                                      force_prealignment=True)
+        for compact_file, result_file, node_name in (('Merged_compact.h5', 'Merged_result.h5', 'MergedCluster'), ('Tracklets_compact.h5', 'Tracklets_result.h5', 'Tracklets')):
+            with tb.open_file(os.path.join(self.output_folder, compact_file), 'r') as in_file_h5:
+                node = in_file_h5.get_node(in_file_h5.root, node_name)
+                self.assertTrue(analysis_utils.is_compact_tracklets(node))
+                self.assertFalse(any(name.startswith('z_dut_') for name in node.dtype.names))
+                data = analysis_utils.expand_tracklets(node[:], node.attrs.z_positions)
+            with tb.open_file(os.path.join(tests_data_folder, result_file), 'r') as in_file_h5:
+                expected_data = in_file_h5.get_node(in_file_h5.root, node_name)[:]
+            self.assertEqual(data.dtype, expected_data.dtype)
+            for name in expected_data.dtype.names:
+                self.assertTrue(np.allclose(data[name], expected_data[name], rtol=1e-6, atol=1e-3, equal_nan=True), msg=name)
+
+    def test_apply_alignment_merged_cluster_view(self):  # Check the alignment of the merged cluster created on the fly
+        cluster_files = [os.path.join(tests_data_folder, 'Cluster_DUT%d_cluster.h5') % i for i in range(4)]
+        dut_alignment.apply_alignment(input_hit_file=analysis_utils.MergedClusterView(cluster_files, n_pixels=self.n_pixels, pixel_size=self.pixel_size, chunk_size=293),
+                                      input_alignment=os.path.join(self.output_folder, 'Prealignment_result.h5'),
+                                      output_hit_aligned_file=os.path.join(self.output_folder, 'Tracklets_view.h5'),
+                                      force_prealignment=True)
+        data_equal, error_msg = test_tools.compare_h5_files(os.path.join(tests_data_folder, 'Tracklets_result.h5'), os.path.join(self.output_folder, 'Tracklets_view.h5'))
+        self.assertTrue(data_equal, msg=error_msg)
+        # Event ranges of the view give the same merged cluster as the merged cluster file
+        merged_cluster = analysis_utils.MergedClusterView(cluster_files, n_pixels=self.n_pixels, pixel_size=self.pixel_size, chunk_size=293)
+        with tb.open_file(os.path.join(tests_data_folder, 'Merged_result.h5'), 'r') as in_file_h5:
+            expected_data = in_file_h5.root.MergedCluster[:]
+        for start_event_number, stop_event_number in ((None, 1500), (1500, None), (1234, 4321), (100000, None)):
+            data = [actual_data for actual_data, _ in analysis_utils.data_aligned_at_events(merged_cluster, start_event_number=start_event_number, stop_event_number=stop_event_number)]
+            data = np.concatenate(data) if data else expected_data[:0]
+            selection = np.ones(expected_data.shape[0], dtype=np.bool_)
+            if start_event_number is not None:
+                selection &= expected_data['event_number'] >= start_event_number
+            if stop_event_number is not None:
+                selection &= expected_data['event_number'] < stop_event_number
+            self.assertEqual(data.shape[0], np.count_nonzero(selection))
+            for name in expected_data.dtype.names:
+                self.assertTrue(np.allclose(data[name], expected_data[name][selection], rtol=1e-6, atol=1e-3, equal_nan=True), msg=name)
+        # The view has no row indices
+        with self.assertRaises(ValueError):
+            next(analysis_utils.data_aligned_at_events(merged_cluster, start=10))
+
     def test_apply_alignment(self):
         dut_alignment.apply_alignment(input_hit_file=os.path.join(tests_data_folder, 'Merged_result.h5'),
                                       input_alignment=os.path.join(self.output_folder, 'Prealignment_result.h5'),
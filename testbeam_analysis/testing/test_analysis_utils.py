@@ -3,9 +3,11 @@
 import os
 
 import unittest
+from multiprocessing.pool import ThreadPool
 
 import tables as tb
 import numpy as np
+from scipy.optimize import curve_fit
 
 from testbeam_analysis.cpp import data_struct
 from testbeam_analysis.tools import analysis_utils, test_tools
@@ -82,12 +84,169 @@ class TestAnalysisUtils(unittest.TestCase):
         self.assertTrue(np.all(test_tools.nan_to_num(analysis_utils.map_cluster(common_event_number, clusters)) ==
                                test_tools.nan_to_num(result[:common_event_number.shape[0]])))
 
+    def test_map_cluster_threaded(self):  # check the cluster mapping of several DUTs in parallel threads against the serial mapping
+        cluster = []
+        for dut_index in range(4):
+            with tb.open_file(os.path.join(os.path.dirname(tests_data_folder), 'dut_alignment', 'Cluster_DUT%d_cluster.h5' % dut_index), 'r') as in_file_h5:
+                cluster.append(in_file_h5.root.Cluster[:])
+        common_event_numbers = cluster[0]['event_number']
+        for actual_cluster in cluster[1:]:
+            common_event_numbers = analysis_utils.get_max_events_in_both_arrays(common_event_numbers, actual_cluster['event_number'])
+        mapped_cluster = [analysis_utils.map_cluster(common_event_numbers, actual_cluster) for actual_cluster in cluster]
+        pool = ThreadPool(len(cluster))
+        try:
+            for _ in range(10):  # Repeat to have the threads overlap
+                mapped_cluster_threaded = pool.map(lambda actual_cluster: analysis_utils.map_cluster(common_event_numbers, actual_cluster), cluster)
+                for dut_index in range(len(cluster)):
+                    self.assertTrue(np.array_equal(test_tools.nan_to_num(mapped_cluster_threaded[dut_index]), test_tools.nan_to_num(mapped_cluster[dut_index])))
+        finally:
+            pool.close()
+            pool.join()
+
     def test_analysis_utils_in1d_events(self):  # check compiled get_in1d_sorted function
         event_numbers = np.array([[0, 0, 2, 2, 2, 4, 5, 5, 6, 7, 7, 7, 8], [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]], dtype=np.int64)
         event_numbers_2 = np.array([1, 1, 1, 2, 2, 2, 4, 4, 4, 7], dtype=np.int64)
         result = event_numbers[0][analysis_utils.in1d_events(event_numbers[0], event_numbers_2)]
         self.assertListEqual([2, 2, 2, 4, 7, 7, 7], result.tolist())
 
+    def test_correlate_cluster_on_event_number_parallel(self):  # check the parallel correlation against the serial one
+        cluster = []
+        for dut_index in range(2):
+            with tb.open_file(os.path.join(os.path.dirname(tests_data_folder), 'dut_alignment', 'Cluster_DUT%d_cluster.h5' % dut_index), 'r') as in_file_h5:
+                cluster.append(in_file_h5.root.Cluster[:])
+        column_corr_hist, row_corr_hist = np.zeros((80, 80), dtype=np.int), np.zeros((336, 336), dtype=np.int)
+        analysis_utils.correlate_cluster_on_event_number(cluster[0], cluster[1], column_corr_hist, row_corr_hist)
+        for max_memory in (1e8, 2 * 4 * (80 * 80 + 336 * 336), 0):  # many blocks, two blocks, one block if the memory is too small
+            column_corr_hist_parallel, row_corr_hist_parallel = np.zeros((80, 80), dtype=np.int), np.zeros((336, 336), dtype=np.int)
+            analysis_utils.correlate_cluster_on_event_number_parallel(cluster[0], cluster[1], column_corr_hist_parallel, row_corr_hist_parallel, min_block_size=100, max_memory=max_memory)
+            self.assertTrue(np.array_equal(column_corr_hist, column_corr_hist_parallel))
+            self.assertTrue(np.array_equal(row_corr_hist, row_corr_hist_parallel))
+        # Cluster positions that do not fit into the histograms have to raise an exception
+        with self.assertRaises(IndexError):
+            analysis_utils.correlate_cluster_on_event_number_parallel(cluster[0], cluster[1], column_corr_hist_parallel[:10], row_corr_hist_parallel)
+
+    def test_fit_gauss_offset(self):  # check the batched gauss fit against curve_fit
+        np.random.seed(0)
+        x = np.arange(80) + 0.5
+        n_rows = 50
+        p_true = np.column_stack((np.random.uniform(20, 100, n_rows), np.random.uniform(10, 70, n_rows), np.random.uniform(1, 5, n_rows), np.random.uniform(0, 5, n_rows)))
+        data = np.array([np.random.poisson(analysis_utils.gauss_offset(x, *p)) for p in p_true])
+        A_peak, mu_peak = data.max(axis=1), x[np.argmax(data, axis=1)]
+        p0 = np.column_stack((A_peak, mu_peak, np.full(n_rows, 5.), np.zeros(n_rows)))
+        bounds = (np.column_stack((np.zeros(n_rows), np.full(n_rows, x.min()), np.zeros(n_rows), np.zeros(n_rows))),
+                  np.column_stack((2. * A_peak, np.full(n_rows, x.max()), np.full(n_rows, x.max() - x.min()), A_peak)))
+        coeff, pcov, converged = analysis_utils.fit_gauss_offset(x, data, p0=p0, bounds=bounds)
+        self.assertTrue(np.all(converged))
+        for index in range(n_rows):
+            coeff_expected, pcov_expected = curve_fit(analysis_utils.gauss_offset, x, data[index], p0=p0[index], bounds=(bounds[0][index], bounds[1][index]))
+            self.assertTrue(np.allclose(coeff[index], coeff_expected, rtol=1e-3, atol=1e-3))
+            self.assertTrue(np.allclose(np.sqrt(pcov[index, 1, 1]), np.sqrt(pcov_expected[1, 1]), rtol=1e-2))
+        # No rows to fit
+        coeff, pcov, converged = analysis_utils.fit_gauss_offset(x, data[:0], p0=p0[:0], bounds=(bounds[0][:0], bounds[1][:0]))
+        self.assertTupleEqual((coeff.shape, pcov.shape, converged.shape), ((0, 4), (0, 4, 4), (0, )))
+
+    def test_hough_transform(self):  # check the compiled hough transform and its peak against a simple implementation
+        np.random.seed(0)
+        img = np.zeros((40, 30), dtype=np.int)
+        img[np.arange(40), (0.6 * np.arange(40) + 3).astype(np.int) % 30] = 1  # straight line
+        img |= np.random.uniform(size=img.shape) < 0.02  # noise
+        accumulator, thetas, rhos, peak = analysis_utils.hough_transform(img, theta_res=0.5, rho_res=0.7, return_peak=True)
+        accumulator_expected = np.zeros_like(accumulator, dtype=np.int)
+        y_idxs, x_idxs = np.nonzero(img)
+        for x, y in zip(x_idxs, y_idxs):
+            rho_idx = np.abs(rhos[:, np.newaxis] - (x * np.cos(thetas) + y * np.sin(thetas))).argmin(axis=0)
+            accumulator_expected[rho_idx, np.arange(thetas.shape[0])] += 1
+        self.assertTrue(np.array_equal(accumulator, accumulator_expected))
+        self.assertTupleEqual(tuple(peak), np.unravel_index(accumulator_expected.argmax(), accumulator_expected.shape))
+
+    def test_truncated_svd(self):  # check the randomized truncated svd against the full svd
+        np.random.seed(0)
+        data = np.dot(np.random.uniform(size=(300, 3)) * [100.0, 50.0, 20.0], np.random.uniform(size=(3, 200))) + np.random.uniform(size=(300, 200))  # rank 3 + noise
+        u, s, vt = np.linalg.svd(data, full_matrices=False)
+        for n_components in (1, 3):
+            uu, ss, vvt = analysis_utils.truncated_svd(data, n_components=n_components, n_iterations=4)
+            self.assertTupleEqual((uu.shape, ss.shape, vvt.shape), ((300, n_components), (n_components, ), (n_components, 200)))
+            self.assertTrue(np.allclose(ss, s[:n_components], rtol=1e-6))
+            self.assertTrue(np.allclose(np.dot(uu * ss, vvt), np.dot(u[:, :n_components] * s[:n_components], vt[:n_components, :]), rtol=0, atol=1e-6 * s[0]))
+        uu, ss, vvt = analysis_utils.truncated_svd(data[:8, :8], n_components=2)  # full svd for small matrices
+        self.assertTrue(np.allclose(ss, np.linalg.svd(data[:8, :8], compute_uv=False)[:2]))
+
+    def test_check_event_order(self):  # check jitted streaming event order check
+        event_numbers = np.array([0, 0, 1, 3, 3, 7], dtype=np.int64)
+        self.assertTrue(analysis_utils.check_event_order(event_numbers, np.iinfo(np.int64).min))
+        self.assertTrue(analysis_utils.check_event_order(event_numbers[3:], event_numbers[2]))
+        self.assertFalse(analysis_utils.check_event_order(event_numbers[::-1], np.iinfo(np.int64).min))
+        # Decreasing event number between chunks
+        self.assertFalse(analysis_utils.check_event_order(event_numbers[:3], event_numbers[-1]))
+
+    def test_in_pixel_mask(self):  # check jitted pixel mask lookup against np.in1d
+        n_pixel = (80, 336)
+        column, row = np.random.randint(1, n_pixel[0] + 1, 1000).astype(np.uint16), np.random.randint(1, n_pixel[1] + 1, 1000).astype(np.uint16)
+        pixel_mask = np.zeros(shape=n_pixel, dtype=np.bool_)
+        pixel_mask[np.random.randint(0, n_pixel[0], 100), np.random.randint(0, n_pixel[1], 100)] = True
+        masked_pixels = np.nonzero(pixel_mask)
+        result = np.in1d((column.astype(np.int64) - 1) * n_pixel[1] + row - 1, masked_pixels[0] * n_pixel[1] + masked_pixels[1])
+        self.assertTrue(np.all(analysis_utils.in_pixel_mask(column, row, pixel_mask) == result))
+        # Indices not fitting into the pixel mask have to raise an exception
+        with self.assertRaises(IndexError):
+            analysis_utils.in_pixel_mask(column, row, pixel_mask[:10])
+
+    def test_get_event_aligned_ranges(self):  # check that the ranges cover all rows and do not split events
+        event_numbers = np.repeat(np.arange(100, dtype=np.int64), np.random.randint(1, 20, 100))
+        with tb.open_file('event_aligned_ranges.h5', 'w', driver='H5FD_CORE', driver_core_backing_store=0) as out_file_h5:
+            table = out_file_h5.create_table(out_file_h5.root, name='Hits', description=np.dtype([('event_number', '<i8')]))
+            table.append(event_numbers.view(np.dtype([('event_number', '<i8')])))
+            for chunk_size in (1, 7, 100, 100000):
+                ranges = analysis_utils.get_event_aligned_ranges(table, chunk_size=chunk_size)
+                self.assertEqual(ranges[0][0], 0)
+                self.assertEqual(ranges[-1][1], event_numbers.shape[0])
+                for (_, stop), (start, _) in zip(ranges[:-1], ranges[1:]):
+                    self.assertEqual(stop, start)
+                    self.assertNotEqual(event_numbers[stop - 1], event_numbers[stop])
+
+    def test_data_aligned_at_events_event_index(self):  # check that reading with event index gives the same data as reading without
+        event_numbers = np.repeat(np.arange(0, 200, 2, dtype=np.int64), np.random.randint(1, 20, 100))
+        with tb.open_file('event_index.h5', 'w', driver='H5FD_CORE', driver_core_backing_store=0) as out_file_h5:
+            table = out_file_h5.create_table(out_file_h5.root, name='Hits', description=np.dtype([('event_number', '<i8')]))
+            table.append(event_numbers.view(np.dtype([('event_number', '<i8')])))
+            expected_data = [(data.copy(), index) for data, index in analysis_utils.data_aligned_at_events(table, start_event_number=11, stop_event_number=150, chunk_size=50)]
+            event_index = analysis_utils.create_event_index(table)
+            self.assertTrue(analysis_utils.is_event_index(event_index))
+            self.assertFalse(analysis_utils.is_event_index(table))
+            self.assertListEqual(np.unique(event_numbers).tolist(), event_index[:]['event_number'].tolist())
+            self.assertTrue(np.all(event_numbers[event_index[:]['start_index']] == event_index[:]['event_number']))
+            data = [(data.copy(), index) for data, index in analysis_utils.data_aligned_at_events(table, start_event_number=11, stop_event_number=150, chunk_size=50)]
+            self.assertTrue(np.all(np.concatenate([d for d, _ in expected_data]) == np.concatenate([d for d, _ in data])))
+            # Chunks must not divide events
+            chunk_stops = [index for _, index in data[:-1]]
+            self.assertTrue(np.all(event_numbers[np.array(chunk_stops) - 1] != event_numbers[chunk_stops]))
+            # Rows appended after creating the event index are not covered, the table is read without the event index
+            table.append(np.repeat(np.arange(200, 220, dtype=np.int64), 3).view(np.dtype([('event_number', '<i8')])))
+            self.assertIsNone(analysis_utils.get_event_index(table))
+            data = np.concatenate([d for d, _ in analysis_utils.data_aligned_at_events(table, start_event_number=11, stop_event_number=1000, chunk_size=50)])
+            self.assertTrue(np.array_equal(table.read(field='event_number')[table.read(field='event_number') >= 11], data['event_number']))
+
+    def test_search_sorted_column(self):  # check the binary search on a table column against np.searchsorted
+        event_numbers = np.sort(np.random.randint(0, 1000, 10000)).astype(np.int64)
+        with tb.open_file('search_sorted_column.h5', 'w', driver='H5FD_CORE', driver_core_backing_store=0) as out_file_h5:
+            table = out_file_h5.create_table(out_file_h5.root, name='Hits', description=np.dtype([('event_number', '<i8')]))
+            table.append(event_numbers.view(np.dtype([('event_number', '<i8')])))
+            for side in ('left', 'right'):
+                for block_size in (1, 2, 100, 100000):
+                    for value in (-1, 0, event_numbers[17], 500, 999, 1000):
+                        self.assertEqual(np.searchsorted(event_numbers, value, side=side), analysis_utils._search_sorted_column(table, 'event_number', value, side=side, block_size=block_size))
+
+    def test_event_aligned_reader(self):  # check reading consecutive event ranges with an open file
+        cluster_file = os.path.join(os.path.dirname(tests_data_folder), 'hit_analysis', 'Cluster_result.h5')
+        with tb.open_file(cluster_file, 'r') as in_file_h5:
+            cluster = in_file_h5.root.Cluster[:]
+        event_ranges = [(0, 1000), (1000, 1001), (1500, 4000), (4000, 100000)]
+        with analysis_utils.EventAlignedReader(cluster_file, node_name='Cluster', chunk_size=100) as reader:
+            for start_event_number, stop_event_number in event_ranges:
+                data = [chunk.copy() for chunk in reader.read(start_event_number=start_event_number, stop_event_number=stop_event_number)]
+                expected_data = cluster[np.logical_and(cluster['event_number'] >= start_event_number, cluster['event_number'] < stop_event_number)]
+                self.assertTrue(np.array_equal(expected_data, np.concatenate(data) if data else expected_data[:0]))
+
     def test_1d_index_histograming(self):  # check compiled hist_2D_index function
         x = np.random.randint(0, 100, 100)
         shape = (100, )
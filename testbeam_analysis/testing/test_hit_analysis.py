@@ -4,7 +4,12 @@ import os
 
 import unittest
 
+import mock
+import tables as tb
+import numpy as np
+
 from testbeam_analysis import hit_analysis
+from testbeam_analysis.tools import analysis_utils
 from testbeam_analysis.tools import test_tools
 
 # Get package path
@@ -34,8 +39,26 @@ class TestHitAnalysis(unittest.TestCase):
     @classmethod
     def tearDownClass(cls):  # remove created files
         os.remove(os.path.join(cls.output_folder, 'TestBeamData_FEI4_DUT0_small_cluster.h5'))
+        os.remove(os.path.join(cls.output_folder, 'TestBeamData_FEI4_DUT0_small_cluster_serial.h5'))
+        os.remove(os.path.join(cls.output_folder, 'TestBeamData_FEI4_DUT0_small_cluster_parallel.h5'))
+        os.remove(os.path.join(cls.output_folder, 'TestBeamData_FEI4_DUT0_small_cluster_pool.h5'))
         os.remove(os.path.join(cls.output_folder, 'TestBeamData_Mimosa26_DUT0_small_noisy_pixels.h5'))
         os.remove(os.path.join(cls.output_folder, 'TestBeamData_Mimosa26_DUT0_small_noisy_pixels.pdf'))
+        os.remove(os.path.join(cls.output_folder, 'TestBeamData_Mimosa26_DUT0_small_occupancy.h5'))
+        os.remove(os.path.join(cls.output_folder, 'TestBeamData_Mimosa26_DUT0_small_masked_hits.h5'))
+        os.remove(os.path.join(cls.output_folder, 'TestBeamData_Mimosa26_DUT0_small_masked_cluster.h5'))
+        os.remove(os.path.join(cls.output_folder, 'HotPixel_result_cluster.h5'))
+        os.remove(os.path.join(cls.output_folder, 'TestBeamData_Mimosa26_DUT0_small_window_noisy_pixels.h5'))
+        os.remove(os.path.join(cls.output_folder, 'TestBeamData_Mimosa26_DUT0_small_cluster.h5'))
+        os.remove(os.path.join(cls.output_folder, 'Hits_hand_made.h5'))
+        os.remove(os.path.join(cls.output_folder, 'Hits_hand_made_cluster.h5'))
+        os.remove(os.path.join(cls.output_folder, 'Hits_unsorted.h5'))
+        os.remove(os.path.join(cls.output_folder, 'Hits_unsorted_cluster.h5'))
+        os.remove(os.path.join(cls.output_folder, 'Hits_many.h5'))
+        os.remove(os.path.join(cls.output_folder, 'TestBeamData_Mimosa26_DUT0_small_noisy_pixels_cluster.h5'))
+        os.remove(os.path.join(cls.output_folder, 'TestBeamData_Mimosa26_DUT0_small_window_analyzed.h5'))
+        os.remove(os.path.join(cls.output_folder, 'TestBeamData_Mimosa26_DUT0_small_window_analyzed_cluster.h5'))
+        os.remove(os.path.join(cls.output_folder, 'TestBeamData_Mimosa26_DUT0_small_window_noisy_pixels_cluster.h5'))
 
     def test_noisy_pixel_remover(self):
         # Test 1:
@@ -47,6 +70,65 @@ class TestHitAnalysis(unittest.TestCase):
         data_equal, error_msg = test_tools.compare_h5_files(os.path.join(tests_data_folder, 'HotPixel_result.h5'), os.path.join(self.output_folder, 'TestBeamData_Mimosa26_DUT0_small_noisy_pixels.h5'))
         self.assertTrue(data_equal, msg=error_msg)
 
+    def test_noisy_pixel_remover_occupancy_cache(self):
+        # Test 1: create occupancy cache
+        hit_analysis.remove_noisy_pixels(self.noisy_data_file, threshold=10.0, n_pixel=(1152, 576), pixel_size=(18.4, 18.4), cache_occupancy=True)
+        data_equal, error_msg = test_tools.compare_h5_files(os.path.join(tests_data_folder, 'HotPixel_result.h5'), os.path.join(self.output_folder, 'TestBeamData_Mimosa26_DUT0_small_noisy_pixels.h5'))
+        self.assertTrue(data_equal, msg=error_msg)
+        with tb.open_file(os.path.join(tests_data_folder, 'HotPixel_result.h5'), 'r') as expected_file_h5:
+            with tb.open_file(os.path.join(self.output_folder, 'TestBeamData_Mimosa26_DUT0_small_occupancy.h5'), 'r') as cache_file_h5:
+                self.assertTrue(np.array_equal(expected_file_h5.root.HistOcc[:], cache_file_h5.root.HistOcc[:]))
+        # Test 2: use occupancy cache
+        hit_analysis.remove_noisy_pixels(self.noisy_data_file, threshold=10.0, n_pixel=(1152, 576), pixel_size=(18.4, 18.4), cache_occupancy=True, chunk_size=4999)
+        data_equal, error_msg = test_tools.compare_h5_files(os.path.join(tests_data_folder, 'HotPixel_result.h5'), os.path.join(self.output_folder, 'TestBeamData_Mimosa26_DUT0_small_noisy_pixels.h5'))
+        self.assertTrue(data_equal, msg=error_msg)
+
+    def test_noisy_pixel_remover_time_windows(self):
+        # Test 1: one window for the whole run gives the same result than no windows
+        hit_analysis.remove_noisy_pixels(self.noisy_data_file, threshold=10.0, n_pixel=(1152, 576), pixel_size=(18.4, 18.4), n_events_window=1000000000, output_hits_file=os.path.join(self.output_folder, 'TestBeamData_Mimosa26_DUT0_small_window_noisy_pixels.h5'), plot=False)
+        with tb.open_file(os.path.join(tests_data_folder, 'HotPixel_result.h5'), 'r') as expected_file_h5:
+            with tb.open_file(os.path.join(self.output_folder, 'TestBeamData_Mimosa26_DUT0_small_window_noisy_pixels.h5'), 'r') as out_file_h5:
+                self.assertTrue(np.array_equal(expected_file_h5.root.Hits[:], out_file_h5.root.Hits[:]))
+                self.assertTrue(np.array_equal(expected_file_h5.root.NoisyPixelsMask[:], out_file_h5.root.NoisyPixelsMask[:]))
+        # Test 2: several windows, the hits have to be removed with the noisy pixel mask of their window
+        hit_analysis.remove_noisy_pixels(self.noisy_data_file, threshold=10.0, n_pixel=(1152, 576), pixel_size=(18.4, 18.4), n_events_window=50000000, output_hits_file=os.path.join(self.output_folder, 'TestBeamData_Mimosa26_DUT0_small_window_noisy_pixels.h5'), plot=False, chunk_size=4999)
+        with tb.open_file(self.noisy_data_file, 'r') as in_file_h5:
+            with tb.open_file(os.path.join(self.output_folder, 'TestBeamData_Mimosa26_DUT0_small_window_noisy_pixels.h5'), 'r') as out_file_h5:
+                hits = in_file_h5.root.Hits[:]
+                window_mask = out_file_h5.root.NoisyPixelsWindowMask[:]
+                self.assertEqual(window_mask.shape[2], (hits['event_number'][-1] - hits['event_number'][0]) // 50000000 + 1)
+                selected_hits = hits[~window_mask[hits['column'] - 1, hits['row'] - 1, (hits['event_number'] - hits['event_number'][0]) // 50000000]]
+                self.assertTrue(np.array_equal(selected_hits, out_file_h5.root.Hits[:]))
+                self.assertTrue(np.array_equal(np.any(window_mask, axis=2), out_file_h5.root.NoisyPixelsMask[:]))
+
+    def test_noisy_pixel_remover_sparse_time_window(self):  # the last window has only few hits, its noise cannot be determined
+        occupancy = hit_analysis.find_noisy_pixels(self.noisy_data_file, threshold=10.0, n_pixel=(1152, 576), n_events_window=240000000)
+        self.assertEqual(occupancy.shape[2], 2)
+        self.assertLess(np.ma.getdata(occupancy)[:, :, -1].sum(), 0.5 * np.ma.getdata(occupancy)[:, :, 0].sum())
+        # The noisy pixels of the whole run are taken for the sparse window instead of masking almost all hit pixels
+        with tb.open_file(os.path.join(tests_data_folder, 'HotPixel_result.h5'), 'r') as expected_file_h5:
+            self.assertTrue(np.array_equal(expected_file_h5.root.NoisyPixelsMask[:], np.ma.getmaskarray(occupancy)[:, :, -1]))
+
+    def test_noisy_pixel_remover_parallel(self):  # the occupancy histogrammed in parallel processes has to be the same than the serial one
+        for n_events_window in (None, 50000000):
+            occupancy_serial = hit_analysis.find_noisy_pixels(self.noisy_data_file, threshold=10.0, n_pixel=(1152, 576), n_events_window=n_events_window, chunk_size=4999, n_processes=1)
+            occupancy_parallel = hit_analysis.find_noisy_pixels(self.noisy_data_file, threshold=10.0, n_pixel=(1152, 576), n_events_window=n_events_window, chunk_size=4999, n_processes=3)
+            self.assertTrue(np.array_equal(np.ma.getdata(occupancy_serial), np.ma.getdata(occupancy_parallel)))
+            self.assertTrue(np.array_equal(np.ma.getmaskarray(occupancy_serial), np.ma.getmaskarray(occupancy_parallel)))
+
+    def test_noisy_pixel_remover_many_hits(self):  # more hits of one pixel and time window than the 16-bit bins of the 3D histogram can count at once
+        hits = np.zeros(shape=(70000, ), dtype=[('event_number', '<i8'), ('frame', 'u1'), ('column', '<u2'), ('row', '<u2'), ('charge', '<u2')])
+        hits['event_number'] = np.arange(70000)
+        hits['column'], hits['row'], hits['charge'] = 10, 10, 1
+        hits['column'][-10:] = 20  # the second window
+        with tb.open_file(os.path.join(self.output_folder, 'Hits_many.h5'), 'w') as out_file_h5:
+            hit_table = out_file_h5.create_table(out_file_h5.root, name='Hits', description=hits.dtype)
+            hit_table.append(hits)
+        occupancy = hit_analysis.find_noisy_pixels(os.path.join(self.output_folder, 'Hits_many.h5'), n_pixel=(80, 336), n_events_window=69990, chunk_size=100000, n_processes=1)
+        self.assertEqual(np.ma.getdata(occupancy)[9, 9, 0], 69990)
+        self.assertEqual(np.ma.getdata(occupancy)[19, 9, 1], 10)
+        self.assertEqual(np.ma.getdata(occupancy).sum(), 70000)
+
     def test_hit_clustering(self):
         # Test 1:
         hit_analysis.cluster_hits(self.data_files[0], max_x_distance=1, max_y_distance=2)
@@ -56,6 +138,122 @@ class TestHitAnalysis(unittest.TestCase):
         hit_analysis.cluster_hits(self.data_files[0], max_x_distance=1, max_y_distance=2, chunk_size=4999)
         data_equal, error_msg = test_tools.compare_h5_files(os.path.join(tests_data_folder, 'Cluster_result.h5'), os.path.join(self.output_folder, 'TestBeamData_FEI4_DUT0_small_cluster.h5'), exact=False)
         self.assertTrue(data_equal, msg=error_msg)
+        with tb.open_file(os.path.join(self.output_folder, 'TestBeamData_FEI4_DUT0_small_cluster.h5'), 'r') as out_file_h5:
+            self.assertTrue(out_file_h5.root.Cluster.attrs.sorted_by_event)
+
+    def test_hit_clustering_histograms(self):  # the cluster histograms of a small hand made hit table
+        hits = np.array([(0, 0, 10, 10, 2),  # event 0: one cluster with one hit
+                         (1, 0, 10, 10, 1), (1, 0, 10, 11, 3), (1, 0, 50, 50, 5),  # event 1: one cluster with two hits, one cluster with one hit
+                         (3, 0, 20, 20, 1), (3, 0, 21, 20, 1), (3, 0, 22, 20, 1)],  # event 3: one cluster with three hits
+                        dtype=[('event_number', '<i8'), ('frame', 'u1'), ('column', '<u2'), ('row', '<u2'), ('charge', '<u2')])
+        with tb.open_file(os.path.join(self.output_folder, 'Hits_hand_made.h5'), 'w') as out_file_h5:
+            hit_table = out_file_h5.create_table(out_file_h5.root, name='Hits', description=hits.dtype)
+            hit_table.append(hits)
+        for chunk_size in (1000, 2):  # one hit range and several hit ranges
+            output_cluster_file = hit_analysis.cluster_hits(os.path.join(self.output_folder, 'Hits_hand_made.h5'), max_x_distance=1, max_y_distance=1, plot=False, chunk_size=chunk_size, n_processes=1)
+            with tb.open_file(output_cluster_file, 'r') as in_file_h5:
+                self.assertTrue(np.array_equal(in_file_h5.root.HistClusterSize[:], [0, 2, 1, 1]))
+                self.assertTrue(np.array_equal(in_file_h5.root.HistClusterCharge[:], [0, 0, 1, 1, 1, 1]))
+                self.assertTrue(np.array_equal(in_file_h5.root.HistNClusterPerEvent[:], [0, 2, 1]))  # event 2 has no hits and is not counted
+
+    def test_hit_clustering_event_order(self):  # a decreasing event number between two hit ranges has to be found, also if the hits of the event are masked
+        hits = np.array([(0, 0, 10, 10, 1), (0, 0, 20, 20, 1), (1, 0, 10, 10, 1), (5, 0, 1, 1, 1), (5, 0, 1, 2, 1), (3, 0, 10, 10, 1), (3, 0, 20, 20, 1)],
+                        dtype=[('event_number', '<i8'), ('frame', 'u1'), ('column', '<u2'), ('row', '<u2'), ('charge', '<u2')])
+        with tb.open_file(os.path.join(self.output_folder, 'Hits_unsorted.h5'), 'w') as out_file_h5:
+            hit_table = out_file_h5.create_table(out_file_h5.root, name='Hits', description=hits.dtype)
+            hit_table.append(hits)
+        pixel_mask = np.zeros(shape=(80, 336), dtype=np.bool_)
+        pixel_mask[0, :2] = True  # the hits of event 5 do not create cluster
+        with self.assertRaises(RuntimeError):
+            hit_analysis.cluster_hits(os.path.join(self.output_folder, 'Hits_unsorted.h5'), plot=False, pixel_mask=pixel_mask, chunk_size=2, n_processes=1)
+
+    def test_hit_clustering_parallel(self):  # the cluster of hit ranges clustered in parallel processes have to be the same than the serial ones
+        hit_analysis.cluster_hits(self.data_files[0], output_cluster_file=os.path.join(self.output_folder, 'TestBeamData_FEI4_DUT0_small_cluster_serial.h5'), max_x_distance=1, max_y_distance=2, plot=False, chunk_size=999, n_processes=1)
+        hit_analysis.cluster_hits(self.data_files[0], output_cluster_file=os.path.join(self.output_folder, 'TestBeamData_FEI4_DUT0_small_cluster_parallel.h5'), max_x_distance=1, max_y_distance=2, plot=False, chunk_size=999, n_processes=3)
+        data_equal, error_msg = test_tools.compare_h5_files(os.path.join(self.output_folder, 'TestBeamData_FEI4_DUT0_small_cluster_serial.h5'), os.path.join(self.output_folder, 'TestBeamData_FEI4_DUT0_small_cluster_parallel.h5'))
+        self.assertTrue(data_equal, msg=error_msg)
+
+    def test_hit_clustering_pool_size(self):  # not more processes than hit ranges, no pool for a single hit range
+        with tb.open_file(self.data_files[0], 'r') as in_file_h5:
+            n_hit_ranges = len(analysis_utils.get_event_aligned_ranges(in_file_h5.root.Hits, chunk_size=4000))
+        self.assertGreater(n_hit_ranges, 1)
+        with mock.patch('testbeam_analysis.hit_analysis.Pool', wraps=hit_analysis.Pool) as pool:
+            hit_analysis.cluster_hits(self.data_files[0], output_cluster_file=os.path.join(self.output_folder, 'TestBeamData_FEI4_DUT0_small_cluster_pool.h5'), plot=False, chunk_size=4000, n_processes=n_hit_ranges + 2)
+            pool.assert_called_once_with(n_hit_ranges)
+            pool.reset_mock()
+            hit_analysis.cluster_hits(self.data_files[0], output_cluster_file=os.path.join(self.output_folder, 'TestBeamData_FEI4_DUT0_small_cluster_pool.h5'), plot=False, n_processes=4)
+            self.assertFalse(pool.called)
+
+    def test_hit_clustering_pixel_mask(self):  # Remove noisy pixels while clustering without intermediate hit file
+        occupancy = hit_analysis.find_noisy_pixels(self.noisy_data_file, threshold=10.0, n_pixel=(1152, 576))
+        hit_analysis.cluster_hits(self.noisy_data_file, output_cluster_file=os.path.join(self.output_folder, 'TestBeamData_Mimosa26_DUT0_small_masked_cluster.h5'), pixel_mask=np.ma.getmaskarray(occupancy), output_hits_file=os.path.join(self.output_folder, 'TestBeamData_Mimosa26_DUT0_small_masked_hits.h5'), plot=False, chunk_size=4999)
+        # Selected hits have to be the same than the hits from the noisy pixel removal
+        with tb.open_file(os.path.join(tests_data_folder, 'HotPixel_result.h5'), 'r') as expected_file_h5:
+            with tb.open_file(os.path.join(self.output_folder, 'TestBeamData_Mimosa26_DUT0_small_masked_hits.h5'), 'r') as hits_file_h5:
+                self.assertTrue(np.array_equal(expected_file_h5.root.Hits[:], hits_file_h5.root.Hits[:]))
+        # Cluster have to be the same than the cluster of the hits after noisy pixel removal
+        hit_analysis.cluster_hits(os.path.join(tests_data_folder, 'HotPixel_result.h5'), output_cluster_file=os.path.join(self.output_folder, 'HotPixel_result_cluster.h5'), plot=False)
+        data_equal, error_msg = test_tools.compare_h5_files(os.path.join(self.output_folder, 'HotPixel_result_cluster.h5'), os.path.join(self.output_folder, 'TestBeamData_Mimosa26_DUT0_small_masked_cluster.h5'))
+        self.assertTrue(data_equal, msg=error_msg)
+
+    def test_analyze_hits(self):  # Cluster several DUTs in parallel with a small memory budget
+        results = hit_analysis.analyze_hits([self.data_files[0], self.noisy_data_file], n_pixels=[(80, 336), (1152, 576)], remove_noisy=False, cluster_kwargs={'max_x_distance': 1, 'max_y_distance': 2, 'plot': False}, max_memory=2e6, max_processes=2)
+        self.assertListEqual([os.path.join(self.output_folder, 'TestBeamData_FEI4_DUT0_small_cluster.h5'), os.path.join(self.output_folder, 'TestBeamData_Mimosa26_DUT0_small_cluster.h5')], [result['cluster_file'] for result in results])
+        data_equal, error_msg = test_tools.compare_h5_files(os.path.join(tests_data_folder, 'Cluster_result.h5'), results[0]['cluster_file'], exact=False)
+        self.assertTrue(data_equal, msg=error_msg)
+
+    def test_analyze_hits_memory_budget(self):  # the chunks analyzed at the same time have to fit into the memory budget
+        max_memory = 1e5
+        # DUTs in parallel with one chunk each, one DUT serial, one DUT with 3 processes that keep up to 2 chunks each
+        for max_processes, input_hits_files, n_pixels, n_chunks in ((2, [self.data_files[0], self.noisy_data_file], [(80, 336), (1152, 576)], 2),
+                                                                    (1, [self.noisy_data_file], [(1152, 576)], 1),
+                                                                    (3, [self.noisy_data_file], [(1152, 576)], 6)):
+            results = hit_analysis.analyze_hits(input_hits_files, n_pixels=n_pixels, remove_noisy=False, cluster_kwargs={'max_x_distance': 1, 'max_y_distance': 2, 'plot': False}, max_memory=max_memory, max_processes=max_processes)
+            for input_hits_file, result in zip(input_hits_files, results):
+                with tb.open_file(input_hits_file, 'r') as in_file_h5:
+                    hit_size = in_file_h5.root.Hits.dtype.itemsize
+                self.assertEqual(result['chunk_size'], int(max_memory / n_chunks / (10 * hit_size)))
+
+    def test_analyze_hits_noisy_pixels(self):  # the noisy pixel mask is given to the clustering, the output files have to be the same than from remove_noisy_pixels and cluster_hits
+        # Test 1: noisy pixels of the whole run
+        results = hit_analysis.analyze_hits([self.noisy_data_file], n_pixels=[(1152, 576)], pixel_size=[(18.4, 18.4)], noisy_pixel_kwargs={'threshold': 10.0, 'plot': False}, cluster_kwargs={'plot': False}, max_memory=2e7, max_processes=2)
+        self.assertEqual(results[0]['noisy_pixels_file'], os.path.join(self.output_folder, 'TestBeamData_Mimosa26_DUT0_small_noisy_pixels.h5'))
+        self.assertEqual(results[0]['cluster_file'], os.path.join(self.output_folder, 'TestBeamData_Mimosa26_DUT0_small_noisy_pixels_cluster.h5'))
+        data_equal, error_msg = test_tools.compare_h5_files(os.path.join(tests_data_folder, 'HotPixel_result.h5'), results[0]['noisy_pixels_file'])
+        self.assertTrue(data_equal, msg=error_msg)
+        hit_analysis.cluster_hits(os.path.join(tests_data_folder, 'HotPixel_result.h5'), output_cluster_file=os.path.join(self.output_folder, 'HotPixel_result_cluster.h5'), plot=False)
+        data_equal, error_msg = test_tools.compare_h5_files(os.path.join(self.output_folder, 'HotPixel_result_cluster.h5'), results[0]['cluster_file'])
+        self.assertTrue(data_equal, msg=error_msg)
+        # Test 2: noisy pixels per time window
+        hit_analysis.remove_noisy_pixels(self.noisy_data_file, threshold=10.0, n_pixel=(1152, 576), n_events_window=50000000, output_hits_file=os.path.join(self.output_folder, 'TestBeamData_Mimosa26_DUT0_small_window_noisy_pixels.h5'), plot=False)
+        hit_analysis.cluster_hits(os.path.join(self.output_folder, 'TestBeamData_Mimosa26_DUT0_small_window_noisy_pixels.h5'), plot=False)
+        results = hit_analysis.analyze_hits([self.noisy_data_file], n_pixels=[(1152, 576)], noisy_pixel_kwargs={'threshold': 10.0, 'n_events_window': 50000000, 'output_hits_file': os.path.join(self.output_folder, 'TestBeamData_Mimosa26_DUT0_small_window_analyzed.h5'), 'plot': False}, cluster_kwargs={'plot': False}, max_memory=2e7, max_processes=1)
+        data_equal, error_msg = test_tools.compare_h5_files(os.path.join(self.output_folder, 'TestBeamData_Mimosa26_DUT0_small_window_noisy_pixels.h5'), results[0]['noisy_pixels_file'])
+        self.assertTrue(data_equal, msg=error_msg)
+        data_equal, error_msg = test_tools.compare_h5_files(os.path.join(self.output_folder, 'TestBeamData_Mimosa26_DUT0_small_window_noisy_pixels_cluster.h5'), results[0]['cluster_file'])
+        self.assertTrue(data_equal, msg=error_msg)
+
+    def test_analyze_hits_arguments(self):  # the arguments set by analyze_hits cannot be given for the DUTs
+        with self.assertRaises(ValueError):
+            hit_analysis.analyze_hits([self.noisy_data_file], n_pixels=[(1152, 576)], noisy_pixel_kwargs={'chunk_size': 1000})
+        with self.assertRaises(ValueError):
+            hit_analysis.analyze_hits([self.noisy_data_file], n_pixels=[(1152, 576)], cluster_kwargs={'n_processes': 2})
+        with self.assertRaises(ValueError):
+            hit_analysis.analyze_hits([self.noisy_data_file], n_pixels=[(1152, 576)], cluster_kwargs={'pixel_mask': np.zeros(shape=(1152, 576), dtype=np.bool_)})
+
+    def test_analyze_hits_occupancy_memory(self):  # the occupancy histograms are taken from the memory budget
+        with tb.open_file(self.noisy_data_file, 'r') as in_file_h5:
+            hit_size = in_file_h5.root.Hits.dtype.itemsize
+        with mock.patch('testbeam_analysis.hit_analysis._remove_noisy_pixels_and_cluster', return_value=(None, None)):
+            # One DUT serial: 4 byte occupancy, 2 byte masks per pixel
+            results = hit_analysis.analyze_hits([self.noisy_data_file], n_pixels=[(1152, 576)], max_memory=4.5e6, max_processes=1)
+            self.assertEqual(results[0]['chunk_size'], int((4.5e6 - 1152 * 576 * 6) / (10 * hit_size)))
+            # One DUT with 2 processes: 4 byte occupancy, 2 byte masks and the mask in 4 pending hit ranges per pixel, 4 chunks
+            results = hit_analysis.analyze_hits([self.noisy_data_file], n_pixels=[(1152, 576)], max_memory=7.5e6, max_processes=2)
+            self.assertEqual(results[0]['chunk_size'], int((7.5e6 - 1152 * 576 * 10) / 4 / (10 * hit_size)))
+        with self.assertRaises(ValueError):
+            hit_analysis.analyze_hits([self.noisy_data_file], n_pixels=[(1152, 576)], max_memory=1152 * 576 * 6, max_processes=1)
+
 
 if __name__ == '__main__':
     import logging
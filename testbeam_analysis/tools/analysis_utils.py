@@ -3,10 +3,14 @@
 from __future__ import division
 
 import logging
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
 import numpy as np
 import numexpr as ne
 import tables as tb
-from numba import njit
+import numba
+from numba import njit, prange
 from scipy.interpolate import splrep, sproot
 from scipy import stats
 from scipy.optimize import curve_fit
@@ -127,6 +131,178 @@ def correlate_cluster_on_event_number(data_1, data_2, column_corr_hist, row_corr
                 break
 
 
+def correlate_cluster_on_event_number_parallel(data_1, data_2, column_corr_hist, row_corr_hist, min_block_size=10000, max_memory=1e8):
+    """
+    Same as correlate_cluster_on_event_number, but the correlation is histogrammed in parallel threads.
+    data_1 is partitioned into blocks at event boundaries, each block fills its own histograms that are summed at the end.
+    Every block needs a copy of both histograms, thus the number of blocks is limited by max_memory.
+    The histogram indices are checked once for all cluster instead of per cluster pair.
+
+    Parameters
+    ----------
+    data_1, data_2: np.recarray
+        Has to have event_number / mean_column / mean_row columns
+    column_corr_hist, row_corr_hist: np.arrays
+        Holds correlation data. Has to be of sufficient size
+    min_block_size: int
+        Minimum number of cluster of data_1 per thread. Small data is histogrammed in one thread to avoid the overhead.
+    max_memory: float
+        Memory in bytes for the histogram copies of the blocks. At least one block is used.
+
+    """
+    if data_1.shape[0] == 0 or data_2.shape[0] == 0:
+        return
+
+    event_number_1, event_number_2 = np.ascontiguousarray(data_1['event_number']), np.ascontiguousarray(data_2['event_number'])
+    # Assuming value is an index, cluster index 1 from 0.5 to 1.4999, index 2 from 1.5 to 2.4999, etc.
+    column_index_1, row_index_1 = np.floor(data_1['mean_column'] - 0.5).astype(np.int64), np.floor(data_1['mean_row'] - 0.5).astype(np.int64)
+    column_index_2, row_index_2 = np.floor(data_2['mean_column'] - 0.5).astype(np.int64), np.floor(data_2['mean_row'] - 0.5).astype(np.int64)
+    for index_1, index_2, hist in ((column_index_1, column_index_2, column_corr_hist), (row_index_1, row_index_2, row_corr_hist)):
+        if np.any(index_1 < 0) or np.any(index_1 >= hist.shape[1]) or np.any(index_2 < 0) or np.any(index_2 >= hist.shape[0]):
+            raise IndexError('Cluster position out of correlation histogram range')
+
+    # Partition data_1 into blocks that do not divide events, the histogram copies of all blocks have to fit into the memory
+    block_hist_size = (column_corr_hist.size + row_corr_hist.size) * np.dtype(np.uint32).itemsize
+    n_blocks = int(max(1, min(numba.config.NUMBA_NUM_THREADS, data_1.shape[0] // min_block_size, max_memory // block_hist_size)))
+    block_edges = np.linspace(0, data_1.shape[0], n_blocks + 1).astype(np.int64)
+    block_edges[1:-1] = np.searchsorted(event_number_1, event_number_1[block_edges[1:-1]], side='left')  # Move the edges to the first cluster of the event
+    block_edges = np.unique(block_edges)
+
+    column_corr_hists = np.zeros((block_edges.shape[0] - 1, ) + column_corr_hist.shape, dtype=np.uint32)
+    row_corr_hists = np.zeros((block_edges.shape[0] - 1, ) + row_corr_hist.shape, dtype=np.uint32)
+    _correlate_blocks(event_number_1, column_index_1, row_index_1, event_number_2, column_index_2, row_index_2, block_edges, column_corr_hists, row_corr_hists)
+    for block_index in range(block_edges.shape[0] - 1):  # Add block by block, summing all blocks at once creates a 64 bit temporary histogram
+        np.add(column_corr_hist, column_corr_hists[block_index], out=column_corr_hist, casting='unsafe')
+        np.add(row_corr_hist, row_corr_hists[block_index], out=row_corr_hist, casting='unsafe')
+
+
+@njit
+def histogram_difference_on_event_number(event_number_1, position_1, event_number_2, position_2, window_index_1, difference_hist):
+    """
+    Histograms the position difference position_2 - position_1 of all cluster pairs of the same event (all permutations).
+    The differences are histogrammed for each event window separately. The histogram has one bin per position unit
+    and is centered at a difference of 0. Differences outside the histogram range are omitted.
+
+    Parameters
+    ----------
+    event_number_1, event_number_2: np.array
+        The event numbers of the cluster, have to be sorted
+    position_1, position_2: np.array
+        The cluster positions
+    window_index_1: np.array
+        The event window index of each cluster of data 1, the row index of the difference histogram
+    difference_hist: np.array
+        Holds the difference histograms with the shape (n windows, n bins)
+
+    """
+    offset = difference_hist.shape[1] // 2
+    index_data_2 = 0
+    for index_data_1 in range(event_number_1.shape[0]):
+        while index_data_2 < event_number_2.shape[0] and event_number_2[index_data_2] < event_number_1[index_data_1]:  # Catch up with outer loop
+            index_data_2 += 1
+        for event_index_data_2 in range(index_data_2, event_number_2.shape[0]):
+            if event_number_1[index_data_1] == event_number_2[event_index_data_2]:
+                difference_index = int(np.floor(position_2[event_index_data_2] - position_1[index_data_1] + 0.5)) + offset
+                if difference_index >= 0 and difference_index < difference_hist.shape[1]:
+                    difference_hist[window_index_1[index_data_1], difference_index] += 1
+            else:
+                break
+
+
+@njit
+def check_event_order(event_numbers, last_event_number):
+    """
+    Checks that the event numbers do not decrease and do not start below the last event number of the previous chunk.
+    Contrary to np.all(np.diff(event_numbers) >= 0) no temporary arrays are created and decreasing event numbers
+    between chunks are found.
+
+    Parameters
+    ----------
+    event_numbers: np.array
+        The event numbers of the actual chunk.
+    last_event_number: int
+        The last event number of the previous chunk. Use np.iinfo(np.int64).min for the first chunk.
+
+    Returns
+    -------
+    True if the event numbers are sorted.
+
+    """
+    for index in range(event_numbers.shape[0]):
+        if event_numbers[index] < last_event_number:
+            return False
+        last_event_number = event_numbers[index]
+    return True
+
+
+def is_sorted_by_event(table):
+    '''Returns True if the table is known to be sorted by event number (sorted_by_event attribute). Then
+    the event order does not have to be checked again.
+    '''
+    return bool(getattr(table.attrs, 'sorted_by_event', False))
+
+
+@njit
+def in_pixel_mask(column, row, pixel_mask):
+    """
+    Checks for each hit if its pixel is set in the pixel mask. The lookup in the dense pixel mask is O(n) and
+    does not need sorting, contrary to np.in1d on 1D pixel indices.
+
+    Parameters
+    ----------
+    column, row: np.array
+        Column / row of the hits, starting at 1.
+    pixel_mask: np.array
+        Boolean 2D array with the shape (n_columns, n_rows).
+
+    Returns
+    -------
+    Boolean np.array that is True for hits of masked pixels.
+
+    """
+    n_columns, n_rows = pixel_mask.shape
+    result = np.empty(column.shape[0], dtype=np.bool_)
+    for index in range(column.shape[0]):
+        column_index = column[index] - 1
+        row_index = row[index] - 1
+        if column_index < 0 or column_index >= n_columns or row_index < 0 or row_index >= n_rows:
+            raise IndexError('Pixel index out of pixel mask range')
+        result[index] = pixel_mask[column_index, row_index]
+    return result
+
+
+@njit
+def in_pixel_window_mask(column, row, window, pixel_mask):
+    """
+    Checks for each hit if its pixel is set in the pixel mask of its time window. Like in_pixel_mask, but the pixel mask
+    has an additional last dimension for the time windows.
+
+    Parameters
+    ----------
+    column, row: np.array
+        Column / row of the hits, starting at 1.
+    window: np.array
+        Time window index of the hits, starting at 0.
+    pixel_mask: np.array
+        Boolean 3D array with the shape (n_columns, n_rows, n_windows).
+
+    Returns
+    -------
+    Boolean np.array that is True for hits of masked pixels.
+
+    """
+    n_columns, n_rows, n_windows = pixel_mask.shape
+    result = np.empty(column.shape[0], dtype=np.bool_)
+    for index in range(column.shape[0]):
+        column_index = column[index] - 1
+        row_index = row[index] - 1
+        window_index = window[index]
+        if column_index < 0 or column_index >= n_columns or row_index < 0 or row_index >= n_rows or window_index < 0 or window_index >= n_windows:
+            raise IndexError('Pixel index out of pixel mask range')
+        result[index] = pixel_mask[column_index, row_index, window_index]
+    return result
+
+
 def in1d_events(ar1, ar2):
     """
     Does the same than np.in1d but uses the fact that ar1 and ar2 are sorted and the c++ library. Is therefore much much faster.
@@ -340,6 +516,9 @@ def data_aligned_at_events(table, start_event_number=None, stop_event_number=Non
     parameters can be set to increase the readout speed. If only events between a certain event range are used one can specify this. Also the start and the
     stop indices for the reading of the table can be specified for speed up.
     It is important to index the event_number with pytables before using this function, otherwise the queries are very slow.
+    If the table has an event index node (see create_event_index) the event boundaries are found with a binary search instead.
+    The table can also be a MergedClusterView, then the merged cluster are created on the fly from the cluster files.
+    The view has no row indices, thus only the event range (start_event_number, stop_event_number) can be selected.
 
     Parameters
     ----------
@@ -369,6 +548,26 @@ def data_aligned_at_events(table, start_event_number=None, stop_event_number=Non
         do_something(data)
     '''
 
+    if isinstance(table, MergedClusterView):  # Lazy merged cluster, the event aligned blocks are sliced to the event range
+        if start is not None or stop is not None:
+            raise ValueError('The merged cluster view has no row indices, select the event range with start_event_number and stop_event_number')
+        for data, index in table.read_aligned_at_events(chunk_size=chunk_size):
+            if start_event_number is not None or stop_event_number is not None:
+                if stop_event_number is not None and data['event_number'][0] >= stop_event_number:  # The blocks are sorted by event number, thus stop here
+                    break
+                event_range = np.searchsorted(data['event_number'], [np.iinfo(np.int64).min if start_event_number is None else start_event_number, np.iinfo(np.int64).max if stop_event_number is None else stop_event_number])
+                data = data[event_range[0]:event_range[1]]
+                if data.shape[0] == 0:
+                    continue
+            yield data, index
+        return
+
+    event_index = get_event_index(table)
+    if event_index is not None:  # Event boundaries are known, jump directly to the selected rows
+        for data in _data_aligned_at_events_indexed(table, event_index, start_event_number=start_event_number, stop_event_number=stop_event_number, start=start, stop=stop, chunk_size=chunk_size):
+            yield data
+        return
+
     # initialize variables
     start_index_known = False
     stop_index_known = False
@@ -424,6 +623,305 @@ def data_aligned_at_events(table, start_event_number=None, stop_event_number=Non
             start_index = start_index + nrows  # events fully read, increase start index and continue reading
 
 
+def merge_aligned_at_events(input_files, node_name='Cluster', chunk_size=10000000):
+    '''Reads the tables with a sorted event_number column of several files in one pass (k-way merge on the event number).
+    Yields for each step one array per file that contain the rows of the same event range. Thus data of different files
+    can be combined event wise without reading a file twice. Events that are missing in a file give an empty array for that file.
+
+    Parameters
+    ----------
+    input_files : iterable of strings
+        The file names.
+    node_name : string
+        The name of the table node in each file.
+    chunk_size : int
+        Number of rows read at once from each file.
+
+    Returns
+    -------
+    iterable of lists with one numpy.array per file
+    '''
+    readers = [EventAlignedReader(input_file, node_name=node_name, chunk_size=chunk_size) for input_file in input_files]  # One open file and read position per file
+    try:
+        iterators = [reader.read() for reader in readers]
+        buffers = [next(iterator, reader.table.read(start=0, stop=0)) for iterator, reader in zip(iterators, readers)]
+        exhausted = [buffer.shape[0] == 0 for buffer in buffers]
+        while not all(exhausted):
+            # All events up to the smallest last event of the buffered chunks are complete in all buffers
+            stop_event_number = min(buffer['event_number'][-1] for index, buffer in enumerate(buffers) if not exhausted[index]) + 1
+            data = []
+            for index, buffer in enumerate(buffers):
+                if exhausted[index]:
+                    data.append(buffer)
+                    continue
+                stop_index = np.searchsorted(buffer['event_number'], stop_event_number, side='left')
+                data.append(buffer[:stop_index])
+                buffers[index] = buffer[stop_index:]
+                if buffers[index].shape[0] == 0:  # Chunk used completely, read the next one
+                    buffers[index] = next(iterators[index], buffer[:0])
+                    exhausted[index] = buffers[index].shape[0] == 0
+            yield data
+    finally:
+        for reader in readers:
+            reader.close()
+
+
+class EventAlignedReader(object):
+    '''Reads a table with a sorted event_number column event range by event range. The file is kept open and the read
+    position is stored between the reads, thus consecutive event ranges are read without reopening the file and without
+    searching the table from the beginning. The event ranges have to be requested in increasing order.
+
+    Example
+    -------
+    with EventAlignedReader(cluster_file, node_name='Cluster', chunk_size=chunk_size) as reader:
+        for start_event_number, stop_event_number in event_ranges:
+            for data in reader.read(start_event_number=start_event_number, stop_event_number=stop_event_number):
+                do_something(data)
+    '''
+
+    def __init__(self, input_file, node_name='Cluster', chunk_size=10000000):
+        self.in_file_h5 = tb.open_file(input_file, mode='r')
+        self.table = self.in_file_h5.get_node(self.in_file_h5.root, node_name)
+        self.chunk_size = chunk_size
+        self.start_index = 0  # Read position, all rows before belong to already read events
+
+    def read(self, start_event_number=None, stop_event_number=None):
+        '''Yields the data of the event range [start_event_number, stop_event_number[ in chunks that do not divide events.
+        '''
+        for data, self.start_index in data_aligned_at_events(self.table, start_event_number=start_event_number, stop_event_number=stop_event_number, start=self.start_index, chunk_size=self.chunk_size):
+            yield data
+
+    def close(self):
+        self.in_file_h5.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class MergedClusterView(object):
+    '''Lazy view of the cluster of several DUTs merged at a common event number (see dut_alignment.merge_cluster_data).
+    The merged cluster are created from the cluster files block by block on demand, thus the merged cluster file does not
+    have to be written. The view can be used instead of the merged cluster file as input of dut_alignment.apply_alignment
+    and track_analysis.find_tracks.
+
+    Example
+    -------
+    merged_cluster = MergedClusterView(cluster_files, n_pixels=n_pixels, pixel_size=pixel_size)
+    for data, index in data_aligned_at_events(merged_cluster):
+        do_something(data)
+    '''
+    name = 'MergedCluster'
+    title = 'Merged cluster on event number'
+
+    def __init__(self, input_cluster_files, n_pixels, pixel_size, compact=False, chunk_size=10000000):
+        self.input_cluster_files = input_cluster_files
+        self.n_pixels = n_pixels
+        self.pixel_size = pixel_size
+        self.chunk_size = chunk_size
+
+        # Create result array description, depends on the number of DUTs
+        description = [('event_number', np.int64)]
+        for index, _ in enumerate(input_cluster_files):
+            description.append(('x_dut_%d' % index, np.float))
+        for index, _ in enumerate(input_cluster_files):
+            description.append(('y_dut_%d' % index, np.float))
+        for index, _ in enumerate(input_cluster_files):
+            description.append(('z_dut_%d' % index, np.float))
+        for index, _ in enumerate(input_cluster_files):
+            description.append(('charge_dut_%d' % index, np.float))
+        description.extend([('track_quality', np.uint32), ('n_tracks', np.int8)])
+        self.dtype = get_compact_tracklets_dtype(np.dtype(description)) if compact else np.dtype(description)
+        self.z_positions = np.zeros(len(input_cluster_files), dtype=np.float) if compact else None  # z is the same for all hits of a DUT before the alignment
+
+        with tb.open_file(input_cluster_files[0], mode='r') as in_file_h5:  # Open DUT0 cluster file
+            n_cluster_dut_0 = in_file_h5.root.Cluster.shape[0]
+            self.last_event_number = in_file_h5.root.Cluster[-1]['event_number'] if n_cluster_dut_0 else -1  # Events after the last event of DUT0 are not merged
+        self.shape = (n_cluster_dut_0,)  # The number of merged cluster is only known after reading, the number of DUT0 cluster is used for progress bars
+
+    def read_aligned_at_events(self, chunk_size=None):
+        '''Reads the cluster of all DUTs in one pass and yields the merged cluster in event aligned blocks and the number of DUT0 cluster read so far.
+        '''
+        pool = ThreadPool(min(cpu_count(), len(self.input_cluster_files)))  # The DUTs are filled in parallel threads, the cluster mapping releases the GIL
+        try:
+            n_cluster_read = 0
+            for cluster in merge_aligned_at_events(self.input_cluster_files, node_name='Cluster', chunk_size=self.chunk_size if chunk_size is None else chunk_size):  # The cluster of each step have the same event range
+                if all(actual_cluster.shape[0] == 0 or actual_cluster['event_number'][0] > self.last_event_number for actual_cluster in cluster):  # DUT0 read completely
+                    break
+                merged_cluster_array = _get_merged_cluster(cluster, self.dtype, self.n_pixels, self.pixel_size, self.last_event_number, pool)
+                n_cluster_read += cluster[0].shape[0]
+                if merged_cluster_array.shape[0] != 0:
+                    yield merged_cluster_array, n_cluster_read
+        finally:
+            pool.close()
+            pool.join()
+
+
+def create_event_index(table, chunk_size=10000000):
+    '''Creates the event index of a table with a sorted event_number column. The event index is stored as an additional
+    node next to the table and contains the unique event numbers and the index of the first table row of each event.
+    It is used to find event boundaries with a binary search (e.g. in data_aligned_at_events).
+    The event order is checked if the table is not marked as sorted by event number. Afterwards it is marked sorted.
+
+    Parameters
+    ----------
+    table : pytables.table
+        The table has to be opened in a writable file.
+    chunk_size : int
+        Number of event numbers read at once.
+
+    Returns
+    -------
+    pytables.table
+        The event index node.
+    '''
+    h5_file, index_name = table._v_file, table.name + 'EventIndex'
+    if index_name in table._v_parent:
+        h5_file.remove_node(table._v_parent, index_name)
+    event_index_table = h5_file.create_table(table._v_parent, name=index_name, description=np.dtype([('event_number', '<i8'), ('start_index', '<i8')]), title='Event index of %s' % table.name, filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+
+    check_order = not is_sorted_by_event(table)
+    last_event_number = None
+    for start_index in range(0, table.nrows, chunk_size):
+        event_numbers = table.read(start=start_index, stop=start_index + chunk_size, field='event_number')
+        if check_order and not check_event_order(event_numbers, np.iinfo(np.int64).min if last_event_number is None else last_event_number):
+            raise RuntimeError('The event number does not always increase. The event index cannot be created!')
+        new_event = np.ones(event_numbers.shape[0], dtype=np.bool_)
+        new_event[1:] = event_numbers[1:] != event_numbers[:-1]
+        if last_event_number is not None:
+            new_event[0] = event_numbers[0] != last_event_number
+        event_index = np.zeros(np.count_nonzero(new_event), dtype=event_index_table.dtype)
+        event_index['event_number'] = event_numbers[new_event]
+        event_index['start_index'] = np.flatnonzero(new_event) + start_index
+        event_index_table.append(event_index)
+        last_event_number = event_numbers[-1]
+    event_index_table.flush()
+    table.attrs.sorted_by_event = True
+    return event_index_table
+
+
+def get_event_index(table):
+    '''Returns the event index node of the table or None if the table has no event index (see create_event_index).
+    An event index that does not cover all table rows (e.g. rows were appended after creating the index) is not used.
+    '''
+    try:
+        event_index = table._v_file.get_node(table._v_parent, table.name + 'EventIndex')
+    except tb.NoSuchNodeError:
+        return None
+    if not _event_index_covers_table(table, event_index):
+        logging.warning('The event index of %s does not cover all rows, it is not used', table.name)
+        return None
+    return event_index
+
+
+def is_event_index(node):
+    '''Returns True if the node is the event index of a table (see create_event_index).
+    '''
+    return isinstance(node, tb.Table) and node.name.endswith('EventIndex') and node.name[:-len('EventIndex')] in node._v_parent
+
+
+def get_event_aligned_ranges(table, chunk_size=10000000):
+    '''Splits the rows of a table with a sorted event_number column into ranges with about chunk_size rows.
+    The ranges do not divide events, thus they can be analyzed independently (e.g. in parallel).
+
+    Parameters
+    ----------
+    table : pytables.table
+    chunk_size : int
+        Approximate number of rows per range. A range is longer if the last event would be splitted.
+
+    Returns
+    -------
+    list of tuples
+        The (start, stop) indices of the ranges. The stop index is not included.
+    '''
+    n_rows = table.nrows
+    event_index = get_event_index(table)
+    if event_index is not None:  # Binary search of the event boundaries, the event index is not read completely
+        return [(start_index, _get_event_aligned_stop(event_index, start_index, n_rows, chunk_size)) for start_index in _get_event_aligned_starts(event_index, 0, n_rows, chunk_size)]
+
+    ranges = []
+    start_index = 0
+    while start_index < n_rows:
+        stop_index = start_index + chunk_size
+        if stop_index >= n_rows:
+            stop_index = n_rows
+        else:  # Move the stop index behind the last event of the range
+            last_event = table.read(start=stop_index - 1, stop=stop_index, field='event_number')[0]
+            read_size = 1000
+            while stop_index < n_rows:
+                event_numbers = table.read(start=stop_index, stop=stop_index + read_size, field='event_number')
+                new_event_indices = np.flatnonzero(event_numbers != last_event)
+                if new_event_indices.shape[0] != 0:
+                    stop_index += new_event_indices[0]
+                    break
+                stop_index += event_numbers.shape[0]
+                read_size *= 2
+        ranges.append((start_index, stop_index))
+        start_index = stop_index
+    return ranges
+
+
+def is_compact_tracklets(table):
+    '''Returns True if the merged cluster / tracklets / track candidates table has the compact format (see merge_cluster_data).
+    The compact format has float32 positions and charge and stores the z position of each DUT in the z_positions attribute
+    instead of the z_dut_N columns. It is only used as long as the z position is the same for all hits of a DUT.
+    '''
+    if isinstance(table, MergedClusterView):
+        return table.z_positions is not None
+    return 'z_positions' in table.attrs._v_attrnames
+
+
+def get_z_positions(table):
+    '''Returns the z position of each DUT of a table in the compact format or None if the table has the full format.
+    '''
+    if not is_compact_tracklets(table):
+        return None
+    return table.z_positions if isinstance(table, MergedClusterView) else table.attrs.z_positions
+
+
+def get_full_tracklets_dtype(dtype):
+    '''Returns the dtype of the full tracklets format with float64 x, y, z positions and charge for each DUT of the compact dtype.
+    '''
+    n_duts = sum([name.startswith('charge_dut_') for name in dtype.names])
+    description = [('event_number', np.int64)]
+    for dimension in ('x', 'y', 'z', 'charge'):
+        for index in range(n_duts):
+            description.append(('%s_dut_%d' % (dimension, index), np.float))
+    description.extend([(name, dtype[name]) for name in dtype.names if name not in [field[0] for field in description]])
+    return np.dtype(description)
+
+
+def get_compact_tracklets_dtype(dtype):
+    '''Returns the dtype of the compact tracklets format without z columns and with float32 positions and charge.
+    '''
+    return np.dtype([(name, np.float32 if name.startswith(('x_dut_', 'y_dut_', 'charge_dut_')) else dtype[name]) for name in dtype.names if not name.startswith('z_dut_')])
+
+
+def expand_tracklets(tracklets, z_positions):
+    '''Converts tracklets of the compact format into the full format. The z positions of the real hits of each DUT are set
+    to the z position of the DUT, virtual hits have z = nan.
+    '''
+    full_tracklets = np.empty(tracklets.shape[0], dtype=get_full_tracklets_dtype(tracklets.dtype))
+    for name in tracklets.dtype.names:
+        full_tracklets[name] = tracklets[name]
+    for index, z_position in enumerate(z_positions):
+        full_tracklets['z_dut_%d' % index] = np.where(np.isnan(tracklets['x_dut_%d' % index]), np.nan, z_position)
+    return full_tracklets
+
+
+def compact_tracklets(tracklets):
+    '''Converts tracklets of the full format into the compact format. The z columns are omitted, thus the z position has to be the
+    same for all hits of a DUT.
+    '''
+    compact = np.empty(tracklets.shape[0], dtype=get_compact_tracklets_dtype(tracklets.dtype))
+    for name in compact.dtype.names:
+        compact[name] = tracklets[name]
+    return compact
+
+
 def fix_event_alignment(event_numbers, ref_column, column, ref_row, row, ref_charge, charge, error=3., n_bad_events=5, n_good_events=3, correlation_search_range=2000, good_events_search_range=10):
     correlated = np.ascontiguousarray(np.ones(shape=event_numbers.shape, dtype=np.uint8))  # array to signal correlation to be ables to omit not correlated events in the analysis
     event_numbers = np.ascontiguousarray(event_numbers)
@@ -485,6 +983,76 @@ def gauss_offset(x, *p):
     return gauss(x, A, mu, sigma) + offset
 
 
+def fit_gauss_offset(x, data, p0, bounds, max_iterations=200, tolerance=1e-8):
+    """
+    Fits gauss_offset to all rows of data at once with a vectorized Levenberg-Marquardt algorithm with analytic Jacobian.
+    The parameters are clipped to the bounds after each step. Rows that converged are not iterated further.
+
+    Parameters
+    ----------
+    x : np.array
+        The bin positions with the shape (n bins, ).
+    data : np.array
+        The histograms to fit with the shape (n rows, n bins).
+    p0 : np.array
+        The start values A, mu, sigma, offset for each row with the shape (n rows, 4).
+    bounds : tuple of np.array
+        The lower and upper parameter bounds for each row, both with the shape (n rows, 4).
+    max_iterations : int
+        The maximum number of iterations.
+    tolerance : float
+        A row converged if the relative decrease of the sum of squared residuals is below the tolerance.
+
+    Returns
+    -------
+    coeff : np.array
+        The fit parameters with the shape (n rows, 4).
+    pcov : np.array
+        The covariance matrices of the fit parameters with the shape (n rows, 4, 4), scaled by the residual variance like in curve_fit.
+    converged : np.array
+        Boolean array, True if the fit of the row converged.
+    """
+    x = np.asarray(x, dtype=np.float)
+    data = np.asarray(data, dtype=np.float)
+    lower, upper = np.array(bounds[0], dtype=np.float), np.array(bounds[1], dtype=np.float)
+    lower[:, 2] = np.maximum(lower[:, 2], 1e-6)  # Sigma has to be positive
+    coeff = np.clip(np.array(p0, dtype=np.float), lower, upper)
+    n_rows, n_bins = data.shape
+    if n_rows == 0:  # np.linalg.pinv fails on empty stacks with older numpy
+        return coeff, np.zeros((0, 4, 4), dtype=np.float), np.zeros(0, dtype=np.bool)
+
+    chi2 = np.square(_gauss_offset_residuals(x, data, coeff)).sum(axis=1)
+    damping = np.full(n_rows, 1e-3)
+    converged = np.zeros(n_rows, dtype=np.bool)
+    active = np.arange(n_rows)
+    for _ in range(max_iterations):
+        if active.shape[0] == 0:
+            break
+        residuals, jacobian = _gauss_offset_residuals(x, data[active], coeff[active], jacobian=True)
+        jtj = np.einsum('nmi,nmj->nij', jacobian, jacobian)
+        gradient = np.einsum('nmi,nm->ni', jacobian, residuals)
+        diagonal = np.einsum('nii->ni', jtj)
+        step = -np.linalg.solve(jtj + (damping[active, np.newaxis] * diagonal + 1e-12)[:, :, np.newaxis] * np.eye(4), gradient[:, :, np.newaxis])[:, :, 0]
+        new_coeff = np.clip(coeff[active] + step, lower[active], upper[active])
+        new_chi2 = np.square(_gauss_offset_residuals(x, data[active], new_coeff)).sum(axis=1)
+
+        improved = new_chi2 <= chi2[active]  # False for nan
+        done = improved & (chi2[active] - new_chi2 <= tolerance * chi2[active])
+        coeff[active[improved]] = new_coeff[improved]
+        chi2[active[improved]] = new_chi2[improved]
+        damping[active] = np.where(improved, damping[active] / 10., damping[active] * 10.)
+        done |= damping[active] > 1e10  # No step decreases the residuals anymore, minimum within the bounds reached
+        converged[active[done]] = True
+        active = active[~done]
+
+    _, jacobian = _gauss_offset_residuals(x, data, coeff, jacobian=True)
+    pcov = np.linalg.pinv(np.einsum('nmi,nmj->nij', jacobian, jacobian))
+    if n_bins > 4:
+        pcov *= (chi2 / (n_bins - 4))[:, np.newaxis, np.newaxis]
+    converged &= np.isfinite(chi2) & np.all(np.isfinite(coeff), axis=1)
+    return coeff, pcov, converged
+
+
 def double_gauss(x, *p):
     A_1, mu_1, sigma_1, A_2, mu_2, sigma_2 = p
     return gauss(x, A_1, mu_1, sigma_1) + gauss(x, A_2, mu_2, sigma_2)
@@ -815,36 +1383,114 @@ def fit_residuals_vs_position(hist, xedges, yedges, xlabel="", ylabel="", title=
     return fit, cov
 
 
-def hough_transform(img, theta_res=1.0, rho_res=1.0, return_edges=False):
-    thetas = np.linspace(-90.0, 0.0, np.ceil(90.0/theta_res) + 1)
-    thetas = np.concatenate((thetas, -thetas[len(thetas)-2::-1]))
-    thetas = np.deg2rad(thetas)
+def truncated_svd(data, n_components=1, n_iterations=4, n_oversamples=10, random_state=0):
+    ''' Randomized truncated singular value decomposition that calculates only the largest singular values and their vectors.
+    The range of the data is sampled with random vectors and refined with power iterations, see Halko et al., SIAM Rev. 53 (2011).
+    For small matrices the full SVD is calculated.
+
+    Parameters
+    ----------
+    data : array like
+        2D matrix.
+    n_components : int
+        Number of singular values and vectors to calculate.
+    n_iterations : int
+        Number of power iterations. More iterations increase the accuracy if the singular values are not well separated.
+    n_oversamples : int
+        Additional random vectors that are used to sample the range of the data.
+    random_state : int, None
+        Seed of the random vectors to get reproducible results.
+
+    Returns
+    -------
+    u, s, vt with shapes (n, n_components), (n_components, ) and (n_components, m).
+    '''
+    data = np.asarray(data, dtype=np.float)
+    n_random = min(n_components + n_oversamples, min(data.shape))
+    if n_random == min(data.shape):  # Randomization does not reduce the size, do full SVD
+        u, s, vt = np.linalg.svd(data, full_matrices=False)
+        return u[:, :n_components], s[:n_components], vt[:n_components, :]
+
+    random_vectors = np.random.RandomState(random_state).normal(size=(data.shape[1], n_random))
+    q, _ = np.linalg.qr(np.dot(data, random_vectors))
+    for _ in range(n_iterations):  # Power iterations with orthonormalization to keep precision
+        q, _ = np.linalg.qr(np.dot(data.T, q))
+        q, _ = np.linalg.qr(np.dot(data, q))
+    # SVD of the small projected matrix
+    u, s, vt = np.linalg.svd(np.dot(q.T, data), full_matrices=False)
+    u = np.dot(q, u)
+    return u[:, :n_components], s[:n_components], vt[:n_components, :]
+
+
+_hough_trig_tables = {}  # cache of the angles and their sin / cos per angle resolution
+
+
+def _get_hough_trig_tables(theta_res):
+    ''' Returns the angles (-90 deg to 90 deg) and their cos and sin values for the given angle resolution.
+    The tables are calculated only once per resolution.
+    '''
+    if theta_res not in _hough_trig_tables:
+        thetas = np.linspace(-90.0, 0.0, int(np.ceil(90.0 / theta_res)) + 1)
+        thetas = np.concatenate((thetas, -thetas[len(thetas) - 2::-1]))
+        thetas = np.deg2rad(thetas)
+        _hough_trig_tables[theta_res] = (thetas, np.cos(thetas), np.sin(thetas))
+    return _hough_trig_tables[theta_res]
+
+
+@njit(cache=True, parallel=True)
+def _hough_accumulate(accumulator, x_idxs, y_idxs, cos_t, sin_t, rhos, rho_res, peak_counts, peak_rho_idxs):
+    ''' Fills the Hough accumulator. Each thread fills full angle columns, thus no write conflicts occur.
+    The maximum of each column and its first rho index are tracked while filling to find the peak without rescanning the accumulator.
+    '''
+    for theta_idx in prange(cos_t.shape[0]):
+        for i in range(x_idxs.shape[0]):
+            rho_val = x_idxs[i] * cos_t[theta_idx] + y_idxs[i] * sin_t[theta_idx]
+            rho_idx = max(0, int(np.floor((rho_val - rhos[0]) / rho_res)))  # rho bin center below the value
+            if rho_idx < rhos.shape[0] - 1 and abs(rhos[rho_idx + 1] - rho_val) < abs(rhos[rho_idx] - rho_val):  # take nearest rho bin center, lower one on tie
+                rho_idx += 1
+            accumulator[rho_idx, theta_idx] += 1
+            count = accumulator[rho_idx, theta_idx]
+            if count > peak_counts[theta_idx] or (count == peak_counts[theta_idx] and rho_idx < peak_rho_idxs[theta_idx]):
+                peak_counts[theta_idx] = count
+                peak_rho_idxs[theta_idx] = rho_idx
+
+
+def hough_transform(img, theta_res=1.0, rho_res=1.0, return_edges=False, return_peak=False):
+    ''' Hough transformation for straight lines of a binary image.
+
+    Parameters
+    ----------
+    img : array like
+        2D image. Non-zero entries are taken as points.
+    theta_res : float
+        The angle resolution in degree.
+    rho_res : float
+        The distance resolution in pixel.
+    return_edges : bool
+        If True, return also the bin edges of the accumulator.
+    return_peak : bool
+        If True, return also the accumulator index (rho index, theta index) of the maximum.
+        The peak is found during the filling of the accumulator and is the same as np.unravel_index(accumulator.argmax(), accumulator.shape).
+
+    Returns
+    -------
+    accumulator, thetas, rhos[, theta_edges, rho_edges][, peak]
+    '''
+    thetas, cos_t, sin_t = _get_hough_trig_tables(theta_res)
     width, height = img.shape
     diag_len = np.sqrt((width - 1)**2 + (height - 1)**2)
-    q = np.ceil(diag_len/rho_res)
+    q = int(np.ceil(diag_len / rho_res))
     nrhos = 2 * q + 1
     rhos = np.linspace(-q * rho_res, q * rho_res, nrhos)
 
-    cos_t = np.cos(thetas)
-    sin_t = np.sin(thetas)
-
-    accumulator = np.zeros((rhos.size, thetas.size), dtype=np.int)
     y_idxs, x_idxs = np.nonzero(img)
+    # A bin cannot be filled more often than there are points
+    accumulator = np.zeros((rhos.size, thetas.size), dtype=np.uint16 if x_idxs.shape[0] <= np.iinfo(np.uint16).max else np.uint32)
+    peak_counts = np.zeros(thetas.size, dtype=accumulator.dtype)
+    peak_rho_idxs = np.zeros(thetas.size, dtype=np.int64)
+    _hough_accumulate(accumulator, x_idxs.astype(np.int64), y_idxs.astype(np.int64), cos_t, sin_t, rhos, float(rho_res), peak_counts, peak_rho_idxs)
 
-    @njit
-    def loop(accumulator, x_idxs, y_idxs, thetas, rhos, sin_t, cos_t):
-
-        for i in range(len(x_idxs)):
-            x = x_idxs[i]
-            y = y_idxs[i]
-
-            for theta_idx in range(thetas.size):
-                #rho_idx = np.around(x * cos_t[theta_idx] + y * sin_t[theta_idx]) + diag_len
-                rhoVal = x * cos_t[theta_idx] + y * sin_t[theta_idx]
-                rho_idx = (np.abs(rhos - rhoVal)).argmin()
-                accumulator[rho_idx, theta_idx] += 1
-    loop(accumulator, x_idxs, y_idxs, thetas, rhos, sin_t, cos_t)
-
+    result = (accumulator, thetas, rhos)  # histogram and bin centers
     if return_edges:
         thetas_diff = thetas[1] - thetas[0]
         thetas_edges = (thetas[1:] + thetas[:-1]) / 2.0
@@ -852,6 +1498,152 @@ def hough_transform(img, theta_res=1.0, rho_res=1.0, return_edges=False):
         rho_diff = rhos[1] - rhos[0]
         rho_edges = (rhos[1:] + rhos[:-1]) / 2.0
         rho_edges = np.r_[rho_edges[0] - rho_diff, rho_edges, rho_edges[-1] + rho_diff]
-        return accumulator, thetas, rhos, theta_edges, rho_edges  # return histogram, bin centers, edges
-    else:
-        return accumulator, thetas, rhos  # return histogram and bin centers
+        result += (theta_edges, rho_edges)
+    if return_peak:
+        # Search the maximum of the column maxima, first rho index and then first theta index on tie as for argmax
+        max_count = peak_counts.max()
+        th_idxs = np.where(peak_counts == max_count)[0]
+        th_idx = th_idxs[np.argmin(peak_rho_idxs[th_idxs])]
+        result += ((peak_rho_idxs[th_idx], th_idx),)
+    return result
+
+
+def _data_aligned_at_events_indexed(table, event_index, start_event_number=None, stop_event_number=None, start=None, stop=None, chunk_size=10000000):
+    ''' Implementation of data_aligned_at_events using the event index of the table. Event boundaries are found with a binary search
+    on the event index node, thus the event index is not read completely. '''
+    start_index = 0 if start is None else start
+    stop_index = table.nrows if stop is None else min(stop, table.nrows)
+    if start_event_number is not None:
+        event_position = _search_sorted_column(event_index, 'event_number', start_event_number, side='left')
+        start_index = max(start_index, _read_value(event_index, 'start_index', event_position) if event_position < event_index.nrows else table.nrows)
+    if stop_event_number is not None:  # stop event number is excluded
+        event_position = _search_sorted_column(event_index, 'event_number', stop_event_number, side='left')
+        stop_index = min(stop_index, _read_value(event_index, 'start_index', event_position) if event_position < event_index.nrows else table.nrows)
+
+    for chunk_start_index in _get_event_aligned_starts(event_index, start_index, stop_index, chunk_size):
+        chunk_stop_index = _get_event_aligned_stop(event_index, chunk_start_index, stop_index, chunk_size)
+        yield table.read(start=chunk_start_index, stop=chunk_stop_index), chunk_stop_index
+
+
+def _read_value(table, field, index):
+    ''' Reads the value of one field of one table row. '''
+    return table.read(start=index, stop=index + 1, field=field)[0]
+
+
+def _search_sorted_column(table, field, value, side='left', block_size=4096):
+    ''' Like np.searchsorted on a sorted table column, but without reading the column completely. Single values are read
+    in a binary search until the search range fits into one block of block_size rows, that is then searched in memory. '''
+    low, high = 0, table.nrows
+    while high - low > block_size:
+        middle = (low + high) // 2
+        middle_value = _read_value(table, field, middle)
+        if middle_value < value or (side == 'right' and middle_value == value):
+            low = middle + 1
+        else:
+            high = middle
+    return low + np.searchsorted(table.read(start=low, stop=high, field=field), value, side=side)
+
+
+def _event_index_covers_table(table, event_index):
+    ''' Returns True if the last indexed event starts at the indexed row and is the last event of the table. '''
+    if event_index.nrows == 0:
+        return table.nrows == 0
+    last_event = event_index.read(start=event_index.nrows - 1, stop=event_index.nrows)[0]
+    last_start_index = last_event['start_index']
+    if last_start_index >= table.nrows:
+        return False
+    if _read_value(table, 'event_number', last_start_index) != last_event['event_number'] or _read_value(table, 'event_number', table.nrows - 1) != last_event['event_number']:
+        return False
+    return last_start_index == 0 or _read_value(table, 'event_number', last_start_index - 1) != last_event['event_number']
+
+
+def _get_event_aligned_stop(event_index, start_index, stop_index, chunk_size):
+    ''' Returns the stop index of the chunk starting at start_index with about chunk_size rows that does not divide an event. '''
+    if start_index + chunk_size >= stop_index:
+        return stop_index
+    event_position = _search_sorted_column(event_index, 'start_index', start_index + chunk_size, side='right') - 1  # Event of the first row not fitting into the chunk
+    event_start_index = _read_value(event_index, 'start_index', event_position)
+    if event_start_index <= start_index:  # Event larger than the chunk, take the whole event
+        event_position += 1
+        if event_position < event_index.nrows:
+            event_start_index = _read_value(event_index, 'start_index', event_position)
+            return event_start_index if event_start_index < stop_index else stop_index
+        return stop_index
+    return event_start_index
+
+
+def _get_event_aligned_starts(event_index, start_index, stop_index, chunk_size):
+    ''' Yields the start indices of consecutive chunks between start_index and stop_index that do not divide events. '''
+    while start_index < stop_index:
+        yield start_index
+        start_index = _get_event_aligned_stop(event_index, start_index, stop_index, chunk_size)
+
+
+def _get_merged_cluster(cluster, dtype, n_pixels, pixel_size, last_event_number, pool):
+    ''' Merges the cluster of all DUTs of the same event range into one array aligned at a common event number.
+    Cluster after last_event_number are omitted. Empty entries are signaled with x = y = z = charge = nan.
+    The DUTs fill disjoint columns, thus they are filled in parallel threads of the pool. '''
+    # Calculate the minimum event numbers needed to merge all cluster to this event number array
+    common_event_numbers = None
+    for actual_cluster in cluster:
+        if actual_cluster.shape[0] == 0:
+            continue
+        common_event_numbers = actual_cluster['event_number'] if common_event_numbers is None else get_max_events_in_both_arrays(common_event_numbers, actual_cluster['event_number'])
+    common_event_numbers = np.ascontiguousarray(common_event_numbers[:np.searchsorted(common_event_numbers, last_event_number, side='right')])
+
+    merged_cluster_array = np.zeros((common_event_numbers.shape[0],), dtype=dtype)  # Result array to be filled. For no hit: column = row = NaN
+    for name in dtype.names:  # Integer columns (e.g. track quality) cannot be NaN, they stay 0
+        if dtype[name].kind == 'f':
+            merged_cluster_array[name] = np.nan
+    merged_cluster_array['event_number'] = common_event_numbers
+
+    pool.map(lambda dut_index: _fill_merged_cluster(merged_cluster_array, dut_index, cluster[dut_index], common_event_numbers, n_pixels[dut_index], pixel_size[dut_index], last_event_number), range(len(cluster)))
+    return merged_cluster_array
+
+
+def _fill_merged_cluster(merged_cluster_array, dut_index, cluster, common_event_numbers, n_pixels, pixel_size, last_event_number):
+    ''' Fills the columns of one DUT of the merged cluster array. '''
+    cluster = cluster[:np.searchsorted(cluster['event_number'], last_event_number, side='right')]
+    if cluster.shape[0] == 0:
+        return
+    cluster = map_cluster(common_event_numbers, cluster)  # Releases the GIL
+    # Add only real hits, nan is a virtual hit
+    selection = ~np.isnan(cluster['mean_column'])
+    # Convert indices to positions, origin in the center of the sensor
+    merged_cluster_array['x_dut_%d' % dut_index][selection] = pixel_size[0] * (cluster['mean_column'][selection] - 0.5 - (0.5 * n_pixels[0]))
+    merged_cluster_array['y_dut_%d' % dut_index][selection] = pixel_size[1] * (cluster['mean_row'][selection] - 0.5 - (0.5 * n_pixels[1]))
+    if 'z_dut_%d' % dut_index in merged_cluster_array.dtype.names:  # Not existing in the compact format
+        merged_cluster_array['z_dut_%d' % dut_index][selection] = 0.0
+    merged_cluster_array['charge_dut_%d' % dut_index][selection] = cluster['charge'][selection]
+
+
+def _gauss_offset_residuals(x, data, coeff, jacobian=False):
+    ''' Returns the residuals of gauss_offset for each row of data and optionally the Jacobian with respect to A, mu, sigma, offset. '''
+    A, mu, sigma, offset = coeff[:, 0:1], coeff[:, 1:2], coeff[:, 2:3], coeff[:, 3:4]
+    dx = x[np.newaxis, :] - mu
+    exponential = np.exp(-dx ** 2 / (2.0 * sigma ** 2))
+    residuals = A * exponential + offset - data
+    if not jacobian:
+        return residuals
+    jacobian = np.empty(data.shape + (4,), dtype=np.float)
+    jacobian[:, :, 0] = exponential
+    jacobian[:, :, 1] = A * exponential * dx / sigma ** 2
+    jacobian[:, :, 2] = A * exponential * dx ** 2 / sigma ** 3
+    jacobian[:, :, 3] = 1.0
+    return residuals, jacobian
+
+
+@njit(parallel=True)
+def _correlate_blocks(event_number_1, column_index_1, row_index_1, event_number_2, column_index_2, row_index_2, block_edges, column_corr_hists, row_corr_hists):
+    ''' Histograms the correlation of the blocks of data 1 with data 2 in parallel threads, one histogram per block. '''
+    for block_index in prange(block_edges.shape[0] - 1):
+        index_data_2 = np.searchsorted(event_number_2, event_number_1[block_edges[block_index]])
+        for index_data_1 in range(block_edges[block_index], block_edges[block_index + 1]):
+            while index_data_2 < event_number_2.shape[0] and event_number_2[index_data_2] < event_number_1[index_data_1]:  # Catch up with outer loop
+                index_data_2 += 1
+            for event_index_data_2 in range(index_data_2, event_number_2.shape[0]):
+                if event_number_1[index_data_1] == event_number_2[event_index_data_2]:
+                    column_corr_hists[block_index, column_index_2[event_index_data_2], column_index_1[index_data_1]] += 1
+                    row_corr_hists[block_index, row_index_2[event_index_data_2], row_index_1[index_data_1]] += 1
+                else:
+                    break
@@ -99,10 +99,14 @@ def select_hits(hit_file, max_hits=None, condition=None, track_quality=None, tra
             output_file = hit_file[:-3] + '_reduced.h5'
         with tb.open_file(output_file, mode="w") as out_file_h5:
             for node in in_file_h5.root:
+                if analysis_utils.is_event_index(node):  # The event index belongs to a hit table
+                    continue
                 total_hits = node.shape[0]
                 progress_bar = progressbar.ProgressBar(widgets=['', progressbar.Percentage(), ' ', progressbar.Bar(marker='*', left='|', right='|'), ' ', progressbar.AdaptiveETA()], maxval=total_hits, term_width=80)
                 progress_bar.start()
                 hit_table_out = out_file_h5.create_table(out_file_h5.root, name=node.name, description=node.dtype, title=node.title, filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+                if analysis_utils.is_compact_tracklets(node):
+                    hit_table_out.attrs.z_positions = node.attrs.z_positions
                 for hits, index in analysis_utils.data_aligned_at_events(node, chunk_size=chunk_size):
                     n_hits = hits.shape[0]
                     if condition:
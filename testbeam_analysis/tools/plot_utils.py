@@ -104,12 +104,19 @@ def plot_cluster_size(input_cluster_file, output_pdf_file=None, dut_name=None):
 
     with PdfPages(output_pdf_file) as output_pdf:
         with tb.open_file(input_cluster_file, 'r') as input_file_h5:
-            cluster_n_hits = input_file_h5.root.Cluster[:1000000]['n_hits']
+            try:  # Histograms created during clustering
+                cluster_size_hist = input_file_h5.root.HistClusterSize[:]
+                cluster_charge_hist = input_file_h5.root.HistClusterCharge[:]
+                n_cluster_per_event_hist = input_file_h5.root.HistNClusterPerEvent[:]
+            except tb.NoSuchNodeError:  # Old cluster files without histograms
+                cluster_n_hits = input_file_h5.root.Cluster[:1000000]['n_hits']
+                cluster_size_hist = testbeam_analysis.tools.analysis_utils.hist_1d_index(cluster_n_hits, shape=(np.amax(cluster_n_hits) + 1,))
+                cluster_charge_hist, n_cluster_per_event_hist = None, None
             # Save cluster size histogram
-            max_cluster_size = np.amax(cluster_n_hits) + 1
+            max_cluster_size = cluster_size_hist.shape[0]
             plt.clf()
             left = np.arange(max_cluster_size)
-            hight = testbeam_analysis.tools.analysis_utils.hist_1d_index(cluster_n_hits, shape=(max_cluster_size,))
+            hight = cluster_size_hist
             plt.bar(left, hight, align='center')
             plt.title('Cluster size of %s' % dut_name)
             plt.xlabel('Cluster size')
@@ -123,6 +130,18 @@ def plot_cluster_size(input_cluster_file, output_pdf_file=None, dut_name=None):
             plt.ylim(ymax=np.amax(hight))
             plt.xlim(0.5, min(10, max_cluster_size - 1) + 0.5)
             output_pdf.savefig()
+            # Save cluster charge and number of cluster per event histograms
+            for hist, xlabel, title in ((cluster_charge_hist, 'Cluster charge', 'Cluster charge of %s' % dut_name),
+                                        (n_cluster_per_event_hist, 'Number of cluster per event', 'Number of cluster per event of %s' % dut_name)):
+                if hist is None or hist.shape[0] == 0:
+                    continue
+                plt.clf()
+                plt.bar(np.arange(hist.shape[0]), hist, align='center')
+                plt.title(title)
+                plt.xlabel(xlabel)
+                plt.ylabel('#')
+                plt.grid()
+                output_pdf.savefig()
 
 
 def plot_correlation_fit(x, y, y_fit, xlabel, fit_label, title, output_pdf):
@@ -328,8 +347,8 @@ def plot_alignments(x, mean_fitted, mean_error_fitted, n_cluster, ref_name, dut_
             left_limit_plot.set_xdata([left_limit, left_limit])
             right_limit_plot.set_xdata([right_limit, right_limit])
             offset_plot.set_data(x[initial_select], np.abs(offset[initial_select]))
-            offset_slider.valmax = np.max(np.abs(offset))
-            offset_slider.ax.set_xlim(xmax=np.max(np.abs(offset)))
+            offset_slider.valmax = np.nanmax(np.abs(offset))  # The offset of not fitted rows is nan
+            offset_slider.ax.set_xlim(xmax=np.nanmax(np.abs(offset)))
             mean_plot.set_data(x[selected_data], mean_fitted[selected_data])
             line_plot.set_data(x, fit_fn(x))
         else:
@@ -405,13 +424,15 @@ def plot_alignments(x, mean_fitted, mean_error_fitted, n_cluster, ref_name, dut_
     ax.grid()
 
     # Setup interactive sliders/buttons
-    ax_offset = plt.axes([0.410, 0.04, 0.2, 0.02], axisbg='white')
-    ax_error = plt.axes([0.410, 0.01, 0.2, 0.02], axisbg='white')
-    ax_left_limit = plt.axes([0.125, 0.04, 0.2, 0.02], axisbg='white')
-    ax_right_limit = plt.axes([0.125, 0.01, 0.2, 0.02], axisbg='white')
-    ax_button_auto = plt.axes([0.670, 0.01, 0.06, 0.05], axisbg='black')
-    ax_button_refit = plt.axes([0.735, 0.01, 0.08, 0.05], axisbg='black')
-    ax_button_ok = plt.axes([0.82, 0.01, 0.08, 0.05], axisbg='black')
+    ax_offset = plt.axes([0.410, 0.04, 0.2, 0.02])
+    ax_error = plt.axes([0.410, 0.01, 0.2, 0.02])
+    ax_left_limit = plt.axes([0.125, 0.04, 0.2, 0.02])
+    ax_right_limit = plt.axes([0.125, 0.01, 0.2, 0.02])
+    ax_button_auto = plt.axes([0.670, 0.01, 0.06, 0.05])
+    ax_button_refit = plt.axes([0.735, 0.01, 0.08, 0.05])
+    ax_button_ok = plt.axes([0.82, 0.01, 0.08, 0.05])
+    for ax_widget, color in ((ax_offset, 'white'), (ax_error, 'white'), (ax_left_limit, 'white'), (ax_right_limit, 'white'), (ax_button_auto, 'black'), (ax_button_refit, 'black'), (ax_button_ok, 'black')):
+        ax_widget.patch.set_facecolor(color)  # The axisbg keyword of plt.axes was removed in matplotlib 2.2
     # Create widgets
     offset_slider = Slider(ax_offset, 'Offset Cut', 0.0, offset_limit, valinit=offset_limit)
     error_slider = Slider(ax_error, 'Error cut', 0.0, error_limit * 10.0, valinit=error_limit * 10.0)
@@ -542,6 +563,13 @@ def plot_correlations(input_correlation_file, output_pdf_file=None, pixel_size=N
                         column = False
                 except AttributeError:
                     continue
+                dut_name = dut_names[dut_idx] if dut_names else ("DUT " + str(dut_idx))
+                ref_name = dut_names[ref_idx] if dut_names else ("DUT " + str(ref_idx))
+
+                if isinstance(node, tb.Table):  # Correlation quality for event windows
+                    plot_correlation_quality(node[:], dut_name=dut_name, ref_name=ref_name, output_pdf=output_pdf)
+                    continue
+
                 data = node[:]
 
                 if np.all(data <= 0):
@@ -552,13 +580,13 @@ def plot_correlations(input_correlation_file, output_pdf_file=None, pixel_size=N
                 cmap = cm.get_cmap('viridis')
 #                 cmap.set_bad('w')
                 norm = colors.LogNorm()
-                if pixel_size:
+                if 'bin_size' in node.attrs:  # Correlation is binned in um
+                    aspect = node.attrs.bin_size[0] / float(node.attrs.bin_size[1])
+                elif pixel_size:
                     aspect = pixel_size[ref_idx][0 if column else 1] / (pixel_size[dut_idx][0 if column else 1])
                 else:
                     aspect = "auto"
                 im = plt.imshow(data.T, origin="lower", cmap=cmap, norm=norm, aspect=aspect, interpolation='none')
-                dut_name = dut_names[dut_idx] if dut_names else ("DUT " + str(dut_idx))
-                ref_name = dut_names[ref_idx] if dut_names else ("DUT " + str(ref_idx))
                 plt.title("Correlation of %s: %s vs. %s" % ("columns" if "column" in node.title.lower() else "rows", dut_name, ref_name))
                 plt.xlabel('%s %s' % ("Column" if "column" in node.title.lower() else "Row", dut_name))
                 plt.ylabel('%s %s' % ("Column" if "column" in node.title.lower() else "Row", ref_name))
@@ -571,6 +599,19 @@ def plot_correlations(input_correlation_file, output_pdf_file=None, pixel_size=N
                 output_pdf.savefig()
 
 
+def plot_correlation_quality(quality, dut_name, ref_name, output_pdf):
+    plt.clf()
+    plt.plot(quality['event_number'], quality['column_fraction'], '.-', label='Column')
+    plt.plot(quality['event_number'], quality['row_fraction'], '.-', label='Row')
+    plt.title("Correlation quality: %s vs. %s" % (dut_name, ref_name))
+    plt.xlabel('Event number')
+    plt.ylabel('Fraction of correlated cluster pairs')
+    plt.ylim(0, 1.05)
+    plt.grid()
+    plt.legend(loc=0)
+    output_pdf.savefig()
+
+
 def plot_hit_alignment(title, difference, particles, ref_dut_column, table_column, actual_median, actual_mean, output_fig, bins=100):
     plt.clf()
     plt.hist(difference, bins=bins, range=(-1. / 100. * np.amax(particles[:][ref_dut_column]) / 1., 1. / 100. * np.amax(particles[:][ref_dut_column]) / 1.))
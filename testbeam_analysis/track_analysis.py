@@ -29,9 +29,9 @@ def find_tracks(input_tracklets_file, input_alignment_file, output_track_candida
 
     Parameters
     ----------
-    input_tracklets_file : string
+    input_tracklets_file : string or analysis_utils.MergedClusterView
         Input file name with merged cluster hit table from all DUTs (tracklets file)
-        Or track candidates file.
+        Or track candidates file. Or the lazy merged cluster view.
     input_alignment_file : string
         File containing the alignment information
     output_track_candidates_file : string
@@ -72,23 +72,20 @@ def find_tracks(input_tracklets_file, input_alignment_file, output_track_candida
                 column_sigma[index] = correlations[index]['column_sigma']
                 row_sigma[index] = correlations[index]['row_sigma']
 
-    with tb.open_file(input_tracklets_file, mode='r') as in_file_h5:
-        try:  # First try:  normal tracklets assumed
-            tracklets_node = in_file_h5.root.Tracklets
-        except tb.exceptions.NoSuchNodeError:
-            try:  # Second try: normal track candidates assumed
-                tracklets_node = in_file_h5.root.TrackCandidates
-                logging.info('Additional find track run on track candidates file %s', input_tracklets_file)
-                logging.info('Output file with new track candidates file %s', output_track_candidates_file)
-            except tb.exceptions.NoSuchNodeError:  # Last try: not used yet
-                raise
+    def find_tracks_in_table(tracklets_node):
+        compact = analysis_utils.is_compact_tracklets(tracklets_node)  # The track finding does not change z, thus compact tracklets give compact track candidates
         with tb.open_file(output_track_candidates_file, mode='w') as out_file_h5:
             track_candidates = out_file_h5.create_table(out_file_h5.root, name='TrackCandidates', description=tracklets_node.dtype, title='Track candidates', filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+            if compact:
+                z_positions = analysis_utils.get_z_positions(tracklets_node)
+                track_candidates.attrs.z_positions = z_positions
 
             progress_bar = progressbar.ProgressBar(widgets=['', progressbar.Percentage(), ' ', progressbar.Bar(marker='*', left='|', right='|'), ' ', progressbar.AdaptiveETA()], maxval=tracklets_node.shape[0], term_width=80)
             progress_bar.start()
 
             for tracklets_data_chunk, index in analysis_utils.data_aligned_at_events(tracklets_node, chunk_size=chunk_size):
+                if compact:
+                    tracklets_data_chunk = analysis_utils.expand_tracklets(tracklets_data_chunk, z_positions)
                 # Prepare hit data for track finding, create temporary arrays for x, y, z position and charge data
                 # This is needed to call a numba jitted function, since the number of DUTs is not fixed and thus the data format
                 tr_x = tracklets_data_chunk['x_dut_0']
@@ -109,11 +106,28 @@ def find_tracks(input_tracklets_file, input_alignment_file, output_track_candida
                 # Merge result data from arrays into one recarray
                 combined = np.column_stack((tracklets_data_chunk['event_number'], tr_x, tr_y, tr_z, tr_charge, tracklets_data_chunk['track_quality'], tracklets_data_chunk['n_tracks']))
                 combined = np.core.records.fromarrays(combined.transpose(), dtype=tracklets_data_chunk.dtype)
+                if compact:
+                    combined = analysis_utils.compact_tracklets(combined)
 
                 track_candidates.append(combined)
                 progress_bar.update(index)
             progress_bar.finish()
 
+    if isinstance(input_tracklets_file, analysis_utils.MergedClusterView):  # Merged cluster are created on the fly
+        find_tracks_in_table(input_tracklets_file)
+    else:
+        with tb.open_file(input_tracklets_file, mode='r') as in_file_h5:
+            try:  # First try:  normal tracklets assumed
+                tracklets_node = in_file_h5.root.Tracklets
+            except tb.exceptions.NoSuchNodeError:
+                try:  # Second try: normal track candidates assumed
+                    tracklets_node = in_file_h5.root.TrackCandidates
+                    logging.info('Additional find track run on track candidates file %s', input_tracklets_file)
+                    logging.info('Output file with new track candidates file %s', output_track_candidates_file)
+                except tb.exceptions.NoSuchNodeError:  # Last try: not used yet
+                    raise
+            find_tracks_in_table(tracklets_node)
+
 
 def fit_tracks(input_track_candidates_file, input_alignment_file, output_tracks_file, fit_duts=None, selection_hit_duts=None, selection_fit_duts=None, exclude_dut_hit=True, selection_track_quality=1, max_tracks=None, force_prealignment=False, use_correlated=False, min_track_distance=False, chunk_size=1000000):
     '''Fits a line through selected DUT hits for selected DUTs. The selection criterion for the track candidates to fit is the track quality and the maximum number of hits per event.
@@ -344,6 +358,7 @@ def fit_tracks(input_track_candidates_file, input_alignment_file, output_tracks_
                 pass
             with tb.open_file(output_tracks_file, mode='a') as out_file_h5:  # Append mode to be able to append to existing tables; file is created here since old file is deleted
                 n_duts = sum(['charge' in col for col in in_file_h5.root.TrackCandidates.dtype.names])
+                track_candidates_z_positions = analysis_utils.get_z_positions(in_file_h5.root.TrackCandidates)  # Only set for compact track candidates
                 fit_duts = fit_duts if fit_duts is not None else range(n_duts)  # Std. setting: fit tracks for all DUTs
 
                 if min_track_distance is True:
@@ -368,6 +383,8 @@ def fit_tracks(input_track_candidates_file, input_alignment_file, output_tracks_
                     progress_bar.start()
 
                     for track_candidates_chunk, index_candidates in analysis_utils.data_aligned_at_events(in_file_h5.root.TrackCandidates, chunk_size=chunk_size):
+                        if track_candidates_z_positions is not None:  # Compact track candidates
+                            track_candidates_chunk = analysis_utils.expand_tracklets(track_candidates_chunk, track_candidates_z_positions)
 
                         # Select tracks based on the dut that are required to have a hit (dut_selection) with a certain quality (track_quality)
 